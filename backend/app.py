@@ -1,8 +1,7 @@
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-import PyPDF2
-import csv, re, unicodedata
+import csv, re
 
 import sys
 from pathlib import Path
@@ -27,20 +26,47 @@ import subprocess
 import fitz
 from openai import BadRequestError
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 import pandas as pd
 import base64
-from datetime import datetime
-from PyPDF2 import PdfReader
+from datetime import datetime, timedelta
 from backend.gpt_interface import (
     get_response_from_chatgpt_multiple_image_and_functions,
-    get_markdown_schema
+    aget_response_from_chatgpt_multiple_image_and_functions,
+    get_response_from_chatgpt_with_functions,
+    aget_response_from_chatgpt_with_functions,
+    get_markdown_schema,
+    get_embedding,
+    image_bytes_to_data_url,
+    run_on_gpt_loop,
+    RATE_LIMITER,
+)
+from backend.prompt_index import (
+    PromptEmbeddingIndex,
+    PROMPT_EMBEDDING_MODEL,
+    PROMPT_EMBEDDING_DIMENSIONS,
+)
+from backend.rendering import (
+    IMAGE_FORMATS,
+    DOCUMENT_CACHE,
+    RENDER_SERVICE,
+    RenderTimeout,
+    MANIFEST_VERSION,
+    build_document_manifest,
+    page_ink_stats,
 )
 
 import uuid
-from typing import List, Dict
+import json
+import asyncio
+import hashlib
+from typing import List, Dict, Optional, Tuple
 import threading
 from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from itertools import groupby
 
 from dataclasses import dataclass
 import time
@@ -61,20 +87,46 @@ from backend.database import (
     save_prompt,
     search_prompts,
     get_prompt_by_id,
+    get_prompts_by_ids,
     delete_prompt,
     save_feedback,
 
     # page results
-    create_page_results_table,
     append_page_result,
-    get_all_page_results,
-    delete_page_results_table,
+    iter_page_results,
+    iter_batch_page_results,
+    delete_page_results,
+    require_page_results_saved,
 
     # job metadata
     create_job,
     get_job,
+    get_jobs_by_ids,
     touch_job_processing_started_at,
     delete_job,
+    count_page_results,
+    cleanup_jobs_older_than,
+    purge_orphan_page_results,
+    list_job_file_ids,
+    list_job_ids,
+    evict_gpt_response_cache,
+    record_job_cache_lookup,
+
+    # GPT response cache
+    get_cached_gpt_response,
+    put_cached_gpt_response,
+)
+from backend.jobstate import JobState
+from backend.housekeeping import Housekeeper
+from backend.upload_store import CAS_DIR_NAME, MANIFEST_NAME, ContentStore, UploadStore
+from backend.export import (
+    OUTPUT_FORMATS,
+    JobExportSpool,
+    iter_export_rows,
+    iter_spooled_rows,
+    normalise_output_format,
+    output_extension,
+    write_rows,
 )
 from io import BytesIO
 
@@ -125,17 +177,6 @@ def _new_ctx(conn_id: str):
         return ctx
     
 
-def _df_to_xlsx_bytesio(df: pd.DataFrame) -> BytesIO:
-    """
-    Convert df to an in-memory XLSX (BytesIO) using openpyxl.
-    """
-    xlsx_io = BytesIO()
-    with pd.ExcelWriter(xlsx_io, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="output")
-    xlsx_io.seek(0)
-    return xlsx_io
-
-
 def _sharepoint_upload_bytes_overwrite(ctx, sp_folder_name: str, sp_file_name: str, content: BytesIO) -> bool:
     """
     Upload BytesIO to SharePoint folder, overwriting if it already exists.
@@ -226,109 +267,113 @@ UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 
 
 
-def _ensure_png_size(img_path: Path,
-                     max_bytes: int = 10 * 1024 * 1024,
-                     min_side_px: int = 256,
-                     downscale_step: float = 0.90,
-                     quantize_steps: list[int] = [256, 128, 64]) -> Path:
-    """
-    Ensure *img_path* (PNG) is ≤ *max_bytes* while keeping it PNG.
-
-    Strategy:
-    • Try palette quantization (256→128→64 colors) with PNG optimize.
-    • If still too big, progressively downscale by 10% until it fits
-      or the shortest edge reaches *min_side_px*.
-    """
-    from PIL import Image
-
-    if img_path.stat().st_size <= max_bytes:
-        return img_path
-
-    with Image.open(img_path) as im:
-        # Work in RGBA when possible; quantize will palette it.
-        im = im.convert("RGBA")
-
-        # 1) Quantization passes
-        for colors in quantize_steps:
-            im_q = im.quantize(colors=colors, method=Image.MEDIANCUT, dither=Image.FLOYDSTEINBERG)
-            im_q.save(img_path, format="PNG", optimize=True, compress_level=9)
-            if img_path.stat().st_size <= max_bytes:
-                return img_path
-
-        # 2) Resolution sweep
-        curr = im
-        while img_path.stat().st_size > max_bytes and min(curr.size) > min_side_px:
-            new_w = max(min_side_px, int(curr.width * downscale_step))
-            new_h = max(min_side_px, int(curr.height * downscale_step))
-            if new_w == curr.width and new_h == curr.height:
-                break
-            curr = curr.resize((new_w, new_h), Image.LANCZOS)
-            curr.save(img_path, format="PNG", optimize=True, compress_level=9)
-
-    return img_path
-
-from contextlib import contextmanager
-
-@contextmanager
-def rasterize_pdf_pages_to_temp_pngs(pdf_path: Path, pages: List[int], dpi: int = 200) -> Dict[int, Path]:
+def _pdf_path_for_file_id(file_id: str) -> str:
     """
-    Rasterize selected PDF pages to PNGs in a TemporaryDirectory and ALWAYS clean it up.
-    Returns {page_number: png_path}.
+    Look up the canonical PDF stored as uploads/<file_id>/document.pdf.
+    Deduplicated uploads resolve to the shared content-store copy, so every
+    alias hits the same open-document and render-worker caches.
     """
-    doc = None
-    tmp_obj = None
-    try:
-        doc = fitz.open(str(pdf_path))
-        max_page = len(doc)
+    pdf_path = UPLOAD_ROOT / file_id / 'document.pdf'
+    if not pdf_path.exists():
+        raise FileNotFoundError(
+            f"PDF not found for file_id={file_id} at {pdf_path}")
+    UPLOAD_STORE.touch(file_id)
+    content_id = CONTENT_STORE.content_id_for(file_id)
+    if content_id:
+        return str(CONTENT_STORE.blob_path(content_id))
+    return str(pdf_path)
 
-        pages_to_render = []
-        for p in pages:
-            try:
-                p_int = int(p)
-            except Exception:
-                continue
-            if 1 <= p_int <= max_page:
-                pages_to_render.append(p_int)
 
-        tmp_obj = tempfile.TemporaryDirectory(prefix=f"{pdf_path.stem}_")
-        tmp_dir = Path(tmp_obj.name)
+def _content_document_key(content_id: str) -> str:
+    return f"{CAS_DIR_NAME}/{content_id}"
 
-        scale = dpi / 72.0
-        mtx = fitz.Matrix(scale, scale)
 
-        out: Dict[int, Path] = {}
-        for p in pages_to_render:
-            page = doc[p - 1]
-            pix = page.get_pixmap(matrix=mtx)
-            png_path = tmp_dir / f"page_{p:04d}.png"
-            pix.save(str(png_path))
-            _ensure_png_size(png_path)
-            out[p] = png_path
+def _document_key(file_id: str) -> str:
+    """DOCUMENT_CACHE key for an upload: shared by all aliases of the same content."""
+    content_id = CONTENT_STORE.content_id_for(file_id) if file_id else None
+    return _content_document_key(content_id) if content_id else file_id
 
-        yield out
-    finally:
-        if doc is not None:
-            try:
-                doc.close()
-            except Exception:
-                pass
-        if tmp_obj is not None:
+
+def _store_upload_content(stream, original_name: str, dest_dir: Path) -> Tuple[str, Path]:
+    """
+    Save an uploaded file into the content store, hashing it on the way, and
+    link it as dest_dir/document.pdf. Bytes seen before skip conversion and
+    copying entirely. Returns (content_id, pdf_path).
+    """
+    content_id, tmp_path = CONTENT_STORE.save_stream(stream)
+    try:
+        if CONTENT_STORE.has(content_id):
             try:
-                tmp_obj.cleanup()
-            except Exception:
-                pass
+                return content_id, CONTENT_STORE.link(content_id, dest_dir)
+            except FileNotFoundError:
+                pass  # swept since has(); store it again below
 
+        if Path(original_name).suffix.lower() == '.pdf':
+            pdf_path = tmp_path
+        else:
+            # Converted once; the PDF is stored under the hash of the original bytes
+            original_path = dest_dir / (secure_filename(original_name) or "original")
+            os.replace(tmp_path, original_path)
+            pdf_path = _ensure_pdf_in_folder(original_path, dest_dir)
+            original_path.unlink(missing_ok=True)
+        CONTENT_STORE.adopt(content_id, pdf_path)
+        return content_id, CONTENT_STORE.link(content_id, dest_dir)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
-def _pdf_path_for_file_id(file_id: str) -> str:
+@lru_cache(maxsize=256)
+def _content_manifest(content_id: str) -> Dict[str, Any]:
     """
-    Look up the canonical PDF stored as uploads/<file_id>/document.pdf
+    Manifest of stored content (page count, page sizes, text and image stats),
+    built in one PyMuPDF pass the first time the content is seen and kept
+    beside the blob. Content never changes, so it is also cached here.
     """
-    pdf_path = UPLOAD_ROOT / file_id / 'document.pdf'
-    if not pdf_path.exists():
-        raise FileNotFoundError(
-            f"PDF not found for file_id={file_id} at {pdf_path}")
-    return str(pdf_path)
+    manifest = CONTENT_STORE.load_manifest(content_id)
+    if manifest is None or manifest.get("version") != MANIFEST_VERSION:
+        with DOCUMENT_CACHE.borrow(_content_document_key(content_id), str(CONTENT_STORE.blob_path(content_id))) as doc:
+            manifest = build_document_manifest(doc)
+        CONTENT_STORE.save_manifest(content_id, manifest)
+    return manifest
+
+
+def _prepare_upload_manifest(content_id: str, dest_dir: Path) -> int:
+    """Write dest_dir/manifest.json for a stored upload; returns its page count."""
+    manifest = _content_manifest(content_id)
+    CONTENT_STORE.link_manifest(content_id, dest_dir)
+    return int(manifest["page_count"])
+
+
+def _manifest_for_file_id(file_id: str) -> Dict[str, Any]:
+    """Manifest of an upload; uploads from before manifests get one built now."""
+    content_id = CONTENT_STORE.content_id_for(file_id)
+    if content_id:
+        return _content_manifest(content_id)
+
+    pdf_path = _pdf_path_for_file_id(file_id)
+    manifest_path = Path(pdf_path).with_name(MANIFEST_NAME)
+    try:
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    with DOCUMENT_CACHE.borrow(file_id, pdf_path) as doc:
+        manifest = build_document_manifest(doc)
+    manifest_path.write_text(json.dumps(manifest, separators=(",", ":")))
+    return manifest
+
+
+def _manifest_page(file_id: Optional[str], page_num: int) -> Optional[Dict[str, Any]]:
+    """A page's manifest entry when it is already at hand (deduplicated uploads), else None."""
+    content_id = CONTENT_STORE.content_id_for(file_id) if file_id else None
+    if not content_id:
+        return None
+    try:
+        pages = _content_manifest(content_id)["pages"]
+    except Exception:
+        return None
+    return pages[page_num - 1] if 1 <= page_num <= len(pages) else None
 
 
 
@@ -414,36 +459,48 @@ def normalize(value):
 
 
 
-def cleanup_upload_root(max_age_seconds: int = 3600):
-    """
-    Delete per-file_id directories under UPLOAD_ROOT that are older than max_age_seconds.
-    """
-    now = time.time()
-    if not UPLOAD_ROOT.exists():
-        return
-    for child in UPLOAD_ROOT.iterdir():
-        try:
-            if child.is_dir():
-                age = now - child.stat().st_mtime
-                if age > max_age_seconds:
-                    shutil.rmtree(child, ignore_errors=True)
-        except Exception:
-            # Don't let cleanup errors break requests
-            traceback.print_exc()
+# Upload directories are kept within a disk budget, least recently used first;
+# anything a job row still refers to is pinned
+UPLOAD_ROOT_MAX_BYTES = int(os.getenv("UPLOAD_ROOT_MAX_BYTES", str(5 * 1024 ** 3)))
+UPLOAD_MAX_IDLE_SECONDS = int(os.getenv("UPLOAD_MAX_IDLE_SECONDS", str(24 * 3600)))
 
-@app.before_request
-def _cleanup_uploads_periodically():
-    # this is cheap enough to run each request
-    cleanup_upload_root()
+
+def _forget_upload(file_id: str):
+    # Close any cached handle before the file goes away
+    DOCUMENT_CACHE.invalidate(file_id)
+    CONTENT_STORE.forget(file_id)
+    _drop_export_spools_for_file(file_id)
+
+
+UPLOAD_STORE = UploadStore(
+    UPLOAD_ROOT,
+    max_bytes=UPLOAD_ROOT_MAX_BYTES,
+    max_idle_seconds=UPLOAD_MAX_IDLE_SECONDS,
+    pinned_ids=list_job_file_ids,
+    on_evict=_forget_upload,
+)
+
+# Deduplicated upload content under UPLOAD_ROOT/_cas (skipped by UPLOAD_STORE)
+CONTENT_STORE = ContentStore(
+    UPLOAD_ROOT,
+    on_remove=lambda content_id: DOCUMENT_CACHE.invalidate(_content_document_key(content_id)),
+)
+
+
+_DOWNLOAD_MIMETYPES = {ext: mimetype for ext, mimetype in OUTPUT_FORMATS.values()}
 
 
 @app.route('/download/<path:filename>', methods=['GET'])
 def download(filename):
-    # Let Flask infer mimetype from extension; don't force CSV.
+    # Export formats get their own mimetype; otherwise let Flask infer it from
+    # the extension. The file is streamed from disk (with Range support).
+    mimetype = _DOWNLOAD_MIMETYPES.get(Path(filename).suffix.lower())
+    UPLOAD_STORE.touch(Path(filename).parts[0])
     return send_from_directory(
         app.config['UPLOAD_FOLDER'],
         filename,
-        as_attachment=True
+        as_attachment=True,
+        mimetype=mimetype,
     )
 
 @app.route("/api/prepare_sharepoint_pdf", methods=["POST"])
@@ -521,29 +578,22 @@ def _download_sp_file_to_upload(ctx, sp_file_path: str, original_filename: str)
     dest_dir = UPLOAD_ROOT / upload_id
     dest_dir.mkdir(parents=True, exist_ok=True)
 
-    safe_name = secure_filename(original_filename) or "original"
-    original_path = dest_dir / safe_name
-
     def _save_from_stream(file_stream):
+        # Normalize/convert to document.pdf so the rest of the app behaves like /upload
         file_stream.seek(0)
-        with open(original_path, "wb") as f:
-            f.write(file_stream.read())
-        return True
+        return _store_upload_content(file_stream, original_filename, dest_dir)
 
     try:
         # Downloads file and calls custom_function with a BytesIO
-        sharepoint_import_excel(
+        content_id, _ = sharepoint_import_excel(
             ctx,
             sp_file_path,
             sheet=None,
             custom_function=_save_from_stream
         )
 
-        # Normalize/convert to document.pdf so the rest of the app behaves like /upload
-        canonical_pdf = _ensure_pdf_in_folder(original_path, dest_dir)
-
-        with open(str(canonical_pdf), "rb") as f:
-            page_count = len(PdfReader(f).pages)
+        page_count = _prepare_upload_manifest(content_id, dest_dir)
+        UPLOAD_STORE.register(upload_id)
 
         return {
             "file_id": upload_id,
@@ -552,6 +602,7 @@ def _download_sp_file_to_upload(ctx, sp_file_path: str, original_filename: str)
             "file_stem": Path(original_filename).stem,
         }
     except Exception:
+        DOCUMENT_CACHE.invalidate(upload_id)
         shutil.rmtree(dest_dir, ignore_errors=True)
         raise
 
@@ -899,24 +950,6 @@ def file_exists_endpoint():
         return jsonify({"error": str(e)}), 500
 
 
-def count_document_pages(file_path, original_filename):
-    """Count the number of pages in a document (PDF)"""
-    file_ext = original_filename.rsplit('.', 1)[1].lower()
-
-    try:
-        if file_ext == 'pdf':
-            # Count PDF pages using PyPDF2
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                return len(pdf_reader.pages)
-
-
-    except Exception as e:
-        print(f"Error counting pages: {e}")
-        return 1
-
-
-
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -935,35 +968,22 @@ def upload_file():
     dest_dir = UPLOAD_ROOT / upload_id
     dest_dir.mkdir(parents=True, exist_ok=True)
 
-    # Save original
-    original_path = dest_dir / f"original{Path(original_filename).suffix.lower()}"
-    file.save(str(original_path))
-
+    # Hash while saving; a file seen before becomes another link to the same document.pdf
     try:
-        converted_path = Path(str(original_path))
-
-        # normalize it to document.pdf
-        canonical_pdf = dest_dir / 'document.pdf'
-        if converted_path.suffix.lower() == '.pdf' and converted_path.exists():
-            # If LibreOffice wrote <basename>.pdf into dest_dir, move/rename it
-            if converted_path != canonical_pdf:
-                shutil.copy2(str(converted_path), str(canonical_pdf))
-            pdf_path = canonical_pdf
-        else:
-            # Fallback: ensure PDF via _ensure_pdf_in_folder (does its own conversion/rename)
-            pdf_path = _ensure_pdf_in_folder(original_path, dest_dir)
+        content_id, _ = _store_upload_content(file.stream, original_filename, dest_dir)
     except Exception as e:
         shutil.rmtree(dest_dir, ignore_errors=True)
         return jsonify({'error': f'Failed to convert file to PDF: {e}'}), 500
 
-    # Count pages using the canonical PDF
+    # Count pages and write the manifest (one pass, once per distinct content)
     try:
-        with open(str(pdf_path), 'rb') as f:
-            page_count = len(PdfReader(f).pages)
+        page_count = _prepare_upload_manifest(content_id, dest_dir)
     except Exception as e:
+        DOCUMENT_CACHE.invalidate(_content_document_key(content_id))
         shutil.rmtree(dest_dir, ignore_errors=True)
         return jsonify({'error': f'Failed to read PDF pages: {e}'}), 500
 
+    UPLOAD_STORE.register(upload_id)
     return jsonify({
         'success': True,
         'filename': original_filename,
@@ -973,17 +993,51 @@ def upload_file():
 
 
 
+@app.route('/api/uploads/<file_id>/manifest', methods=['GET'])
+def upload_manifest(file_id):
+    """Page count, page sizes and per-page text/image stats for an upload."""
+    if file_id.startswith(('.', '_')):
+        return jsonify({"success": False, "error": "Invalid file_id"}), 400
+    try:
+        manifest = _manifest_for_file_id(file_id)
+    except FileNotFoundError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "file_id": file_id, **manifest}), 200
+
+
+
 
 # -----------------------------------------------------------------------------
 # /process (modified to just initialize job)
 # -----------------------------------------------------------------------------
-@app.route('/process', methods=['POST'])
-def process_document():
-    data = request.get_json()
-    print('*' * 80)
-    print('[/process] Received new processing request')
-    print(f'[/process] Data: {data}')
 
+# Server-side job execution: upper bound on pages in flight for one job
+DEFAULT_PAGE_CONCURRENCY = int(os.getenv("DEFAULT_PAGE_CONCURRENCY", "4"))
+MAX_PAGE_CONCURRENCY = int(os.getenv("MAX_PAGE_CONCURRENCY", "16"))
+
+
+def _processing_options_from_payload(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-job processing switches accepted by /process and /process_job."""
+    text_mode = str(data.get("text_mode") or "off").lower()
+    image_format = str(data.get("image_format") or "png").lower()
+    return {
+        "use_cache": bool(data.get("use_cache", True)),
+        # Blank and near-blank pages get BLANK_PAGE_RESPONSE without a GPT call
+        "skip_blank_pages": bool(data.get("skip_blank_pages", True)),
+        # "auto": send born-digital, text-heavy pages as text instead of an image
+        "text_mode": text_mode if text_mode in ("off", "auto") else "off",
+        # png (default) | jpeg | webp | auto (JPEG only where it is much smaller)
+        "image_format": image_format if image_format in IMAGE_FORMATS else "png",
+    }
+
+
+def _initialize_job(data: Dict[str, Any], processing_options: Dict[str, Any] = None):
+    """
+    Validate a /process style payload, create the job row and its results table.
+    Returns (payload, status_code) ready for jsonify.
+    """
     # Extract form data
     role = data.get('role', '')
     task = data.get('task', '')
@@ -1001,21 +1055,26 @@ def process_document():
 
     # Validate inputs
     if not file_id:
-        return jsonify({'success': False, 'error': 'file_id is required'}), 400
+        return {'success': False, 'error': 'file_id is required'}, 400
     if not isinstance(selected_pages, list) or not selected_pages:
-        return jsonify({
+        return {
             'success': False,
             'error': 'selected_pages must be a non-empty list'
-        }), 400
+        }, 400
+
+    try:
+        normalise_output_format((output_config or {}).get('outputFormat'))
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
 
     # Resolve canonical PDF up-front to fail fast if missing
     try:
         _ = _pdf_path_for_file_id(file_id)
     except Exception as e:
-        return jsonify({
+        return {
             'success': False,
             'error': f'Could not resolve PDF: {e}'
-        }), 400
+        }, 400
 
     # Prepare prompts
     system_prompt = 'you are a helpful assistant'
@@ -1036,26 +1095,18 @@ def process_document():
         output_config=output_config or {"outputType": "browser"},
         original_file_name=original_file_name,
         file_stem=file_stem,
+        processing_options=processing_options,
     )
 
     if not job_create.get("success"):
-        return jsonify({
+        return {
             "success": False,
             "error": job_create.get("error", "Failed to create job in DB")
-        }), 500
+        }, 500
 
-    # Create SQL table for page results
-    try:
-        create_page_results_table(job_id)
-        print(f'[/process] Created page results table for job {job_id}')
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Failed to create page results table: {e}'
-        }), 500
+    # Page results go to the shared page_results table keyed by job_id
 
-    # Return job info for frontend to start processing pages
-    return jsonify({
+    return {
         'success': True,
         'message': 'Job initialized, ready to process pages',
         'job_id': job_id,
@@ -1063,7 +1114,749 @@ def process_document():
         'pages_total': len(selected_pages),
         'selected_pages': sorted(selected_pages),
         'status': 'ready'
-    }), 200
+    }, 200
+
+
+@app.route('/process', methods=['POST'])
+def process_document():
+    data = request.get_json()
+    print('*' * 80)
+    print('[/process] Received new processing request')
+    print(f'[/process] Data: {data}')
+
+    # `run: true` hands the whole job to the server-side runner
+    if data.get('run'):
+        return _start_server_side_job(data)
+
+    payload, status = _initialize_job(data, processing_options=_processing_options_from_payload(data))
+
+    # Return job info for frontend to start processing pages
+    return jsonify(payload), status
+
+
+# -----------------------------------------------------------------------------
+#  Page pipeline (shared by /process_page and the server-side job runner)
+# -----------------------------------------------------------------------------
+# Resolution pages are rendered at for GPT (also part of the cache key)
+RENDER_DPI = 200
+
+
+# Text-layer fast path: a page qualifies when it has at least this much text
+# and images cover no more than this fraction of it (logos, stamps)
+TEXT_FAST_PATH_MIN_CHARS = 200
+TEXT_FAST_PATH_MAX_IMAGES = 2
+TEXT_FAST_PATH_MAX_IMAGE_COVERAGE = 0.10
+
+
+def _text_fast_path_possible(page_info: Dict[str, Any]) -> bool:
+    """Whether a page's manifest entry leaves the text fast path open (same limits as below)."""
+    return (page_info["text_chars"] >= TEXT_FAST_PATH_MIN_CHARS
+            and page_info["image_count"] <= TEXT_FAST_PATH_MAX_IMAGES
+            and page_info["image_coverage"] <= TEXT_FAST_PATH_MAX_IMAGE_COVERAGE)
+
+
+def _usable_page_text(pdf_path: Path, page_num: int, file_id: Optional[str] = None) -> Optional[str]:
+    """
+    Return the page's text layer if the page is born-digital and text-heavy
+    enough to send as text instead of an image; otherwise None.
+    """
+    try:
+        with DOCUMENT_CACHE.borrow(file_id or str(pdf_path), str(pdf_path)) as doc:
+            if not (1 <= page_num <= len(doc)):
+                return None
+            page = doc[page_num - 1]
+
+            text = page.get_text("text") or ""
+            if len("".join(text.split())) < TEXT_FAST_PATH_MIN_CHARS:
+                return None
+
+            image_infos = page.get_image_info()
+            if len(image_infos) > TEXT_FAST_PATH_MAX_IMAGES:
+                return None
+            page_area = abs(page.rect) or 1.0
+            image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in image_infos)
+            if image_area / page_area > TEXT_FAST_PATH_MAX_IMAGE_COVERAGE:
+                return None
+
+            return text
+    except Exception as e:
+        print(f'[/process_page] Page {page_num}: text layer check failed, rendering instead: {e}')
+        return None
+
+
+# Blank-page pre-filter (per-job option skip_blank_pages, on by default).
+# A page with only a "left blank" notice is blank. A page whose text layer is
+# empty or just a page number is rendered at BLANK_PAGE_CHECK_DPI; almost no
+# ink (light or dark) and a nearly flat render mean the page is stored as
+# BLANK_PAGE_RESPONSE without a GPT call. Any other text (even a lone
+# heading) sends the page to GPT.
+BLANK_PAGE_RESPONSE = "[Blank page]"
+BLANK_PAGE_MAX_TEXT_CHARS = 60
+BLANK_PAGE_CHECK_DPI = 36
+# A bare page number inks ~0.0001 of a letter page at 36 DPI, a 14pt heading ~0.0008
+BLANK_PAGE_MAX_INK_RATIO = float(os.getenv("BLANK_PAGE_MAX_INK_RATIO", "0.0003"))
+# ...and the render must also be nearly flat (scanner noise, not content)
+BLANK_PAGE_MAX_STDDEV = float(os.getenv("BLANK_PAGE_MAX_STDDEV", "12"))
+_BLANK_NOTICE_RE = re.compile(
+    r"^(this page (has been |is )?(intentionally |deliberately )?left blank"
+    r"|(page )?intentionally (left )?blank|blank page)$"
+)
+
+
+def _is_blank_notice(text: str) -> bool:
+    # Letters only, so page numbers and punctuation around the notice don't matter
+    return bool(_BLANK_NOTICE_RE.match(re.sub(r"[^a-z]+", " ", text.lower()).strip()))
+
+
+_PAGE_NUMBER_RE = re.compile(
+    r"^(page )?(\d+|(?=[ivxlcdm])m{0,4}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3}))( (of )?\d+)?$"
+)
+
+
+def _is_page_number_only(text: str) -> bool:
+    # "12", "- iv -", "Page 3 of 10"; empty text counts too
+    words = re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+    return not words or bool(_PAGE_NUMBER_RE.match(words))
+
+
+def _page_is_blank(pdf_path: Path, page_num: int, file_id: Optional[str] = None,
+                   page_info: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Whether a page is blank or near-blank: nothing drawn at all (from the
+    manifest), only a "left blank" notice in its text layer, or no text but
+    a page number and almost no ink in a low-DPI render (scanned separators
+    and versos).
+    """
+    if page_info is not None:
+        if page_info["blank"]:
+            return True
+        if page_info["text_chars"] > BLANK_PAGE_MAX_TEXT_CHARS:
+            return False
+    try:
+        with DOCUMENT_CACHE.borrow(file_id or str(pdf_path), str(pdf_path)) as doc:
+            if not (1 <= page_num <= len(doc)):
+                return False
+            text = doc[page_num - 1].get_text("text") or ""
+            if len("".join(text.split())) > BLANK_PAGE_MAX_TEXT_CHARS:
+                return False
+            if _is_blank_notice(text):
+                return True
+            if not _is_page_number_only(text):
+                return False
+            stats = page_ink_stats(doc, page_num, dpi=BLANK_PAGE_CHECK_DPI)
+    except Exception as e:
+        print(f'[/process_page] Page {page_num}: blank check failed, processing normally: {e}')
+        return False
+    return stats["ink_ratio"] <= BLANK_PAGE_MAX_INK_RATIO and stats["stddev"] <= BLANK_PAGE_MAX_STDDEV
+
+
+def _render_page_for_gpt(pdf_path: Path, page_num: int, text_mode: str = "off", image_format: str = "png",
+                         file_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Prepare one page for GPT. Returns {input_mode, data_url, page_text,
+    image_bytes, image_size_bytes}. With text_mode "auto", text-heavy pages
+    come back as input_mode "text" without being rasterized; data_url is None
+    (and page_text empty) when the page could not be rendered.
+    """
+    if text_mode == "auto":
+        page_text = _usable_page_text(Path(pdf_path), page_num, file_id)
+        if page_text is not None:
+            print(f'[/process_page] Page {page_num}: Using text layer ({len(page_text):,} chars)')
+            return {
+                'input_mode': 'text',
+                'data_url': None,
+                'page_text': page_text,
+                'image_bytes': b'',
+                'image_size_bytes': 0,
+            }
+
+    # Rasterize exactly one page in memory, on the render process pool
+    try:
+        image_bytes, mime_type = RENDER_SERVICE.render(
+            str(pdf_path), page_num, dpi=RENDER_DPI, image_format=image_format, file_id=file_id
+        ) or (b'', None)
+    except RenderTimeout as e:
+        # Fail just this page; the rest of the job goes on
+        print(f'[/process_page] Page {page_num}: {e}')
+        return {'input_mode': 'image', 'data_url': None, 'page_text': '', 'image_bytes': b'',
+                'image_size_bytes': 0, 'render_error': str(e)}
+
+    if not image_bytes:
+        print(f'[/process_page] Page {page_num}: No image available')
+        return {'input_mode': 'image', 'data_url': None, 'page_text': '', 'image_bytes': b'', 'image_size_bytes': 0}
+
+    image_size_bytes = len(image_bytes)
+    print(f'[/process_page] Page {page_num}: {mime_type} size = {image_size_bytes:,} bytes')
+    return {
+        'input_mode': 'image',
+        'data_url': image_bytes_to_data_url(image_bytes, mime_type),
+        'page_text': '',
+        'image_bytes': image_bytes,
+        'image_size_bytes': image_size_bytes,
+    }
+
+
+def _page_is_renderable(rendered: Dict[str, Any]) -> bool:
+    return rendered['input_mode'] == 'text' or rendered['data_url'] is not None
+
+
+def _unrenderable_page_response(rendered: Dict[str, Any]) -> str:
+    """Stored response for a page that is not sent to GPT."""
+    if rendered['input_mode'] == 'blank':
+        return BLANK_PAGE_RESPONSE
+    if rendered.get('render_error'):
+        return f"Unable to process this page: {rendered['render_error']}"
+    return 'Page image not available'
+
+
+def _user_prompt_with_page_text(user_prompt: str, page_text: str) -> str:
+    return (f"{user_prompt or ''}\n"
+            f"# Page Content\n"
+            f"The page is supplied as its extracted text layer rather than as an image.\n\n"
+            f"{page_text}\n")
+
+
+def _page_cache_key(job: Dict[str, Any], image_bytes: bytes, dpi) -> str:
+    """
+    sha256 over (model, system_prompt, user_prompt, rendered image bytes, dpi).
+    Text-layer pages pass their text as image_bytes and "text" as dpi.
+    """
+    h = hashlib.sha256()
+    for part in (job.get("model"), job.get("system_prompt"), job.get("user_prompt")):
+        encoded = (part or "").encode("utf-8")
+        # Length-prefix every field so adjacent fields cannot run into each other
+        h.update(len(encoded).to_bytes(8, "big"))
+        h.update(encoded)
+    h.update(len(image_bytes).to_bytes(8, "big"))
+    h.update(image_bytes)
+    h.update(str(dpi).encode("ascii"))
+    return h.hexdigest()
+
+
+def _markdown_from_raw_response(raw_response: str, page_num: int) -> str:
+    print(f'[/process_page] Page {page_num}: GPT API call successful, parsing response')
+
+    try:
+        parsed = json.loads(raw_response)
+        gpt_response = parsed.get('markdown_response', raw_response)
+    except json.JSONDecodeError:
+        print(f'[/process_page] Page {page_num}: Failed to parse JSON, using raw response')
+        gpt_response = raw_response
+
+    print(f'[/process_page] Page {page_num}: Response extracted successfully')
+    return gpt_response
+
+
+def _gpt_error_placeholder(e: Exception, page_num: int) -> str:
+    if isinstance(e, BadRequestError):
+        print(f'[/process_page] Page {page_num}: GPT refused to process')
+        return 'GPT refused to process this page'
+    if 'timeout' in str(e).lower() or 'timed out' in str(e).lower():
+        print(f'[/process_page] Page {page_num}: GPT API timeout')
+        return 'Timed out contacting GPT for this page'
+    print(f'[/process_page] Page {page_num}: GPT API error: {e}')
+    return f'Unable to get a response from GPT for this page: {e}'
+
+
+def _call_gpt_for_page(rendered: Dict[str, Any], page_num: int, system_prompt: str, user_prompt: str, model: str) -> Tuple[str, bool]:
+    """
+    Send one prepared page (image or text layer) to GPT. Returns
+    (markdown response, True), or (human-readable placeholder, False) if the
+    call failed.
+    """
+    # Call GPT API
+    if os.getenv('OPENAI_API_KEY') is None:
+        print(f'[/process_page] Page {page_num}: No API key found')
+        return 'No API key found', False
+
+    try:
+        print(f'[/process_page] Page {page_num}: Calling GPT API with function calling')
+
+        if rendered['input_mode'] == 'text':
+            raw_response = get_response_from_chatgpt_with_functions(
+                user_prompt=_user_prompt_with_page_text(user_prompt, rendered['page_text']),
+                system_prompt=system_prompt,
+                model=model,
+                temperature=0,
+                function_name='provide_markdown_response',
+                functions=get_markdown_schema()
+            )
+        else:
+            raw_response = get_response_from_chatgpt_multiple_image_and_functions(
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                image_paths=[],
+                model=model,
+                functions=get_markdown_schema(),
+                function_name='provide_markdown_response',
+                pre_compiled_images=[rendered['data_url']]
+            )
+        return _markdown_from_raw_response(raw_response, page_num), True
+    except Exception as e:
+        return _gpt_error_placeholder(e, page_num), False
+
+
+async def _acall_gpt_for_page(rendered: Dict[str, Any], page_num: int, system_prompt: str, user_prompt: str, model: str) -> Tuple[str, bool]:
+    """Async twin of _call_gpt_for_page (AsyncOpenAI on the shared GPT loop)."""
+    if os.getenv('OPENAI_API_KEY') is None:
+        print(f'[/process_job] Page {page_num}: No API key found')
+        return 'No API key found', False
+
+    try:
+        print(f'[/process_job] Page {page_num}: Calling GPT API with function calling')
+
+        if rendered['input_mode'] == 'text':
+            raw_response = await aget_response_from_chatgpt_with_functions(
+                user_prompt=_user_prompt_with_page_text(user_prompt, rendered['page_text']),
+                system_prompt=system_prompt,
+                model=model,
+                temperature=0,
+                function_name='provide_markdown_response',
+                functions=get_markdown_schema()
+            )
+        else:
+            raw_response = await aget_response_from_chatgpt_multiple_image_and_functions(
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                image_paths=[],
+                model=model,
+                functions=get_markdown_schema(),
+                function_name='provide_markdown_response',
+                pre_compiled_images=[rendered['data_url']]
+            )
+        return _markdown_from_raw_response(raw_response, page_num), True
+    except Exception as e:
+        return _gpt_error_placeholder(e, page_num), False
+
+
+def _lookup_page_cache(job: Dict[str, Any], rendered: Dict[str, Any], page_num: int) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns (cache_key, cached_response). cache_key is None when the job opted
+    out of caching; cached_response is None on a miss.
+    """
+    if not (job.get("processing_options") or {}).get("use_cache", True):
+        return None, None
+    if rendered['input_mode'] == 'text':
+        cache_key = _page_cache_key(job, rendered['page_text'].encode("utf-8"), "text")
+    else:
+        cache_key = _page_cache_key(job, rendered['image_bytes'], RENDER_DPI)
+    cached = get_cached_gpt_response(cache_key)
+    if cached is not None:
+        print(f'[/process_page] Page {page_num}: GPT cache hit')
+    return cache_key, cached
+
+
+def _render_job_page(job: Dict[str, Any], page_num: int) -> Dict[str, Any]:
+    """Render one page of a job with the job's processing options."""
+    pdf_path = _pdf_path_for_file_id(job.get("file_id"))
+    doc_key = _document_key(job.get("file_id"))
+    options = job.get("processing_options") or {}
+    page_info = _manifest_page(job.get("file_id"), page_num)
+
+    if options.get("skip_blank_pages", True) and _page_is_blank(Path(pdf_path), page_num, doc_key, page_info):
+        print(f'[/process_page] Page {page_num}: Blank, skipping GPT')
+        return {'input_mode': 'blank', 'data_url': None, 'page_text': '', 'image_bytes': b'', 'image_size_bytes': 0}
+
+    text_mode = options.get("text_mode", "off")
+    if text_mode == "auto":
+        # Scans and image-heavy pages are known from the manifest; skip extracting their text
+        if page_info is not None and not _text_fast_path_possible(page_info):
+            text_mode = "off"
+    return _render_page_for_gpt(
+        Path(pdf_path), page_num, text_mode, options.get("image_format", "png"), doc_key
+    )
+
+
+# Rendering and DB writes for server-side jobs run here so the GPT loop never blocks
+PAGE_WORK_EXECUTOR = ThreadPoolExecutor(max_workers=max(4, os.cpu_count() or 1), thread_name_prefix="page-work")
+
+# Browser-driven jobs: while page N is with GPT, page N+1 renders here.
+# Keyed by (job_id, page_number) -> (future, submitted_at); bounded per job and
+# overall, and a job's entries are dropped when it finishes, fails or is cleaned up.
+_PAGE_PREFETCH: "OrderedDict[Tuple[str, int], Tuple[Any, float]]" = OrderedDict()
+_PAGE_PREFETCH_LOCK = threading.Lock()
+PAGE_PREFETCH_MAX_ENTRIES = 32
+PAGE_PREFETCH_MAX_PER_JOB = 2
+# A prefetched page nobody asked for within this long belongs to an abandoned job
+PAGE_PREFETCH_TTL_SECONDS = 600
+
+
+def _prefetch_job_page(job_id: str, job: Dict[str, Any], page_num: int) -> None:
+    key = (job_id, int(page_num))
+    with _PAGE_PREFETCH_LOCK:
+        if key in _PAGE_PREFETCH:
+            return
+        job_keys = [k for k in _PAGE_PREFETCH if k[0] == job_id]
+        for stale_key in job_keys[:max(0, len(job_keys) - PAGE_PREFETCH_MAX_PER_JOB + 1)]:
+            _PAGE_PREFETCH.pop(stale_key)[0].cancel()
+        _PAGE_PREFETCH[key] = (PAGE_WORK_EXECUTOR.submit(_render_job_page, job, int(page_num)), time.monotonic())
+        while len(_PAGE_PREFETCH) > PAGE_PREFETCH_MAX_ENTRIES:
+            _, (stale, _) = _PAGE_PREFETCH.popitem(last=False)
+            stale.cancel()
+
+
+def _drop_prefetched_pages(job_id: str) -> int:
+    """Forget (and cancel, if not started) every prefetched render for *job_id*."""
+    with _PAGE_PREFETCH_LOCK:
+        keys = [k for k in _PAGE_PREFETCH if k[0] == job_id]
+        for key in keys:
+            _PAGE_PREFETCH.pop(key)[0].cancel()
+    return len(keys)
+
+
+def _expire_page_prefetch() -> int:
+    """Drop prefetched renders of jobs that are gone from the DB or were never collected."""
+    with _PAGE_PREFETCH_LOCK:
+        if not _PAGE_PREFETCH:
+            return 0
+    live_jobs = list_job_ids()
+    cutoff = time.monotonic() - PAGE_PREFETCH_TTL_SECONDS
+    with _PAGE_PREFETCH_LOCK:
+        stale = [k for k, (_, submitted_at) in _PAGE_PREFETCH.items()
+                 if k[0] not in live_jobs or submitted_at < cutoff]
+        for key in stale:
+            _PAGE_PREFETCH.pop(key)[0].cancel()
+    return len(stale)
+
+
+def _take_prefetched_render(job_id: str, page_num: int) -> Optional[Dict[str, Any]]:
+    with _PAGE_PREFETCH_LOCK:
+        entry = _PAGE_PREFETCH.pop((job_id, int(page_num)), None)
+    if entry is None:
+        return None
+    future, _ = entry
+    try:
+        rendered = future.result()
+        print(f'[/process_page] Page {page_num}: Using prefetched render')
+        return rendered
+    except Exception as e:
+        # Render again in the request; it will surface the error if it persists
+        print(f'[/process_page] Page {page_num}: Prefetched render failed: {e}')
+        return None
+
+
+def _job_file_names(job: Dict[str, Any], fallback_id: str) -> Tuple[str, str]:
+    """(file_stem, original_file_name) used in the output sheet for a job."""
+    file_stem = job.get("file_stem") or Path(job.get("original_file_name") or "").stem or fallback_id[:8]
+    original_file_name = job.get("original_file_name") or file_stem
+    return file_stem, original_file_name
+
+
+# Export state built as pages finish, so writing the output is only a copy.
+# Lost on restart; the output is then streamed from the DB instead.
+_EXPORT_SPOOLS: Dict[str, JobExportSpool] = {}
+_EXPORT_SPOOLS_LOCK = threading.Lock()
+
+
+def _export_spool_for_job(job_id: str, job: Dict[str, Any]) -> Optional[JobExportSpool]:
+    with _EXPORT_SPOOLS_LOCK:
+        spool = _EXPORT_SPOOLS.get(job_id)
+        if spool is None:
+            file_id = job.get("file_id")
+            pages = job.get("selected_pages") or []
+            if not file_id or not pages:
+                return None
+            file_stem, original_file_name = _job_file_names(job, file_id)
+            spool = JobExportSpool(
+                UPLOAD_ROOT / file_id / f".export_{job_id}.jsonl", pages, file_stem, original_file_name
+            )
+            _EXPORT_SPOOLS[job_id] = spool
+        return spool
+
+
+def _take_export_spool(job_id: str) -> Optional[JobExportSpool]:
+    with _EXPORT_SPOOLS_LOCK:
+        return _EXPORT_SPOOLS.pop(job_id, None)
+
+
+def _drop_export_spools_for_file(file_id: str):
+    with _EXPORT_SPOOLS_LOCK:
+        stale = [jid for jid, spool in _EXPORT_SPOOLS.items() if spool.spool_path.parent.name == file_id]
+        for jid in stale:
+            _EXPORT_SPOOLS.pop(jid).discard()
+
+
+def _store_page_result(job_id: str, job: Dict[str, Any], page_num: int,
+                       gpt_response: str, image_size_bytes: int):
+    """Store a page result in the DB and add it to the job's export spool."""
+    append_page_result(job_id, int(page_num), gpt_response, image_size_bytes)
+    try:
+        spool = _export_spool_for_job(job_id, job)
+        if spool is not None:
+            spool.add(page_num, gpt_response)
+    except Exception as e:
+        # The DB copy is authoritative; the output falls back to it
+        print(f'[export] Job {job_id} page {page_num}: spool update failed: {e}')
+        spool = _take_export_spool(job_id)
+        if spool is not None:
+            spool.discard()
+
+
+def _process_page_for_job(job_id: str, job: Dict[str, Any], page_num: int,
+                          next_page: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Render one page, ask GPT about it (or reuse a cached answer) and store the
+    result for the job. Returns {gpt_response, image_size_bytes, cache_hit, ok};
+    ok is False when the stored response is a placeholder for a failed page.
+    With *next_page*, that page is rendered in the background meanwhile.
+    """
+    rendered = _take_prefetched_render(job_id, page_num) or _render_job_page(job, page_num)
+    if next_page is not None:
+        _prefetch_job_page(job_id, job, next_page)
+
+    cache_key, cache_hit = None, False
+    ok = not rendered.get('render_error')
+    if not _page_is_renderable(rendered):
+        gpt_response = _unrenderable_page_response(rendered)
+    else:
+        cache_key, gpt_response = _lookup_page_cache(job, rendered, page_num)
+        cache_hit = gpt_response is not None
+        if not cache_hit:
+            gpt_response, ok = _call_gpt_for_page(
+                rendered,
+                page_num,
+                system_prompt=job.get("system_prompt"),
+                user_prompt=job.get("user_prompt"),
+                model=job.get("model"),
+            )
+            if ok and cache_key:
+                put_cached_gpt_response(cache_key, job.get("model"), gpt_response)
+
+    # Store result in SQL database
+    _store_page_result(job_id, job, int(page_num), gpt_response, rendered['image_size_bytes'])
+    print(f'[/process_page] Page {page_num}: Result stored in database')
+
+    # cache_hit is None when no cache lookup happened
+    outcome = {
+        'gpt_response': gpt_response,
+        'image_size_bytes': rendered['image_size_bytes'],
+        'input_mode': rendered['input_mode'],
+        'cache_hit': cache_hit if cache_key else None,
+        'ok': ok,
+    }
+    if cache_key:
+        counts = record_job_cache_lookup(job_id, cache_hit)
+        if counts.get("success"):
+            outcome['cache_hits'] = counts['cache_hits']
+            outcome['cache_misses'] = counts['cache_misses']
+    return outcome
+
+
+async def _aprepare_page_for_job(job: Dict[str, Any], page_num: int) -> Dict[str, Any]:
+    """
+    CPU/disk half of a page: render it and look it up in the GPT cache.
+    Returns {rendered, cache_key, cached_response}.
+    """
+    loop = asyncio.get_running_loop()
+    rendered = await loop.run_in_executor(PAGE_WORK_EXECUTOR, _render_job_page, job, page_num)
+
+    cache_key, cached = None, None
+    if _page_is_renderable(rendered):
+        cache_key, cached = await loop.run_in_executor(
+            PAGE_WORK_EXECUTOR, _lookup_page_cache, job, rendered, page_num
+        )
+    return {'rendered': rendered, 'cache_key': cache_key, 'cached_response': cached}
+
+
+async def _afinish_page_for_job(job_id: str, job: Dict[str, Any], page_num: int,
+                                prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """Network half of a page: call GPT unless cached, then store the result."""
+    loop = asyncio.get_running_loop()
+    rendered, cache_key = prepared['rendered'], prepared['cache_key']
+
+    cache_hit = False
+    ok = not rendered.get('render_error')
+    if not _page_is_renderable(rendered):
+        gpt_response = _unrenderable_page_response(rendered)
+    else:
+        gpt_response = prepared['cached_response']
+        cache_hit = gpt_response is not None
+        if not cache_hit:
+            gpt_response, ok = await _acall_gpt_for_page(
+                rendered,
+                page_num,
+                system_prompt=job.get("system_prompt"),
+                user_prompt=job.get("user_prompt"),
+                model=job.get("model"),
+            )
+            if ok and cache_key:
+                await loop.run_in_executor(
+                    PAGE_WORK_EXECUTOR, put_cached_gpt_response, cache_key, job.get("model"), gpt_response
+                )
+
+    await loop.run_in_executor(
+        PAGE_WORK_EXECUTOR, _store_page_result, job_id, job, int(page_num), gpt_response, rendered['image_size_bytes']
+    )
+    print(f'[/process_job] Page {page_num}: Result stored in database')
+
+    # cache_hit is None when no cache lookup happened
+    return {
+        'gpt_response': gpt_response,
+        'image_size_bytes': rendered['image_size_bytes'],
+        'input_mode': rendered['input_mode'],
+        'cache_hit': cache_hit if cache_key else None,
+        'ok': ok,
+    }
+
+
+async def _aprocess_page_for_job(job_id: str, job: Dict[str, Any], page_num: int) -> Dict[str, Any]:
+    """Async twin of _process_page_for_job: blocking steps go to PAGE_WORK_EXECUTOR."""
+    prepared = await _aprepare_page_for_job(job, page_num)
+    return await _afinish_page_for_job(job_id, job, page_num, prepared)
+
+
+def _write_job_output(job_id: str, job: Dict[str, Any], processing_ts: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the output file (XLSX unless output_config.outputFormat says
+    otherwise) for a finished (non-batch) job, deliver it according to the
+    job's output_config and clean up the job's DB rows.
+
+    Mutates and returns *result*; raises if no page results are stored.
+    """
+    file_id = job.get("file_id")
+    output_config = job.get("output_config") or {"outputType": "browser"}
+    output_format = normalise_output_format(output_config.get("outputFormat"))
+    ext = output_extension(output_format)
+
+    # The local file doubles as the browser download and the source for SharePoint uploads
+    upload_dir = UPLOAD_ROOT / file_id
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
+    local_output_name = secure_filename(f"gpt_responses_{timestamp}{ext}")
+    output_path = upload_dir / local_output_name
+
+    # A page result that could not be saved must fail the job, even when the
+    # spool alone could still produce the file
+    require_page_results_saved([job_id])
+
+    # Rows were cleaned and chunked as pages finished; if the spool is
+    # incomplete (restart, re-processed page) stream them from the DB instead
+    spool = _take_export_spool(job_id)
+    try:
+        if spool is not None and spool.complete:
+            n_rows = write_rows(iter_spooled_rows([spool], processing_ts), output_path, output_format)
+        else:
+            file_stem, original_file_name = _job_file_names(job, file_id)
+            # closing(): release the DB cursor even if writing fails part-way
+            with closing(iter_page_results(job_id)) as pages:
+                n_rows = write_rows(
+                    iter_export_rows([(file_stem, original_file_name, pages)], processing_ts),
+                    output_path,
+                    output_format,
+                )
+    finally:
+        if spool is not None:
+            spool.discard()
+    if not n_rows:
+        output_path.unlink(missing_ok=True)
+        raise ValueError('No results found in database')
+    UPLOAD_STORE.register(file_id)
+
+    # Handle output based on output_config
+    out_type = (output_config or {}).get("outputType", "browser")
+    fallback = False
+
+    if out_type == "init_from_sharepoint":
+        print(f'[/process_page] init_from_sharepoint: Saving {output_format.upper()} to SharePoint pdf_output subfolder')
+
+        # Required meta (frontend must send these when initialized from URL)
+        folder_name   = output_config.get("sharepointFolder")        # e.g. "/sites/.../Shared Documents/some/folder"
+        xlsx_filename = output_config.get("filename")      # e.g. "input.xlsx"
+        row_id        = output_config.get("row_id")            # required for naming
+        site_name     = output_config.get("siteName")
+        tenant        = "tris42.onmicrosoft.com"
+        client_id     = "d44a05d5-c6a5-4bbb-82d2-443123722380"
+
+        if not (folder_name and xlsx_filename and row_id):
+            # Fallback to browser if meta missing
+            print('[/process_page] init_from_sharepoint missing folderName/xlsxFilename/row_id; falling back to browser download')
+            out_type = "browser"
+            fallback = True
+        else:
+            # Build output folder + filename
+            xlsx_stem = Path(xlsx_filename).stem
+            sp_out_folder = f"{folder_name.rstrip('/')}/pdf_output".replace("//", "/")
+            sp_out_name = f"{xlsx_stem}_pdf_{row_id}{ext}"
+
+            # Create SharePoint context (same style as init_from_sharepoint route)
+            sp_site_url = f"https://tris42.sharepoint.com/sites/{site_name}/"
+            ctx = sharepoint_create_context(sp_site_url, tenant, client_id)
+
+            # Ensure subfolder exists
+            sharepoint_create_folder(ctx, sp_out_folder)
+
+            # Upload the exported file (overwrite)
+            output_io = BytesIO(output_path.read_bytes())
+            ok = _sharepoint_upload_bytes_overwrite(ctx, sp_out_folder, sp_out_name, output_io)
+
+            if ok:
+                output_path.unlink(missing_ok=True)
+                result["xlsx_filename"] = sp_out_name
+                result["xlsx_download_url"] = None
+                result["note"] = f"Uploaded to SharePoint: {sp_out_folder}/{sp_out_name}"
+            else:
+                print('[/process_page] init_from_sharepoint upload failed; falling back to browser download')
+                out_type = "browser"
+
+
+    if out_type == "sharepoint":
+        print(f'[/process_page] Saving {output_format.upper()} to SharePoint (explicit sharepoint mode)')
+        context_id = output_config.get('contextId')
+        sharepoint_folder = output_config.get('sharepointFolder')
+        filename = output_config.get('filename', f'output{ext}')
+
+        if not filename.lower().endswith(ext):
+            filename = f"{Path(filename).stem}{ext}"
+
+        if not (context_id and sharepoint_folder):
+            print('[/process_page] Missing SharePoint context or folder, falling back to browser output')
+            out_type = "browser"
+        else:
+            def _upload_to_sharepoint():
+                ctx = _new_ctx(context_id)
+                sharepoint_create_folder(ctx, sharepoint_folder)  # safe if exists
+                output_io = BytesIO(output_path.read_bytes())
+                return _sharepoint_upload_bytes_overwrite(ctx, sharepoint_folder, filename, output_io)
+
+            try:
+                future = EXECUTOR.submit(_upload_to_sharepoint)
+                success = future.result(timeout=60)
+
+                if success:
+                    output_path.unlink(missing_ok=True)
+                    result['xlsx_filename'] = filename
+                    result['xlsx_download_url'] = None
+                    result['note'] = f"Uploaded {output_format.upper()} to SharePoint"
+                else:
+                    raise Exception("SharePoint upload returned False")
+            except Exception as sp_error:
+                print(f"SharePoint upload failed: {sp_error}, falling back to browser output")
+                out_type = "browser"
+
+
+    if out_type == "browser":
+        # Already on the local filesystem for browser download
+        print(f'[/process_page] {output_format.upper()} saved to {output_path}')
+        result['xlsx_filename'] = local_output_name
+        result['xlsx_download_url'] = f"/download/{file_id}/{local_output_name}"
+        result['fallback'] = fallback
+
+    # xlsx_* keys are kept for existing clients whatever the format
+    result['output_format'] = output_format
+
+    # Perform cleanup after result is prepared but before returning
+    try:
+        print(f'[/process_page] Starting cleanup for job {job_id}')
+        _drop_prefetched_pages(job_id)
+        delete_page_results(job_id)
+        delete_job(job_id)
+        print(f'[/process_page] Deleted page results and job row for job {job_id}')
+    except Exception as cleanup_error:
+        # Log but don't raise - cleanup failures shouldn't block CSV delivery
+        print(f'[/process_page] Warning: Cleanup failed for job {job_id}: {cleanup_error}')
+        traceback.print_exc()
+
+    return result
 
 
 # -----------------------------------------------------------------------------
@@ -1073,14 +1866,13 @@ def process_document():
 def process_page():
     data = request.get_json()
     job_id = data.get('job_id')
-    original_file_name = data.get('original_file_name')
     page_number = data.get('page_number')
-    
+
     if not job_id or page_number is None:
         return jsonify({'success': False, 'error': 'job_id and page_number are required'}), 400
-    
+
     print(f'[/process_page] Processing page {page_number} for job {job_id}')
-    
+
     # Load job from DB
     job_resp = get_job(job_id)
     if not job_resp.get("success"):
@@ -1088,103 +1880,50 @@ def process_page():
 
     job = job_resp["job"]
 
-    file_id = job.get("file_id")
     selected_pages = job.get("selected_pages", []) or []
-    system_prompt = job.get("system_prompt")
-    user_prompt = job.get("user_prompt")
-    model = job.get("model")
     output_config = job.get("output_config") or {"outputType": "browser"}
-    # keep original_file_name local too (used later)
-    original_file_name = job.get("original_file_name")
 
     # Ensure processing_started_at is set in DB once
     ts_resp = touch_job_processing_started_at(job_id)
     processing_ts = ts_resp.get("processing_started_at") if ts_resp.get("success") else datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
     try:
-        # Resolve PDF path
-        pdf_path = _pdf_path_for_file_id(file_id)
-        
-        page_num = int(page_number)
-
-        # Rasterize exactly one page, and guarantee temp cleanup
-        with rasterize_pdf_pages_to_temp_pngs(Path(pdf_path), [page_num], dpi=200) as img_paths:
-            png_path = img_paths.get(page_num)
-
-            if png_path is None or not png_path.exists():
-                print(f'[/process_page] Page {page_num}: No image available')
-                gpt_response = 'Page image not available'
-                image_size_bytes = 0
-            else:
-                image_size_bytes = png_path.stat().st_size
-                print(f'[/process_page] Page {page_num}: PNG size = {image_size_bytes:,} bytes')
-
-                # Call GPT API
-                if os.getenv('OPENAI_API_KEY') is None:
-                    print(f'[/process_page] Page {page_num}: No API key found')
-                    gpt_response = 'No API key found'
-                else:
-                    try:
-                        import json
-                        print(f'[/process_page] Page {page_num}: Calling GPT API with function calling')
-
-                        raw_response = get_response_from_chatgpt_multiple_image_and_functions(
-                            system_prompt=system_prompt,
-                            user_prompt=user_prompt,
-                            image_paths=[str(png_path)], 
-                            model=model,
-                            functions=get_markdown_schema(),
-                            function_name='provide_markdown_response',
-                            pre_compiled_images=None
-                        )
-
-                        print(f'[/process_page] Page {page_num}: GPT API call successful, parsing response')
-
-                        try:
-                            parsed = json.loads(raw_response)
-                            gpt_response = parsed.get('markdown_response', raw_response)
-                        except json.JSONDecodeError:
-                            print(f'[/process_page] Page {page_num}: Failed to parse JSON, using raw response')
-                            gpt_response = raw_response
-
-                        print(f'[/process_page] Page {page_num}: Response extracted successfully')
-
-                    except BadRequestError:
-                        print(f'[/process_page] Page {page_num}: GPT refused to process')
-                        gpt_response = 'GPT refused to process this page'
-                    except Exception as e:
-                        if 'timeout' in str(e).lower() or 'timed out' in str(e).lower():
-                            print(f'[/process_page] Page {page_num}: GPT API timeout')
-                            gpt_response = 'Timed out contacting GPT for this page'
-                        else:
-                            print(f'[/process_page] Page {page_num}: GPT API error: {e}')
-                            gpt_response = f'Unable to get a response from GPT for this page: {e}'
-
-        
-        # Store result in SQL database
-        append_page_result(job_id, int(page_number), gpt_response, image_size_bytes)
-        print(f'[/process_page] Page {page_number}: Result stored in database')
-        
         # Check if this is the last page (be robust to type mismatches / empty list)
         try:
             is_last_page = bool(selected_pages) and (int(page_number) == int(selected_pages[-1]))
         except Exception:
             is_last_page = False
-        
+
+        # The browser sends pages in selection order: render the next one while GPT works
+        next_page = None
+        try:
+            idx = [int(p) for p in selected_pages].index(int(page_number))
+            if idx + 1 < len(selected_pages):
+                next_page = int(selected_pages[idx + 1])
+        except (TypeError, ValueError):
+            next_page = None
+
+        page_outcome = _process_page_for_job(job_id, job, int(page_number), next_page=next_page)
+
         result = {
             'success': True,
             'job_id': job_id,
             'page': page_number,
-            'gpt_response': gpt_response,
-            'image_size_bytes': image_size_bytes,
-            'is_last_page': is_last_page
+            'gpt_response': page_outcome['gpt_response'],
+            'image_size_bytes': page_outcome['image_size_bytes'],
+            'is_last_page': is_last_page,
+            'input_mode': page_outcome['input_mode'],
+            'cache_hit': page_outcome['cache_hit'],
         }
-        
-        # If last page, write CSV and delete table
+        for key in ('cache_hits', 'cache_misses'):
+            if key in page_outcome:
+                result[key] = page_outcome[key]
+
         # If last page, either:
         #  - batch_mode: do NOT write XLSX yet (we'll finalize once all files finish)
         #  - normal: write XLSX now
         if is_last_page:
+            _drop_prefetched_pages(job_id)
             batch_mode = bool((output_config or {}).get("batch_mode"))
             if batch_mode:
                 result["note"] = "File completed (batch mode). Waiting for finalization."
@@ -1192,415 +1931,567 @@ def process_page():
                 return jsonify(result), 200
             print(f'[/process_page] Last page reached, writing CSV file')
             try:
-                # Get all results from database
-                all_results = get_all_page_results(job_id)
-                
-                if not all_results:
-                    return jsonify({
-                        'success': False,
-                        'error': 'No results found in database'
-                    }), 500
-                
-                # Create DataFrame
-                df_raw = pd.DataFrame(all_results, columns=["page", "gpt_response"])
-
-                TARGET_CHARS_PER_CHUNK = 26140
-
-                def _safe_len(x) -> int:
-                    try:
-                        return len(x) if isinstance(x, str) else len(str(x))
-                    except Exception:
-                        return 0
-
-                df_clean_list = []
-                chunk_id = 1
-                chunk_sum = 0
-                prev_file_stem = None 
-
-                file_stem = job.get("file_stem") or Path(job.get("original_file_name") or "").stem or file_id[:8]
-                original_file_name = job.get("original_file_name") or file_stem
-
-                df_raw = pd.DataFrame(all_results)
-
-                # Deterministic order by page
-                if "page" in df_raw.columns:
-                    df_raw["page"] = df_raw["page"].apply(lambda x: int(x) if str(x).strip() else 0)
-                    df_raw = df_raw.sort_values("page")
-
-                flat_rows = [
-                    (file_stem, original_file_name, int(r["page"]), r.get("gpt_response", ""))
-                    for _, r in df_raw.iterrows()
-                ]
-                
-                for (file_stem, original_file_name, page, text) in flat_rows:
-                    # --- force chunk break on new file ---
-                    if prev_file_stem is not None and file_stem != prev_file_stem:
-                        chunk_id += 1
-                        chunk_sum = 0
-                    prev_file_stem = file_stem
-                    # -----------------------------------------
-
-                    text_len = _safe_len(text)
-
-                    # existing size-based break (still applies within a file)
-                    if chunk_sum > 0 and (chunk_sum + text_len) > TARGET_CHARS_PER_CHUNK:
-                        dist_if_break = TARGET_CHARS_PER_CHUNK - chunk_sum
-                        dist_if_keep  = (chunk_sum + text_len) - TARGET_CHARS_PER_CHUNK
-                        if dist_if_break <= dist_if_keep:
-                            chunk_id += 1
-                            chunk_sum = 0
-
-                    chunk_sum += text_len
-
-                    df_clean_list.append({
-                        "timestamp": processing_ts,
-                        "chunk": chunk_id,
-                        "Filename stem": file_stem,
-                        "Data reference": f"p_{original_file_name}",
-                        "Brief description (optional)": f"Page {page}",
-                        "Source (optional)": original_file_name,
-                        "Data": text
-                    })
-
-                df = pd.DataFrame(df_clean_list)
-
-                # ---- Hardening: clean text to avoid control chars / normalization issues ----
-                _CTRL_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")  # keep \t \n \r
-
-                def _clean_cell(x):
-                    if isinstance(x, (bytes, bytearray)):
-                        try:
-                            x = x.decode('utf-8')
-                        except Exception:
-                            x = x.decode('utf-8', 'replace')
-                    if isinstance(x, str):
-                        x = unicodedata.normalize('NFC', x)
-                        x = _CTRL_RE.sub('', x)
-                    return x
-
-                df = df.map(_clean_cell)
-                # ---------------------------------------------------------------------------
-
-
-                # Handle output based on output_config
-                out_type = (output_config or {}).get("outputType", "browser")
-                fallback = False
-
-                if out_type == "init_from_sharepoint":
-                    print('[/process_page] init_from_sharepoint: Saving XLSX to SharePoint pdf_output subfolder')
-
-                    # Required meta (frontend must send these when initialized from URL)
-                    folder_name   = output_config.get("sharepointFolder")        # e.g. "/sites/.../Shared Documents/some/folder"
-                    xlsx_filename = output_config.get("filename")      # e.g. "input.xlsx"
-                    row_id        = output_config.get("row_id")            # required for naming
-                    site_name     = output_config.get("siteName")
-                    tenant        = "tris42.onmicrosoft.com"
-                    client_id     = "d44a05d5-c6a5-4bbb-82d2-443123722380"
-
-                    if not (folder_name and xlsx_filename and row_id):
-                        # Fallback to browser if meta missing
-                        print('[/process_page] init_from_sharepoint missing folderName/xlsxFilename/row_id; falling back to browser download')
-                        out_type = "browser"
-                        fallback = True
-                    else:
-                        # Build output folder + filename
-                        xlsx_stem = Path(xlsx_filename).stem
-                        sp_out_folder = f"{folder_name.rstrip('/')}/pdf_output".replace("//", "/")
-                        sp_out_name = f"{xlsx_stem}_pdf_{row_id}.xlsx"
-
-                        # Create SharePoint context (same style as init_from_sharepoint route)
-                        sp_site_url = f"https://tris42.sharepoint.com/sites/{site_name}/"
-                        ctx = sharepoint_create_context(sp_site_url, tenant, client_id)
-
-                        # Ensure subfolder exists
-                        sharepoint_create_folder(ctx, sp_out_folder)
-
-                        # Convert df -> xlsx bytes and upload (overwrite)
-                        xlsx_io = _df_to_xlsx_bytesio(df)
-                        ok = _sharepoint_upload_bytes_overwrite(ctx, sp_out_folder, sp_out_name, xlsx_io)
-
-                        if ok:
-                            result["xlsx_filename"] = sp_out_name
-                            result["xlsx_download_url"] = None
-                            result["note"] = f"Uploaded to SharePoint: {sp_out_folder}/{sp_out_name}"
-                        else:
-                            print('[/process_page] init_from_sharepoint upload failed; falling back to browser download')
-                            out_type = "browser"
-
-
-                if out_type == "sharepoint":
-                    print('[/process_page] Saving XLSX to SharePoint (explicit sharepoint mode)')
-                    context_id = output_config.get('contextId')
-                    sharepoint_folder = output_config.get('sharepointFolder')
-                    filename = output_config.get('filename', 'output.xlsx')
-
-                    if not filename.lower().endswith(".xlsx"):
-                        filename = f"{Path(filename).stem}.xlsx"
-
-                    if not (context_id and sharepoint_folder):
-                        print('[/process_page] Missing SharePoint context or folder, falling back to browser output')
-                        out_type = "browser"
-                    else:
-                        def _upload_to_sharepoint():
-                            ctx = _new_ctx(context_id)
-                            sharepoint_create_folder(ctx, sharepoint_folder)  # safe if exists
-                            xlsx_io = _df_to_xlsx_bytesio(df)
-                            return _sharepoint_upload_bytes_overwrite(ctx, sharepoint_folder, filename, xlsx_io)
-
-                        try:
-                            future = EXECUTOR.submit(_upload_to_sharepoint)
-                            success = future.result(timeout=60)
-
-                            if success:
-                                result['xlsx_filename'] = filename
-                                result['xlsx_download_url'] = None
-                                result['note'] = "Uploaded XLSX to SharePoint"
-                            else:
-                                raise Exception("SharePoint upload returned False")
-                        except Exception as sp_error:
-                            print(f"SharePoint upload failed: {sp_error}, falling back to browser output")
-                            out_type = "browser"
-
-
-                if out_type == "browser":
-                    # Save to local filesystem for browser download
-                    print('[/process_page] Saving XLSX to local filesystem')
-                    timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
-                    xlsx_filename = secure_filename(f"gpt_responses_{timestamp}.xlsx")
-                    upload_dir = UPLOAD_ROOT / file_id
-                    xlsx_path = upload_dir / xlsx_filename
-                    upload_dir.mkdir(parents=True, exist_ok=True)
-
-                    xlsx_io = _df_to_xlsx_bytesio(df)
-                    with open(xlsx_path, "wb") as f:
-                        f.write(xlsx_io.getvalue())
-
-                    print(f'[/process_page] XLSX saved to {xlsx_path}')
-                    result['xlsx_filename'] = xlsx_filename
-                    result['xlsx_download_url'] = f"/download/{file_id}/{xlsx_filename}"
-                    result['fallback'] = fallback
-                
-                # Perform cleanup after result is prepared but before returning
-                try:
-                    print(f'[/process_page] Starting cleanup for job {job_id}')
-                    delete_page_results_table(job_id)
-                    delete_job(job_id)
-                    print(f'[/process_page] Deleted page results table and job table for job {job_id}')
-                except Exception as cleanup_error:
-                    # Log but don't raise - cleanup failures shouldn't block CSV delivery
-                    print(f'[/process_page] Warning: Cleanup failed for job {job_id}: {cleanup_error}')
-                    traceback.print_exc()
-                
+                _write_job_output(job_id, job, processing_ts, result)
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': str(e)
+                }), 500
             except Exception as e:
                 print(f'[/process_page] Error writing CSV: {e}')
                 return jsonify({
                     'success': False,
                     'error': f'Error writing CSV file: {e}'
                 }), 500
-        
+
         return jsonify(result), 200
-        
+
     except Exception as e:
         tb = traceback.format_exc()
         print('!' * 80)
         print('error in /process_page')
         print(tb)
+        _drop_prefetched_pages(job_id)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
-@app.route("/api/finalize_batch", methods=["POST"])
-def finalize_batch():
+# -----------------------------------------------------------------------------
+#  Server-side job runner (/process_job, or /process with run: true)
+# -----------------------------------------------------------------------------
+
+# In-memory progress for jobs executed by the server. The job row and page
+# results still live in the DB; this only tracks what the poller needs.
+_JOB_PROGRESS: Dict[str, JobState] = {}
+_JOB_PROGRESS_LOCK = threading.Lock()
+
+
+def _update_job_progress(job_id: str, **changes) -> None:
+    with _JOB_PROGRESS_LOCK:
+        state = _JOB_PROGRESS.get(job_id)
+        if state is None:
+            return
+        for key, value in changes.items():
+            setattr(state, key, value)
+        if state.pages_total:
+            state.progress = round(state.pages_done / state.pages_total, 4)
+
+
+# Pipelined runner: rendered pages waiting for a GPT slot, and pages rendered at once per job
+PAGE_PREFETCH_DEPTH = int(os.getenv("PAGE_PREFETCH_DEPTH", "2"))
+RENDER_PIPELINE_WORKERS = int(os.getenv("RENDER_PIPELINE_WORKERS", "2"))
+
+
+def _run_job_pages(job_id: str, concurrency: int) -> None:
     """
-    Combine results from multiple job_ids into ONE dataframe and output ONE XLSX.
-    Adds an extra column "Filename stem".
+    Process every selected page of *job_id* on the shared GPT event loop with at
+    most *concurrency* pages in flight, then write the output (unless the job is
+    part of a batch).
+    Runs on its own thread; all outcomes are recorded in _JOB_PROGRESS.
     """
     try:
-        data = request.get_json(force=True)
-        job_ids = data.get("job_ids") or []
-        output_config = data.get("output_config") or {"outputType": "browser"}
+        job_resp = get_job(job_id)
+        if not job_resp.get("success"):
+            raise RuntimeError(job_resp.get("error", "Job not found"))
+        job = job_resp["job"]
+
+        pages = [int(p) for p in (job.get("selected_pages") or [])]
+        ts_resp = touch_job_processing_started_at(job_id)
+        processing_ts = ts_resp.get("processing_started_at") if ts_resp.get("success") else datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        _update_job_progress(job_id, status="RUNNING", message=f"Processing {len(pages)} pages")
+        print(f'[/process_job] Job {job_id}: {len(pages)} pages, concurrency {concurrency}')
+
+        def _record_page(page_num: int, failed: bool, cache_hit: Optional[bool], blank: bool = False) -> None:
+            with _JOB_PROGRESS_LOCK:
+                state = _JOB_PROGRESS[job_id]
+                state.pages_done += 1
+                state.pages_failed += int(failed)
+                state.pages_blank += int(blank)
+                if cache_hit is not None:
+                    state.cache_hits += int(cache_hit)
+                    state.cache_misses += int(not cache_hit)
+                state.progress = round(state.pages_done / max(1, state.pages_total), 4)
+                state.message = f"Processed page {page_num}"
+
+        async def _store_failure(page_num: int, e: Exception) -> None:
+            # Keep the page in the output so the sheet has no silent gaps
+            print(f'[/process_job] Job {job_id} page {page_num} failed: {e}')
+            traceback.print_exc()
+            await asyncio.get_running_loop().run_in_executor(
+                PAGE_WORK_EXECUTOR, _store_page_result, job_id, job, page_num, f'Unable to process this page: {e}', 0
+            )
+
+        async def _all_pages():
+            # Pipeline: renderers fill a bounded look-ahead queue while up to
+            # *concurrency* consumers are waiting on GPT, so rendering stays
+            # hidden behind network latency even at concurrency 1. The GPT
+            # layer also applies its process-wide semaphore.
+            queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, PAGE_PREFETCH_DEPTH))
+            page_iter = iter(pages)
+            n_renderers = max(1, min(concurrency, len(pages), RENDER_PIPELINE_WORKERS))
+            n_consumers = max(1, min(concurrency, len(pages)))
+
+            async def _renderer():
+                for page_num in page_iter:
+                    try:
+                        prepared = await _aprepare_page_for_job(job, page_num)
+                    except Exception as e:
+                        prepared = e
+                    await queue.put((page_num, prepared))
+
+            async def _consumer():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    page_num, prepared = item
+                    cache_hit, failed, blank = None, False, False
+                    try:
+                        if isinstance(prepared, Exception):
+                            raise prepared
+                        outcome = await _afinish_page_for_job(job_id, job, page_num, prepared)
+                        cache_hit = outcome.get('cache_hit')
+                        blank = outcome.get('input_mode') == 'blank'
+                        failed = not outcome['ok'] or bool(prepared['rendered'].get('render_error'))
+                    except Exception as e:
+                        await _store_failure(page_num, e)
+                        failed = True
+                    _record_page(page_num, failed, cache_hit, blank)
 
-        if not isinstance(job_ids, list) or not job_ids:
-            return jsonify({"success": False, "error": "job_ids must be a non-empty list"}), 400
+            consumers = [asyncio.ensure_future(_consumer()) for _ in range(n_consumers)]
+            try:
+                await asyncio.gather(*(_renderer() for _ in range(n_renderers)))
+                for _ in consumers:
+                    await queue.put(None)
+                await asyncio.gather(*consumers)
+            finally:
+                for task in consumers:
+                    task.cancel()
 
-        # Collect (file_stem, original_file_name, page, gpt_response) rows in job_ids order
-        flat_rows = []
-        processing_ts_candidates = []
+        run_on_gpt_loop(_all_pages())
 
+        with _JOB_PROGRESS_LOCK:
+            state = _JOB_PROGRESS[job_id]
+            cache_hits, cache_misses = state.cache_hits, state.cache_misses
 
-        for jid in job_ids:
-            job_resp = get_job(jid)
-            job = job_resp.get("job") if job_resp.get("success") else {}
-            file_stem = job.get("file_stem") or Path(job.get("original_file_name") or "").stem or jid[:8]
-            original_file_name = job.get("original_file_name") or file_stem
-            ts = job.get("processing_started_at")
-            if ts:
-                processing_ts_candidates.append(ts)
+        result = {
+            'success': True,
+            'job_id': job_id,
+            'pages_total': len(pages),
+            'cache_hits': cache_hits,
+            'cache_misses': cache_misses,
+        }
+        if bool((job.get("output_config") or {}).get("batch_mode")):
+            result["note"] = "File completed (batch mode). Waiting for finalization."
+            result["batch_mode"] = True
+        else:
+            _update_job_progress(job_id, message="Writing output")
+            _write_job_output(job_id, job, processing_ts, result)
 
-            all_results = get_all_page_results(jid)
-            if not all_results:
-                continue
-            df_raw = pd.DataFrame(all_results)  # expects dicts with keys: page, gpt_response, image_size_bytes
-            for _, r in df_raw.iterrows():
-                flat_rows.append((file_stem, original_file_name, int(r["page"]), r["gpt_response"]))
+        _update_job_progress(job_id, status="DONE", message="Job complete", result=result)
+        print(f'[/process_job] Job {job_id} complete')
+    except Exception as e:
+        tb = traceback.format_exc()
+        print('!' * 80)
+        print(f'error in server-side job {job_id}')
+        print(tb)
+        _update_job_progress(job_id, status="ERROR", message="Job failed", error=str(e), traceback=tb)
 
-        if not flat_rows:
-            return jsonify({"success": False, "error": "No results found for provided job_ids"}), 500
 
-        # Use earliest processing timestamp if available
-        processing_ts = min(processing_ts_candidates) if processing_ts_candidates else datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+def _start_server_side_job(data: Dict[str, Any]):
+    try:
+        concurrency = int(data.get('concurrency') or DEFAULT_PAGE_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'concurrency must be an integer'}), 400
+    concurrency = max(1, min(concurrency, MAX_PAGE_CONCURRENCY))
+
+    processing_options = _processing_options_from_payload(data)
+    processing_options["concurrency"] = concurrency
+    payload, status = _initialize_job(data, processing_options=processing_options)
+    if status != 200:
+        return jsonify(payload), status
+
+    job_id = payload['job_id']
+    with _JOB_PROGRESS_LOCK:
+        _JOB_PROGRESS[job_id] = JobState(
+            job_id=job_id,
+            status="PENDING",
+            message="Queued",
+            pages_total=len(payload['selected_pages']),
+        )
 
-        TARGET_CHARS_PER_CHUNK = 26140
+    threading.Thread(
+        target=_run_job_pages,
+        args=(job_id, concurrency),
+        name=f"job-runner-{job_id[:8]}",
+        daemon=True,
+    ).start()
+
+    payload.update({
+        'message': 'Job started on the server',
+        'status': 'running',
+        'concurrency': concurrency,
+        'status_url': f"/api/jobs/{job_id}",
+    })
+    return jsonify(payload), 202
 
-        def _safe_len(x) -> int:
-            try:
-                return len(x) if isinstance(x, str) else len(str(x))
-            except Exception:
-                return 0
-
-        df_clean_list = []
-        chunk_id = 1
-        chunk_sum = 0
-
-        for (file_stem, original_file_name, page, text) in flat_rows:
-            text_len = _safe_len(text)
-
-            if chunk_sum > 0 and (chunk_sum + text_len) > TARGET_CHARS_PER_CHUNK:
-                dist_if_break = TARGET_CHARS_PER_CHUNK - chunk_sum
-                dist_if_keep  = (chunk_sum + text_len) - TARGET_CHARS_PER_CHUNK
-                if dist_if_break <= dist_if_keep:
-                    chunk_id += 1
-                    chunk_sum = 0
-
-            chunk_sum += text_len
-
-            df_clean_list.append({
-                "timestamp": processing_ts,
-                "chunk": chunk_id,
-                "Filename stem": file_stem,
-                "Data reference": f"p_{original_file_name}",
-                "Brief description (optional)": f"Page {page}",
-                "Source (optional)": original_file_name,
-                "Data": text
-            })
 
-        df = pd.DataFrame(df_clean_list)
-
-        # ---- Clean text to avoid control chars / normalization issues ----
-        import unicodedata, re as _re
-        _CTRL_RE = _re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")  # keep \t \n \r
-
-        def _clean_cell(x):
-            if isinstance(x, (bytes, bytearray)):
-                try:
-                    x = x.decode('utf-8')
-                except Exception:
-                    x = x.decode('utf-8', 'replace')
-            if isinstance(x, str):
-                x = unicodedata.normalize('NFC', x)
-                x = _CTRL_RE.sub('', x)
-            return x
-
-        df = df.map(_clean_cell)
-        # -----------------------------------------------------------------
-
-        out_type = (output_config or {}).get("outputType", "browser")
-        fallback = False
-        result = {"success": True}
-
-        if out_type == "init_from_sharepoint":
-            folder_name   = output_config.get("sharepointFolder")
-            xlsx_filename = output_config.get("filename")
-            row_id        = output_config.get("row_id")
-            site_name     = output_config.get("siteName")
-            tenant        = "tris42.onmicrosoft.com"
-            client_id     = "d44a05d5-c6a5-4bbb-82d2-443123722380"
-
-            if not (folder_name and xlsx_filename and row_id and site_name):
+@app.route('/process_job', methods=['POST'])
+def process_job():
+    """
+    Initialise a job like /process and immediately run every selected page on
+    the server. Poll /api/jobs/<job_id> for progress and the final output.
+    """
+    data = request.get_json(force=True) or {}
+    print('*' * 80)
+    print('[/process_job] Received new server-side processing request')
+    return _start_server_side_job(data)
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Progress for a job; server-run jobs report live counters, others fall back to the DB."""
+    with _JOB_PROGRESS_LOCK:
+        state = _JOB_PROGRESS.get(job_id)
+        if state is not None:
+            return jsonify({
+                "success": True,
+                "job_id": job_id,
+                "status": state.status,
+                "message": state.message,
+                "progress": state.progress,
+                "pages_total": state.pages_total,
+                "pages_done": state.pages_done,
+                "pages_failed": state.pages_failed,
+                "pages_blank": state.pages_blank,
+                "cache_hits": state.cache_hits,
+                "cache_misses": state.cache_misses,
+                "error": state.error,
+                "result": state.result,
+            }), 200
+
+    job_resp = get_job(job_id)
+    if not job_resp.get("success"):
+        return jsonify({"success": False, "error": job_resp.get("error", "Job not found")}), 404
+
+    job = job_resp["job"]
+    pages_total = len(job.get("selected_pages") or [])
+    pages_done = count_page_results(job_id)
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": job.get("status"),
+        "progress": round(pages_done / pages_total, 4) if pages_total else 0.0,
+        "pages_total": pages_total,
+        "pages_done": pages_done,
+        "cache_hits": job.get("cache_hits") or 0,
+        "cache_misses": job.get("cache_misses") or 0,
+    }), 200
+
+
+# -----------------------------------------------------------------------------
+#  Batch finalization (background; poll /api/finalize/<finalize_id>)
+# -----------------------------------------------------------------------------
+
+# Progress for background batch finalization, keyed by finalize_id. Waiters
+# on the condition (the SSE stream) are woken on every update.
+_FINALIZE_PROGRESS: Dict[str, JobState] = {}
+_FINALIZE_PROGRESS_LOCK = threading.Lock()
+_FINALIZE_PROGRESS_CHANGED = threading.Condition(_FINALIZE_PROGRESS_LOCK)
+
+# Finished handles are forgotten (by housekeeping) after this long; the
+# output directory is left to UPLOAD_STORE eviction
+FINALIZE_STATE_TTL_SECONDS = 3600
+FINALIZE_PROGRESS_EVERY_ROWS = 200
+FINALIZE_SSE_HEARTBEAT_SECONDS = 15
+
+
+def _update_finalize_progress(finalize_id: str, **changes) -> None:
+    with _FINALIZE_PROGRESS_CHANGED:
+        state = _FINALIZE_PROGRESS.get(finalize_id)
+        if state is None:
+            return
+        for key, value in changes.items():
+            setattr(state, key, value)
+        if state.pages_total:
+            state.progress = round(min(1.0, state.pages_done / state.pages_total), 4)
+        _FINALIZE_PROGRESS_CHANGED.notify_all()
+
+
+def _prune_finalize_progress() -> int:
+    cutoff = datetime.now() - timedelta(seconds=FINALIZE_STATE_TTL_SECONDS)
+    with _FINALIZE_PROGRESS_LOCK:
+        stale = [fid for fid, state in _FINALIZE_PROGRESS.items()
+                 if state.status in ("DONE", "ERROR") and state.created_at < cutoff]
+        for fid in stale:
+            del _FINALIZE_PROGRESS[fid]
+    return len(stale)
+
+
+def _finalize_status_payload(finalize_id: str, state: JobState) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "finalize_id": finalize_id,
+        "status": state.status,
+        "message": state.message,
+        "progress": state.progress,
+        "files_total": state.total_files,
+        "rows_total": state.pages_total,
+        "rows_written": state.pages_done,
+        "error": state.error,
+        "result": state.result,
+    }
+
+
+def _count_finalize_rows(finalize_id: str, rows):
+    """Pass *rows* through, reporting how many have been written."""
+    done = 0
+    for row in rows:
+        yield row
+        done += 1
+        if done % FINALIZE_PROGRESS_EVERY_ROWS == 0:
+            _update_finalize_progress(finalize_id, pages_done=done)
+    _update_finalize_progress(finalize_id, pages_done=done)
+
+
+def _build_batch_output(finalize_id: str, job_ids: List[str], output_config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Combine results from multiple job_ids into ONE file (XLSX unless
+    outputFormat says otherwise; with a "Filename stem" column), deliver it
+    according to *output_config* and clean up the jobs.
+    Raises ValueError if none of the jobs has results.
+    """
+    output_format = normalise_output_format((output_config or {}).get("outputFormat"))
+    ext = output_extension(output_format)
+
+    # Barrier: every page result queued so far must be in the DB before we
+    # read; a result that could not be saved fails the batch
+    require_page_results_saved(job_ids)
+
+    # Job metadata in one query (the timestamp column needs the earliest start)
+    jobs_resp = get_jobs_by_ids(job_ids)
+    if not jobs_resp.get("success"):
+        raise RuntimeError(jobs_resp.get("error", "Could not read jobs"))
+    jobs = jobs_resp["jobs"]
+
+    file_names = {}
+    processing_ts_candidates = []
+    pages_total = 0
+    for jid in job_ids:
+        job = jobs.get(jid) or {}
+        file_names[jid] = _job_file_names(job, jid)
+        pages_total += len(job.get("selected_pages") or [])
+        ts = job.get("processing_started_at")
+        if ts:
+            processing_ts_candidates.append(ts)
+
+    # Use earliest processing timestamp if available
+    processing_ts = min(processing_ts_candidates) if processing_ts_candidates else datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    batch_id = str(uuid.uuid4())
+    timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
+    local_output_name = secure_filename(f"gpt_responses_batch_{timestamp}{ext}")
+    out_dir = UPLOAD_ROOT / batch_id
+    out_dir.mkdir(parents=True, exist_ok=True)
+    output_path = out_dir / local_output_name
+
+    def _db_sources():
+        # One ordered query over all jobs, split back into per-job page streams
+        with closing(iter_batch_page_results(job_ids)) as rows:
+            for jid, group in groupby(rows, key=lambda r: r[0]):
+                file_stem, original_file_name = file_names[jid]
+                yield file_stem, original_file_name, ((page, text) for _, page, text in group)
+
+    _update_finalize_progress(finalize_id, pages_total=pages_total, message=f"Writing {output_format.upper()}")
+
+    # Spools from every job let this be a plain copy; otherwise stream from the DB
+    spools = [_take_export_spool(jid) for jid in job_ids]
+    try:
+        if all(spool is not None and spool.complete for spool in spools):
+            rows = iter_spooled_rows(spools, processing_ts, break_on_new_file=False)
+        else:
+            rows = iter_export_rows(_db_sources(), processing_ts, break_on_new_file=False)
+        # closing(): release the DB cursor even if writing fails part-way
+        with closing(rows):
+            n_rows = write_rows(_count_finalize_rows(finalize_id, rows), output_path, output_format)
+    finally:
+        for spool in spools:
+            if spool is not None:
+                spool.discard()
+    if not n_rows:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise ValueError("No results found for provided job_ids")
+    UPLOAD_STORE.register(batch_id)
+
+    out_type = (output_config or {}).get("outputType", "browser")
+    fallback = False
+    result = {"success": True}
+
+    if out_type in ("init_from_sharepoint", "sharepoint"):
+        _update_finalize_progress(finalize_id, message="Uploading to SharePoint")
+
+    if out_type == "init_from_sharepoint":
+        folder_name   = output_config.get("sharepointFolder")
+        xlsx_filename = output_config.get("filename")
+        row_id        = output_config.get("row_id")
+        site_name     = output_config.get("siteName")
+        tenant        = "tris42.onmicrosoft.com"
+        client_id     = "d44a05d5-c6a5-4bbb-82d2-443123722380"
+
+        if not (folder_name and xlsx_filename and row_id and site_name):
+            out_type = "browser"
+            fallback = True
+        else:
+            xlsx_stem = Path(xlsx_filename).stem
+            sp_out_folder = f"{folder_name.rstrip('/')}/pdf_output".replace("//", "/")
+            sp_out_name = f"{xlsx_stem}_pdf_{row_id}{ext}"
+
+            sp_site_url = f"https://tris42.sharepoint.com/sites/{site_name}/"
+            ctx = sharepoint_create_context(sp_site_url, tenant, client_id)
+
+            sharepoint_create_folder(ctx, sp_out_folder)
+            output_io = BytesIO(output_path.read_bytes())
+            ok = _sharepoint_upload_bytes_overwrite(ctx, sp_out_folder, sp_out_name, output_io)
+
+            if ok:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                result["xlsx_filename"] = sp_out_name
+                result["xlsx_download_url"] = None
+                result["note"] = f"Uploaded to SharePoint: {sp_out_folder}/{sp_out_name}"
+            else:
                 out_type = "browser"
                 fallback = True
-            else:
-                xlsx_stem = Path(xlsx_filename).stem
-                sp_out_folder = f"{folder_name.rstrip('/')}/pdf_output".replace("//", "/")
-                sp_out_name = f"{xlsx_stem}_pdf_{row_id}.xlsx"
 
-                sp_site_url = f"https://tris42.sharepoint.com/sites/{site_name}/"
-                ctx = sharepoint_create_context(sp_site_url, tenant, client_id)
+    if out_type == "sharepoint":
+        context_id = output_config.get('contextId')
+        sharepoint_folder = output_config.get('sharepointFolder')
+        filename = output_config.get('filename', f'output{ext}')
 
-                sharepoint_create_folder(ctx, sp_out_folder)
-                xlsx_io = _df_to_xlsx_bytesio(df)
-                ok = _sharepoint_upload_bytes_overwrite(ctx, sp_out_folder, sp_out_name, xlsx_io)
+        if not filename.lower().endswith(ext):
+            filename = f"{Path(filename).stem}{ext}"
+
+        if not (context_id and sharepoint_folder):
+            out_type = "browser"
+            fallback = True
+        else:
+            def _upload_to_sharepoint():
+                ctx = _new_ctx(context_id)
+                sharepoint_create_folder(ctx, sharepoint_folder)
+                output_io = BytesIO(output_path.read_bytes())
+                return _sharepoint_upload_bytes_overwrite(ctx, sharepoint_folder, filename, output_io)
 
-                if ok:
-                    result["xlsx_filename"] = sp_out_name
+            try:
+                future = EXECUTOR.submit(_upload_to_sharepoint)
+                success = future.result(timeout=60)
+                if success:
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                    result["xlsx_filename"] = filename
                     result["xlsx_download_url"] = None
-                    result["note"] = f"Uploaded to SharePoint: {sp_out_folder}/{sp_out_name}"
+                    result["note"] = f"Uploaded {output_format.upper()} to SharePoint"
                 else:
                     out_type = "browser"
                     fallback = True
+            except Exception:
+                out_type = "browser"
+                fallback = True
 
-        if out_type == "sharepoint":
-            context_id = output_config.get('contextId')
-            sharepoint_folder = output_config.get('sharepointFolder')
-            filename = output_config.get('filename', 'output.xlsx')
+    if out_type == "browser":
+        result["xlsx_filename"] = local_output_name
+        result["xlsx_download_url"] = f"/download/{batch_id}/{local_output_name}"
+        result["fallback"] = fallback
+        _update_finalize_progress(finalize_id, output_folder=batch_id, csv_name=local_output_name)
 
-            if not filename.lower().endswith(".xlsx"):
-                filename = f"{Path(filename).stem}.xlsx"
+    # xlsx_* keys are kept for existing clients whatever the format
+    result["output_format"] = output_format
 
-            if not (context_id and sharepoint_folder):
-                out_type = "browser"
-                fallback = True
-            else:
-                def _upload_to_sharepoint():
-                    ctx = _new_ctx(context_id)
-                    sharepoint_create_folder(ctx, sharepoint_folder)
-                    xlsx_io = _df_to_xlsx_bytesio(df)
-                    return _sharepoint_upload_bytes_overwrite(ctx, sharepoint_folder, filename, xlsx_io)
-
-                try:
-                    future = EXECUTOR.submit(_upload_to_sharepoint)
-                    success = future.result(timeout=60)
-                    if success:
-                        result["xlsx_filename"] = filename
-                        result["xlsx_download_url"] = None
-                        result["note"] = "Uploaded XLSX to SharePoint"
-                    else:
-                        out_type = "browser"
-                        fallback = True
-                except Exception:
-                    out_type = "browser"
-                    fallback = True
+    # Cleanup all job rows and page results now that we've produced the combined output
+    for jid in job_ids:
+        _drop_prefetched_pages(jid)
+        try:
+            delete_page_results(jid)
+        except Exception:
+            traceback.print_exc()
+        try:
+            delete_job(jid)
+        except Exception:
+            traceback.print_exc()
 
-        if out_type == "browser":
-            batch_id = str(uuid.uuid4())
-            timestamp = datetime.now().strftime('%Y%m%dT%H%M%SZ')
-            xlsx_filename = secure_filename(f"gpt_responses_batch_{timestamp}.xlsx")
-            out_dir = UPLOAD_ROOT / batch_id
-            out_dir.mkdir(parents=True, exist_ok=True)
-            xlsx_path = out_dir / xlsx_filename
+    return result
 
-            xlsx_io = _df_to_xlsx_bytesio(df)
-            with open(xlsx_path, "wb") as f:
-                f.write(xlsx_io.getvalue())
 
-            result["xlsx_filename"] = xlsx_filename
-            result["xlsx_download_url"] = f"/download/{batch_id}/{xlsx_filename}"
-            result["fallback"] = fallback
+def _run_finalize_batch(finalize_id: str, job_ids: List[str], output_config: Dict[str, Any]) -> None:
+    """Thread body for /api/finalize_batch; all outcomes go to _FINALIZE_PROGRESS."""
+    try:
+        _update_finalize_progress(finalize_id, status="RUNNING", message="Reading results")
+        result = _build_batch_output(finalize_id, job_ids, output_config)
+        _update_finalize_progress(finalize_id, status="DONE", message="Batch complete", progress=1.0, result=result)
+        print(f'[finalize_batch] {finalize_id} complete')
+    except Exception as e:
+        tb = traceback.format_exc()
+        print("!" * 80)
+        print("Unhandled error in finalize_batch")
+        print(tb)
+        _update_finalize_progress(finalize_id, status="ERROR", message="Finalize failed", error=str(e), traceback=tb)
 
-        # Cleanup all job tables now that we've produced the combined output
-        for jid in job_ids:
-            try:
-                delete_page_results_table(jid)
-            except Exception:
-                traceback.print_exc()
-            try:
-                delete_job(jid)
-            except Exception:
-                traceback.print_exc()
 
-        return jsonify(result), 200
+@app.route("/api/finalize_batch", methods=["POST"])
+def finalize_batch():
+    """
+    Combine results from multiple job_ids into ONE output file.
+
+    By default this runs in the request and returns the result (200), as
+    before. With "async": true it runs in the background and returns 202 with
+    a finalize_id; poll status_url (or stream events_url) until DONE, then use
+    result.xlsx_download_url / download_url.
+    """
+    try:
+        data = request.get_json(force=True)
+        job_ids = data.get("job_ids") or []
+        output_config = data.get("output_config") or {"outputType": "browser"}
+
+        if not isinstance(job_ids, list) or not job_ids:
+            return jsonify({"success": False, "error": "job_ids must be a non-empty list"}), 400
+        try:
+            normalise_output_format(output_config.get("outputFormat"))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        finalize_id = str(uuid.uuid4())
+        with _FINALIZE_PROGRESS_LOCK:
+            _FINALIZE_PROGRESS[finalize_id] = JobState(
+                job_id=finalize_id,
+                status="PENDING",
+                message="Queued",
+                total_files=len(job_ids),
+            )
+
+        job_ids = [str(jid) for jid in job_ids]
+        if not data.get("async"):
+            _run_finalize_batch(finalize_id, job_ids, output_config)
+            with _FINALIZE_PROGRESS_LOCK:
+                state = _FINALIZE_PROGRESS[finalize_id]
+            if state.status != "DONE":
+                return jsonify({"success": False, "error": state.error}), 500
+            return jsonify({**state.result, "finalize_id": finalize_id}), 200
+
+        threading.Thread(
+            target=_run_finalize_batch,
+            args=(finalize_id, job_ids, output_config),
+            name=f"finalize-{finalize_id[:8]}",
+            daemon=True,
+        ).start()
+
+        return jsonify({
+            "success": True,
+            "finalize_id": finalize_id,
+            "status": "PENDING",
+            "status_url": f"/api/finalize/{finalize_id}",
+            "events_url": f"/api/finalize/{finalize_id}/events",
+            "download_url": f"/api/finalize/{finalize_id}/download",
+        }), 202
 
     except Exception as e:
         tb = traceback.format_exc()
@@ -1610,6 +2501,66 @@ def finalize_batch():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route("/api/finalize/<finalize_id>", methods=["GET"])
+def finalize_status(finalize_id):
+    with _FINALIZE_PROGRESS_LOCK:
+        state = _FINALIZE_PROGRESS.get(finalize_id)
+        if state is None:
+            return jsonify({"success": False, "error": "Unknown finalize_id"}), 404
+        return jsonify(_finalize_status_payload(finalize_id, state)), 200
+
+
+@app.route("/api/finalize/<finalize_id>/download", methods=["GET"])
+def finalize_download(finalize_id):
+    with _FINALIZE_PROGRESS_LOCK:
+        state = _FINALIZE_PROGRESS.get(finalize_id)
+        if state is None:
+            return jsonify({"success": False, "error": "Unknown finalize_id"}), 404
+        status, batch_id, output_name = state.status, state.output_folder, state.csv_name
+
+    if status != "DONE":
+        return jsonify({"success": False, "status": status, "error": "Batch output is not ready"}), 409
+    if not (batch_id and output_name):
+        return jsonify({"success": False, "error": "Batch output was delivered to SharePoint"}), 404
+    return download(f"{batch_id}/{output_name}")
+
+
+@app.route("/api/finalize/<finalize_id>/events", methods=["GET"])
+def finalize_events(finalize_id):
+    """Server-sent events: one status payload per change until DONE or ERROR."""
+    with _FINALIZE_PROGRESS_LOCK:
+        if finalize_id not in _FINALIZE_PROGRESS:
+            return jsonify({"success": False, "error": "Unknown finalize_id"}), 404
+
+    def _events():
+        last = None
+        while True:
+            with _FINALIZE_PROGRESS_CHANGED:
+                state = _FINALIZE_PROGRESS.get(finalize_id)
+                payload = _finalize_status_payload(finalize_id, state) if state is not None else None
+                if payload is not None and payload == last:
+                    _FINALIZE_PROGRESS_CHANGED.wait(timeout=FINALIZE_SSE_HEARTBEAT_SECONDS)
+                    state = _FINALIZE_PROGRESS.get(finalize_id)
+                    payload = _finalize_status_payload(finalize_id, state) if state is not None else None
+
+            if payload is None:
+                yield f"event: error\ndata: {json.dumps({'success': False, 'error': 'Unknown finalize_id'})}\n\n"
+                return
+            if payload == last:
+                yield ": keep-alive\n\n"
+                continue
+            last = payload
+            yield f"data: {json.dumps(payload)}\n\n"
+            if payload["status"] in ("DONE", "ERROR"):
+                return
+
+    return Response(
+        _events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/api/feedback", methods=["POST"])
 def api_submit_feedback():
     try:
@@ -1644,6 +2595,77 @@ def ping():
     return jsonify({"status": "ok"})
 
 
+@app.route("/api/gpt/rate_limits")
+def gpt_rate_limits():
+    """Current per-model request/token budgets and AIMD concurrency of the GPT scheduler."""
+    return jsonify({"success": True, "models": RATE_LIMITER.snapshot()})
+
+
+# -----------------------------------------------------------------------------
+#  Semantic prompt search
+# -----------------------------------------------------------------------------
+def _embed_prompt_text(text: str) -> List[float]:
+    return get_embedding(text, model=PROMPT_EMBEDDING_MODEL, dimensions=PROMPT_EMBEDDING_DIMENSIONS)
+
+
+PROMPT_INDEX = PromptEmbeddingIndex(embed_fn=_embed_prompt_text)
+_prompt_backfill_started = False
+
+
+def _start_prompt_embedding_backfill():
+    """Embed prompts saved before embeddings existed, once, in the background."""
+    global _prompt_backfill_started
+    if _prompt_backfill_started:
+        return
+    _prompt_backfill_started = True
+
+    def _backfill():
+        try:
+            while PROMPT_INDEX.backfill(limit=100):
+                pass
+        except Exception:
+            traceback.print_exc()
+
+    EXECUTOR.submit(_backfill)
+
+
+def _semantic_prompt_search(search_text: Optional[str], like_id: Optional[int], limit: int, filters: Dict[str, Any]):
+    """
+    Rank saved prompts by cosine similarity to *search_text*, or to the stored
+    embedding of prompt *like_id* (which is left out of the results).
+    """
+    _start_prompt_embedding_backfill()
+
+    if like_id is not None:
+        query_vec = PROMPT_INDEX.vector_for(like_id)
+        if query_vec is None:
+            prompt = get_prompts_by_ids([like_id]).get(like_id)
+            if prompt is None:
+                return {"success": False, "error": "Prompt not found"}, 404
+            PROMPT_INDEX.embed_prompt(prompt)
+            query_vec = PROMPT_INDEX.vector_for(like_id)
+    elif search_text:
+        query_vec = PROMPT_INDEX.embed_query(search_text)
+    else:
+        return {"success": False, "error": "search_text or like_id is required for semantic search"}, 400
+
+    if query_vec is None:
+        return {"success": False, "error": "Could not compute an embedding for this search"}, 502
+
+    # Over-fetch when filters may drop some of the nearest prompts
+    has_filters = any(filters.values())
+    hits = PROMPT_INDEX.top_k(query_vec, k=limit * 4 if has_filters else limit, exclude=like_id)
+    rows = get_prompts_by_ids([pid for pid, _ in hits], **filters)
+
+    prompts = []
+    for pid, score in hits:
+        if pid in rows:
+            prompts.append(dict(rows[pid], similarity=round(score, 4)))
+        if len(prompts) >= limit:
+            break
+    return {"success": True, "prompts": prompts, "count": len(prompts), "search_mode": "semantic"}, 200
+
+
 @app.route("/api/prompts/save", methods=["POST"])
 def api_save_prompt():
     """Save a new prompt configuration."""
@@ -1668,6 +2690,22 @@ def api_save_prompt():
         )
         
         if result["success"]:
+            # Embed once now so semantic search never has to re-embed the library
+            try:
+                result["embedded"] = PROMPT_INDEX.embed_prompt({
+                    "id": result["id"],
+                    "name": data["name"],
+                    "description": data.get("description", ""),
+                    "tags": data.get("tags"),
+                    "role_prompt": data["role"],
+                    "task_prompt": data["task"],
+                    "context_prompt": data["context"],
+                    "format_prompt": data["format"],
+                    "constraints_prompt": data["constraints"],
+                })
+            except Exception as e:
+                print(f'[/api/prompts/save] Embedding failed for prompt {result["id"]}: {e}')
+                result["embedded"] = False
             return jsonify(result), 201
         else:
             return jsonify(result), 400
@@ -1691,6 +2729,23 @@ def api_search_prompts():
         date_operator = request.args.get("date_operator")
         date_value = request.args.get("date_value")
         date_value_end = request.args.get("date_value_end")
+
+        # mode=semantic (with search_text) or like_id=<prompt id>: rank by embedding similarity
+        like_id = request.args.get("like_id", type=int)
+        if like_id is not None or request.args.get("mode") == "semantic":
+            result, status = _semantic_prompt_search(
+                search_text,
+                like_id,
+                limit,
+                filters={
+                    "tags": tags,
+                    "created_by": created_by,
+                    "date_operator": date_operator,
+                    "date_value": date_value,
+                    "date_value_end": date_value_end,
+                },
+            )
+            return jsonify(result), status
         
         result = search_prompts(
             search_text=search_text,
@@ -1733,6 +2788,7 @@ def api_delete_prompt(prompt_id):
         result = delete_prompt(prompt_id)
         
         if result["success"]:
+            PROMPT_INDEX.remove(prompt_id)
             return jsonify(result), 200
         else:
             return jsonify(result), 404
@@ -1740,6 +2796,71 @@ def api_delete_prompt(prompt_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# -----------------------------------------------------------------------------
+#  Housekeeping (one background thread; stats at /api/housekeeping)
+# -----------------------------------------------------------------------------
+# Jobs normally delete themselves when their output is written; this only
+# catches abandoned ones, so it is far longer than any real run
+JOB_MAX_AGE_MINUTES = int(os.getenv("JOB_MAX_AGE_MINUTES", str(24 * 60)))
+JOB_PROGRESS_TTL_SECONDS = 3600
+
+# Task intervals in seconds; 0 disables a task
+HOUSEKEEPING_UPLOADS_INTERVAL = float(os.getenv("HOUSEKEEPING_UPLOADS_INTERVAL", "300"))
+HOUSEKEEPING_JOBS_INTERVAL = float(os.getenv("HOUSEKEEPING_JOBS_INTERVAL", "3600"))
+HOUSEKEEPING_CACHES_INTERVAL = float(os.getenv("HOUSEKEEPING_CACHES_INTERVAL", "300"))
+
+
+def _prune_job_progress() -> int:
+    cutoff = datetime.now() - timedelta(seconds=JOB_PROGRESS_TTL_SECONDS)
+    with _JOB_PROGRESS_LOCK:
+        stale = [jid for jid, state in _JOB_PROGRESS.items()
+                 if state.status in ("DONE", "ERROR") and state.created_at < cutoff]
+        for jid in stale:
+            del _JOB_PROGRESS[jid]
+    return len(stale)
+
+
+def _expire_sharepoint_contexts() -> int:
+    now = time.time()
+    with _CTX_CACHE_LOCK:
+        stale = [cid for cid, (_, created_at) in _CTX_CACHE.items() if now - created_at >= CTX_TTL_SECONDS]
+        for cid in stale:
+            del _CTX_CACHE[cid]
+    return len(stale)
+
+
+def _expire_caches() -> Dict[str, int]:
+    return {
+        "gpt_cache_entries": evict_gpt_response_cache(),
+        "open_documents": DOCUMENT_CACHE.evict_idle(),
+        "sharepoint_contexts": _expire_sharepoint_contexts(),
+        "job_progress": _prune_job_progress(),
+        "finalize_progress": _prune_finalize_progress(),
+        "page_prefetch": _expire_page_prefetch(),
+    }
+
+
+HOUSEKEEPER = Housekeeper()
+HOUSEKEEPER.add_task("uploads", HOUSEKEEPING_UPLOADS_INTERVAL, UPLOAD_STORE.sweep)
+HOUSEKEEPER.add_task("upload_content", HOUSEKEEPING_UPLOADS_INTERVAL, CONTENT_STORE.sweep)
+HOUSEKEEPER.add_task("stale_jobs", HOUSEKEEPING_JOBS_INTERVAL, lambda: cleanup_jobs_older_than(JOB_MAX_AGE_MINUTES))
+HOUSEKEEPER.add_task("orphan_results", HOUSEKEEPING_JOBS_INTERVAL, purge_orphan_page_results)
+HOUSEKEEPER.add_task("caches", HOUSEKEEPING_CACHES_INTERVAL, _expire_caches)
+
+
+@app.before_request
+def _ensure_housekeeping():
+    # Started by the first request rather than at import, so spawned render
+    # workers (which re-import this module) never run it
+    if not HOUSEKEEPER.running:
+        HOUSEKEEPER.start()
+
+
+@app.route("/api/housekeeping", methods=["GET"])
+def housekeeping_stats():
+    return jsonify({"success": True, **HOUSEKEEPER.stats(), "upload_store": UPLOAD_STORE.stats()}), 200
+
+
 @app.route("/")
 def root():
     return app.send_static_file("index.html")
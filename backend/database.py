@@ -1,12 +1,15 @@
 import sqlite3
 import os
+import re
 import logging
 import time
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Set, Tuple, Iterator
 from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 import json
+import queue
+import atexit
 import threading
 import pandas as pd
 
@@ -40,10 +43,88 @@ def ensure_db_directory():
     Path(DB_DIR).mkdir(parents=True, exist_ok=True)
     logger.info(f"Database directory ensured at: {DB_DIR}")
 
+
+# Connection pool: connections stay open with their pragmas applied once.
+# Beyond DB_POOL_SIZE idle connections, returned ones are closed.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_CACHE_SIZE_KIB = int(os.getenv("DB_CACHE_SIZE_KIB", str(16 * 1024)))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_CACHED_STATEMENTS = 256
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_local = threading.local()  # the connection this thread is inside of, for nesting
+
+
+def _open_connection(timeout: float) -> sqlite3.Connection:
+    ensure_db_directory()
+    # check_same_thread=False: a pooled connection is used by one thread at a time
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=timeout,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return conn
+
+
+def _checkout_connection(timeout: float) -> sqlite3.Connection:
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        return _open_connection(timeout)
+    if timeout != DEFAULT_BUSY_TIMEOUT:
+        conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return conn
+
+
+def _return_connection(conn: sqlite3.Connection, timeout: float, healthy: bool) -> None:
+    if healthy and conn.in_transaction:
+        # An open transaction would keep its locks while the connection sits in the pool
+        logger.warning("Discarding pooled connection left inside a transaction")
+        healthy = False
+    if healthy:
+        try:
+            if timeout != DEFAULT_BUSY_TIMEOUT:
+                conn.execute(f"PRAGMA busy_timeout={int(DEFAULT_BUSY_TIMEOUT * 1000)}")
+            _pool.put_nowait(conn)
+            return
+        except (queue.Full, sqlite3.Error):
+            pass
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def close_db_connections():
+    """Close every idle pooled connection (they reopen on demand)."""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 @contextmanager
-def get_db_connection(timeout=30.0):
+def get_db_connection(timeout=DEFAULT_BUSY_TIMEOUT):
     """
     Context manager for database connections with proper resource cleanup.
+
+    Connections come from a small pool and are returned afterwards. Nested
+    use on the same thread shares the outer connection; only the outermost
+    block commits (or rolls back if it exits by any exception). A connection
+    still inside a transaction is closed rather than pooled.
     
     Args:
         timeout: Database busy timeout in seconds
@@ -51,22 +132,56 @@ def get_db_connection(timeout=30.0):
     Yields:
         sqlite3.Connection: Database connection
     """
-    ensure_db_directory()
-    conn = None
+    outer = getattr(_local, "conn", None)
+    if outer is not None:
+        yield outer
+        return
+
+    conn = _checkout_connection(timeout)
+    _local.conn = conn
+    healthy = True
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=timeout)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA journal_mode=WAL")
         yield conn
         conn.commit()
-    except Exception as e:
-        if conn:
+    except BaseException as e:
+        # Also GeneratorExit and KeyboardInterrupt: never leave the transaction open
+        try:
             conn.rollback()
-        logger.error(f"Database error: {e}")
+        except Exception:
+            healthy = False
+        if isinstance(e, sqlite3.Error):
+            # Don't hand a connection that just failed to the next caller
+            healthy = False
+        if isinstance(e, Exception):
+            logger.error(f"Database error: {e}")
         raise
     finally:
-        if conn:
+        _local.conn = None
+        _return_connection(conn, timeout, healthy)
+
+
+
+@contextmanager
+def _streaming_connection(timeout=DEFAULT_BUSY_TIMEOUT):
+    """
+    A private read-only, autocommit connection for generators that yield
+    rows while a query is open. It is never shared through _local or the
+    pool, so other DB calls made while the generator is suspended do not
+    join its transaction.
+    """
+    conn = _open_connection(timeout)
+    conn.isolation_level = None
+    conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        try:
             conn.close()
+        except Exception:
+            pass
+
+
+atexit.register(close_db_connections)
 
 def init_prompts_table():
     """Initialize the saved_prompts table if it doesn't exist."""
@@ -97,6 +212,99 @@ def init_prompts_table():
         """)
         logger.info("Prompts table initialized successfully")
 
+    init_prompts_fts()
+    init_prompt_embeddings_table()
+
+
+# ----------------------------
+# PROMPT FULL-TEXT INDEX (FTS5)
+# ----------------------------
+
+# Indexed columns, in FTS column order; search_fields names map onto these
+PROMPT_FTS_COLUMNS = [
+    "name", "description", "role_prompt", "task_prompt",
+    "context_prompt", "format_prompt", "constraints_prompt", "tags",
+]
+PROMPT_SEARCH_FIELD_COLUMNS = {
+    'name': 'name',
+    'description': 'description',
+    'role': 'role_prompt',
+    'task': 'task_prompt',
+    'context': 'context_prompt',
+    'format': 'format_prompt',
+    'constraints': 'constraints_prompt',
+    'tags': 'tags'
+}
+PROMPT_BODY_COLUMNS = ["role_prompt", "task_prompt", "context_prompt", "format_prompt", "constraints_prompt"]
+# bm25 weights per column (same order as PROMPT_FTS_COLUMNS): name matches rank highest
+PROMPT_FTS_WEIGHTS = [10.0, 3.0, 1.0, 1.0, 1.0, 1.0, 1.0, 3.0]
+
+_prompt_fts_available = False
+
+
+def init_prompts_fts():
+    """
+    Create the saved_prompts_fts external-content index and the triggers that
+    keep it in sync. Builds the index from existing rows the first time.
+    Search falls back to LIKE when this SQLite has no FTS5.
+    """
+    global _prompt_fts_available
+    cols = ", ".join(PROMPT_FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in PROMPT_FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in PROMPT_FTS_COLUMNS)
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'saved_prompts_fts'"
+            ).fetchone()
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS saved_prompts_fts USING fts5(
+                    {cols},
+                    content='saved_prompts',
+                    content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2',
+                    prefix='2 3'
+                )
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_ai AFTER INSERT ON saved_prompts BEGIN
+                    INSERT INTO saved_prompts_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_ad AFTER DELETE ON saved_prompts BEGIN
+                    INSERT INTO saved_prompts_fts(saved_prompts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                END
+            """)
+            # Only a change to an indexed column needs reindexing (not use_count bumps)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS saved_prompts_fts_au AFTER UPDATE OF {cols} ON saved_prompts BEGIN
+                    INSERT INTO saved_prompts_fts(saved_prompts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    INSERT INTO saved_prompts_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                END
+            """)
+            if not exists:
+                cursor.execute("INSERT INTO saved_prompts_fts(saved_prompts_fts) VALUES ('rebuild')")
+                logger.info("Built saved_prompts_fts from existing prompts")
+        _prompt_fts_available = True
+        logger.info("Prompt full-text index initialized successfully")
+    except sqlite3.OperationalError as e:
+        _prompt_fts_available = False
+        logger.warning(f"FTS5 unavailable, prompt search will use LIKE: {e}")
+
+
+def _prompt_fts_query(search_text: str, columns: List[str]) -> Optional[str]:
+    """
+    Build an FTS5 MATCH expression: every word must match (as a prefix) in
+    one of *columns*. Returns None if the text has no searchable words.
+    """
+    terms = re.findall(r"\w+", search_text or "")
+    if not terms:
+        return None
+    colspec = "{" + " ".join(columns) + "}"
+    return " AND ".join(f'{colspec} : "{term}"*' for term in terms)
+
 def save_prompt(
     name: str,
     description: str,
@@ -170,6 +378,151 @@ def save_prompt(
     
     return {"success": False, "error": "Database is busy, please try again"}
 
+# ----------------------------
+# PROMPT EMBEDDINGS
+# ----------------------------
+
+def init_prompt_embeddings_table():
+    """
+    Initialize prompt_embeddings (one float32 vector per saved prompt); rows
+    go away with their prompt via trigger.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS prompt_embeddings (
+                prompt_id INTEGER PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                embedding BLOB NOT NULL,        -- float32, little-endian
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS saved_prompts_embedding_ad AFTER DELETE ON saved_prompts BEGIN
+                DELETE FROM prompt_embeddings WHERE prompt_id = old.id;
+            END
+        """)
+        logger.info("Prompt embeddings table initialized successfully")
+
+
+def save_prompt_embedding(prompt_id: int, model: str, embedding: bytes, dim: int) -> Dict[str, Any]:
+    """
+    Store (or replace) the embedding for a prompt.
+
+    Args:
+        prompt_id: ID of the saved prompt
+        model: Embedding model that produced the vector
+        embedding: float32 vector as raw bytes
+        dim: Vector length
+    """
+    try:
+        with get_db_connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO prompt_embeddings (prompt_id, model, dim, embedding)
+                VALUES (?, ?, ?, ?)
+            """, (prompt_id, model, dim, sqlite3.Binary(embedding)))
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"Error saving prompt embedding: {e}")
+        return {"success": False, "error": str(e)}
+
+
+def load_prompt_embeddings(model: str) -> List[Tuple[int, int, bytes]]:
+    """Return [(prompt_id, dim, embedding_bytes)] for every prompt embedded with *model*."""
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT prompt_id, dim, embedding FROM prompt_embeddings WHERE model = ?", (model,)
+        ).fetchall()
+    return [(row[0], row[1], bytes(row[2])) for row in rows]
+
+
+def list_prompts_missing_embeddings(model: str, limit: int = 100) -> List[Dict[str, Any]]:
+    """Saved prompts with no embedding for *model* yet (oldest first)."""
+    with get_db_connection() as conn:
+        rows = conn.execute("""
+            SELECT p.* FROM saved_prompts p
+            LEFT JOIN prompt_embeddings e ON e.prompt_id = p.id AND e.model = ?
+            WHERE e.prompt_id IS NULL
+            ORDER BY p.id
+            LIMIT ?
+        """, (model, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_prompts_by_ids(
+    prompt_ids: List[int],
+    tags: Optional[str] = None,
+    created_by: Optional[str] = None,
+    date_operator: Optional[str] = None,
+    date_value: Optional[str] = None,
+    date_value_end: Optional[str] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Fetch saved prompts by ID (without touching use counts), applying the
+    same optional filters as search_prompts. Returns {id: prompt}.
+    """
+    if not prompt_ids:
+        return {}
+    placeholders = ",".join("?" for _ in prompt_ids)
+    filters, filter_params = _prompt_filter_conditions(tags, created_by, date_operator, date_value, date_value_end)
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM saved_prompts WHERE id IN ({placeholders}){filters}",
+            [int(i) for i in prompt_ids] + filter_params,
+        ).fetchall()
+    return {row["id"]: dict(row) for row in rows}
+
+
+def _prompt_search_columns(search_in: str, search_fields: Optional[List[str]]) -> List[str]:
+    """Columns a text search covers; search_fields wins over the legacy search_in."""
+    if search_fields:
+        columns = [PROMPT_SEARCH_FIELD_COLUMNS[f] for f in search_fields if f in PROMPT_SEARCH_FIELD_COLUMNS]
+        if columns:
+            return columns
+        return []
+    if search_in == "name":
+        return ["name"]
+    if search_in == "body":
+        return list(PROMPT_BODY_COLUMNS)
+    return ["name"] + PROMPT_BODY_COLUMNS
+
+
+def _prompt_filter_conditions(
+    tags: Optional[str],
+    created_by: Optional[str],
+    date_operator: Optional[str],
+    date_value: Optional[str],
+    date_value_end: Optional[str],
+    alias: str = "",
+) -> Tuple[str, List[Any]]:
+    """SQL (" AND ..." clauses) and params for the non-text search filters."""
+    query = ""
+    params: List[Any] = []
+    if tags:
+        query += f" AND {alias}tags LIKE ?"
+        params.append(f"%{tags}%")
+
+    if created_by:
+        query += f" AND {alias}created_by = ?"
+        params.append(created_by)
+
+    if date_operator and date_value:
+        if date_operator == "before":
+            query += f" AND DATE({alias}created_at) < DATE(?)"
+            params.append(date_value)
+        elif date_operator == "after":
+            query += f" AND DATE({alias}created_at) > DATE(?)"
+            params.append(date_value)
+        elif date_operator == "on":
+            query += f" AND DATE({alias}created_at) = DATE(?)"
+            params.append(date_value)
+        elif date_operator == "between" and date_value_end:
+            query += f" AND DATE({alias}created_at) BETWEEN DATE(?) AND DATE(?)"
+            params.extend([date_value, date_value_end])
+    return query, params
+
+
 def search_prompts(
     search_text: Optional[str] = None,
     search_in: str = "both",
@@ -183,11 +536,16 @@ def search_prompts(
 ) -> Dict[str, Any]:
     """
     Search for saved prompts.
+
+    Text searches use the FTS5 index: every word must match as a prefix,
+    results are ranked by bm25 and carry a highlighted "snippet". Without
+    FTS5 (or for text with no words) they fall back to LIKE '%text%',
+    newest first.
     
     Args:
         search_text: Text to search for
         search_in: Where to search - 'name', 'body', or 'both' (legacy, overridden by search_fields)
-        search_fields: List of specific fields to search in (e.g., ['name', 'description', 'role_prompt'])
+        search_fields: List of specific fields to search in (e.g., ['name', 'description', 'role'])
         tags: Filter by tags (comma-separated)
         created_by: Filter by creator
         date_operator: Date comparison operator - 'before', 'after', 'on', 'between'
@@ -198,104 +556,68 @@ def search_prompts(
     Returns:
         Dict with success status and list of prompts or error
     """
+    columns = _prompt_search_columns(search_in, search_fields) if search_text else []
+    fts_query = _prompt_fts_query(search_text, columns) if (columns and _prompt_fts_available) else None
+
     attempt = 0
     while attempt < MAX_RETRIES:
         try:
             with get_db_connection() as conn:
                 cursor = conn.cursor()
-                
-                query = "SELECT * FROM saved_prompts WHERE 1=1"
-                params = []
-                
-                if search_text:
-                    search_pattern = f"%{search_text}%"
-                    
-                    if search_fields and len(search_fields) > 0:
-                        field_mapping = {
-                            'name': 'name',
-                            'description': 'description',
-                            'role': 'role_prompt',
-                            'task': 'task_prompt',
-                            'context': 'context_prompt',
-                            'format': 'format_prompt',
-                            'constraints': 'constraints_prompt',
-                            'tags': 'tags'
-                        }
-                        
-                        valid_fields = []
-                        for field in search_fields:
-                            if field in field_mapping:
-                                valid_fields.append(field_mapping[field])
-                        
-                        if valid_fields:
-                            conditions = " OR ".join([f"{field} LIKE ?" for field in valid_fields])
-                            query += f" AND ({conditions})"
-                            params.extend([search_pattern] * len(valid_fields))
-                    else:
-                        if search_in == "name":
-                            query += " AND name LIKE ?"
-                            params.append(search_pattern)
-                        elif search_in == "body":
-                            query += """ AND (
-                                role_prompt LIKE ? OR 
-                                task_prompt LIKE ? OR 
-                                context_prompt LIKE ? OR 
-                                format_prompt LIKE ? OR 
-                                constraints_prompt LIKE ?
-                            )"""
-                            params.extend([search_pattern] * 5)
-                        else:
-                            query += """ AND (
-                                name LIKE ? OR
-                                role_prompt LIKE ? OR 
-                                task_prompt LIKE ? OR 
-                                context_prompt LIKE ? OR 
-                                format_prompt LIKE ? OR 
-                                constraints_prompt LIKE ?
-                            )"""
-                            params.extend([search_pattern] * 6)
-                
-                if tags:
-                    query += " AND tags LIKE ?"
-                    params.append(f"%{tags}%")
-                
-                if created_by:
-                    query += " AND created_by = ?"
-                    params.append(created_by)
-                
-                if date_operator and date_value:
-                    if date_operator == "before":
-                        query += " AND DATE(created_at) < DATE(?)"
-                        params.append(date_value)
-                    elif date_operator == "after":
-                        query += " AND DATE(created_at) > DATE(?)"
-                        params.append(date_value)
-                    elif date_operator == "on":
-                        query += " AND DATE(created_at) = DATE(?)"
-                        params.append(date_value)
-                    elif date_operator == "between" and date_value_end:
-                        query += " AND DATE(created_at) BETWEEN DATE(?) AND DATE(?)"
-                        params.extend([date_value, date_value_end])
-                
-                query += " ORDER BY created_at DESC LIMIT ?"
-                params.append(limit)
-                
+
+                if fts_query:
+                    filters, filter_params = _prompt_filter_conditions(
+                        tags, created_by, date_operator, date_value, date_value_end, alias="p."
+                    )
+                    weights = ", ".join(str(w) for w in PROMPT_FTS_WEIGHTS)
+                    query = f"""
+                        SELECT p.*,
+                               snippet(saved_prompts_fts, -1, '<mark>', '</mark>', '…', 12) AS snippet,
+                               bm25(saved_prompts_fts, {weights}) AS rank
+                        FROM saved_prompts_fts
+                        JOIN saved_prompts p ON p.id = saved_prompts_fts.rowid
+                        WHERE saved_prompts_fts MATCH ?{filters}
+                        ORDER BY rank
+                        LIMIT ?
+                    """
+                    params = [fts_query] + filter_params + [limit]
+                    search_mode = "fts"
+                else:
+                    query = "SELECT * FROM saved_prompts WHERE 1=1"
+                    params = []
+
+                    if search_text and columns:
+                        conditions = " OR ".join(f"{field} LIKE ?" for field in columns)
+                        query += f" AND ({conditions})"
+                        params.extend([f"%{search_text}%"] * len(columns))
+
+                    filters, filter_params = _prompt_filter_conditions(
+                        tags, created_by, date_operator, date_value, date_value_end
+                    )
+                    query += filters + " ORDER BY created_at DESC LIMIT ?"
+                    params += filter_params + [limit]
+                    search_mode = "like"
+
                 cursor.execute(query, params)
                 rows = cursor.fetchall()
                 
                 prompts = [dict(row) for row in rows]
-                logger.info(f"Search returned {len(prompts)} results")
+                logger.info(f"Search ({search_mode}) returned {len(prompts)} results")
                 
                 return {
                     "success": True,
                     "prompts": prompts,
-                    "count": len(prompts)
+                    "count": len(prompts),
+                    "search_mode": search_mode,
                 }
         except sqlite3.OperationalError as e:
             if any(err in str(e).lower() for err in RETRYABLE_ERRORS):
                 attempt += 1
                 logger.warning(f"Database locked, retry {attempt}/{MAX_RETRIES}: {e}")
                 time.sleep(RETRY_DELAY * attempt)
+            elif fts_query:
+                logger.warning(f"FTS search failed, falling back to LIKE: {e}")
+                fts_query = None
             else:
                 logger.error(f"Non-retryable database error: {e}")
                 return {"success": False, "error": str(e)}
@@ -399,30 +721,222 @@ def delete_prompt(prompt_id: int) -> Dict[str, Any]:
     return {"success": False, "error": "Database is busy, please try again"}
 
 
-def create_page_results_table(job_id: str):
+# ----------------------------
+# PAGE RESULTS (one shared table)
+# ----------------------------
+
+_LEGACY_PAGE_RESULTS_RE = re.compile(
+    r"^page_results_([0-9a-f]{8})_([0-9a-f]{4})_([0-9a-f]{4})_([0-9a-f]{4})_([0-9a-f]{12})$"
+)
+
+
+def init_page_results_table():
     """
-    Create a temporary table for storing page processing results for a specific job.
-    
-    Args:
-        job_id: Unique identifier for the processing job
+    Initialize the shared page_results table, and fold in any per-job
+    page_results_<job_id> tables left by older versions.
     """
-    table_name = f"page_results_{job_id.replace('-', '_')}"
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                page_number INTEGER PRIMARY KEY,
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS page_results (
+                job_id TEXT NOT NULL,
+                page_number INTEGER NOT NULL,
                 gpt_response TEXT,
                 image_size_bytes INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (job_id, page_number)
             )
         """)
-        logger.info(f"Created page results table: {table_name}")
+
+        legacy = cursor.execute("""
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name LIKE 'page_results\\_%' ESCAPE '\\'
+        """).fetchall()
+        for (table_name,) in legacy:
+            m = _LEGACY_PAGE_RESULTS_RE.match(table_name)
+            if m:
+                job_id = "-".join(m.groups())
+                cursor.execute(f"""
+                    INSERT OR IGNORE INTO page_results (job_id, page_number, gpt_response, image_size_bytes, created_at)
+                    SELECT ?, page_number, gpt_response, image_size_bytes, created_at FROM "{table_name}"
+                """, (job_id,))
+            cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        if legacy:
+            logger.warning(f"Migrated {len(legacy)} per-job page results tables into page_results")
+
+        logger.info("Page results table initialized successfully")
+
+
+# Write-behind: page results are queued and committed by one writer thread in
+# grouped transactions (up to PAGE_WRITE_BATCH_ROWS rows, or whatever arrived
+# within PAGE_WRITE_BATCH_MS). Readers of page results flush first.
+PAGE_WRITE_BATCH_ROWS = int(os.getenv("PAGE_WRITE_BATCH_ROWS", "200"))
+PAGE_WRITE_BATCH_MS = int(os.getenv("PAGE_WRITE_BATCH_MS", "5"))
+PAGE_WRITE_FLUSH_TIMEOUT = 60.0
+
+
+class PageResultWriter:
+    """Background writer for page_results with a flush barrier."""
+
+    def __init__(self, batch_rows: int = PAGE_WRITE_BATCH_ROWS, batch_ms: int = PAGE_WRITE_BATCH_MS):
+        self.batch_rows = max(1, batch_rows)
+        self.batch_seconds = max(0, batch_ms) / 1000.0
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._cond = threading.Condition()
+        self._enqueued = 0   # rows handed to the writer
+        self._settled = 0    # rows written (or given up on)
+        self._failed = 0
+        # job_id -> pages whose latest write was given up on; cleared when the
+        # page is written again or the job's results are deleted
+        self._failed_pages: Dict[str, Set[int]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="page-result-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, job_id: str, page_number: int, gpt_response: str, image_size_bytes: int):
+        self._ensure_started()
+        with self._cond:
+            self._enqueued += 1
+        self._queue.put((job_id, page_number, gpt_response, image_size_bytes))
+
+    def flush(self, timeout: Optional[float] = PAGE_WRITE_FLUSH_TIMEOUT,
+              job_ids: Optional[List[str]] = None) -> bool:
+        """
+        Wait until every row queued before this call is settled. False on
+        timeout, or if rows of *job_ids* (any job when None) could not be written.
+        """
+        with self._cond:
+            target = self._enqueued
+            if not self._cond.wait_for(lambda: self._settled >= target, timeout=timeout):
+                return False
+            return not self._failed_pages_locked(job_ids)
+
+    def _failed_pages_locked(self, job_ids: Optional[List[str]]) -> Dict[str, Set[int]]:
+        if job_ids is None:
+            return {jid: pages for jid, pages in self._failed_pages.items() if pages}
+        return {jid: self._failed_pages[jid] for jid in job_ids if self._failed_pages.get(jid)}
+
+    def failed_pages(self, job_ids: Optional[List[str]] = None) -> Dict[str, List[int]]:
+        with self._cond:
+            return {jid: sorted(pages) for jid, pages in self._failed_pages_locked(job_ids).items()}
+
+    def forget_failures(self, job_id: str) -> None:
+        with self._cond:
+            self._failed_pages.pop(job_id, None)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_rows:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            written = self._write_batch(batch)
+            with self._cond:
+                for job_id, page_number, _, _ in batch:
+                    if written:
+                        pages = self._failed_pages.get(job_id)
+                        if pages:
+                            pages.discard(page_number)
+                    else:
+                        self._failed_pages.setdefault(job_id, set()).add(page_number)
+                self._settled += len(batch)
+                self._failed += len(batch) - written
+                self._cond.notify_all()
+
+    def _write_batch(self, batch: List[tuple]) -> int:
+        attempt = 0
+        while attempt < MAX_RETRIES:
+            try:
+                with get_db_connection() as conn:
+                    conn.executemany("""
+                        INSERT OR REPLACE INTO page_results
+                        (job_id, page_number, gpt_response, image_size_bytes)
+                        VALUES (?, ?, ?, ?)
+                    """, batch)
+                logger.info(f"Wrote {len(batch)} page results")
+                return len(batch)
+            except sqlite3.OperationalError as e:
+                if any(err in str(e).lower() for err in RETRYABLE_ERRORS):
+                    attempt += 1
+                    logger.warning(f"Database locked, retry {attempt}/{MAX_RETRIES}: {e}")
+                    time.sleep(RETRY_DELAY * attempt)
+                else:
+                    logger.error(f"Non-retryable database error writing page results: {e}")
+                    break
+            except Exception as e:
+                logger.error(f"Error writing page results: {e}")
+                break
+
+        logger.error(f"Dropped {len(batch)} page results after {attempt} retries")
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "queued": self._enqueued - self._settled,
+                "written": self._settled - self._failed,
+                "failed": self._failed,
+            }
+
+
+PAGE_RESULT_WRITER = PageResultWriter()
+
+
+class PageResultsNotSaved(RuntimeError):
+    """Queued page results for a job were not committed (write failed or timed out)."""
+
+
+def flush_page_results(timeout: Optional[float] = PAGE_WRITE_FLUSH_TIMEOUT,
+                       job_ids: Optional[List[str]] = None) -> bool:
+    """
+    Block until all queued page results are committed.
+    Returns False if the writer did not catch up within timeout, or if rows
+    of *job_ids* (any job when None) could not be written.
+    """
+    ok = PAGE_RESULT_WRITER.flush(timeout, job_ids)
+    if not ok:
+        failed = PAGE_RESULT_WRITER.failed_pages(job_ids)
+        if failed:
+            logger.error(f"Page results could not be written: {failed}")
+        else:
+            logger.warning("Timed out waiting for queued page results to be written")
+    return ok
+
+
+def require_page_results_saved(job_ids: List[str],
+                               timeout: Optional[float] = PAGE_WRITE_FLUSH_TIMEOUT) -> None:
+    """
+    Flush, then raise PageResultsNotSaved unless every result queued for
+    *job_ids* is committed. Use before building output from those jobs.
+    """
+    if flush_page_results(timeout, job_ids):
+        return
+    failed = PAGE_RESULT_WRITER.failed_pages(job_ids)
+    if failed:
+        detail = "; ".join(f"job {jid} pages {pages}" for jid, pages in failed.items())
+        raise PageResultsNotSaved(f"Page results could not be saved ({detail})")
+    raise PageResultsNotSaved("Timed out waiting for page results to be saved")
+
+
+# Registered after close_db_connections, so it runs first (atexit is LIFO)
+atexit.register(flush_page_results, 10)
 
 
 def append_page_result(job_id: str, page_number: int, gpt_response: str, image_size_bytes: int = 0):
     """
-    Append a page processing result to the job's table.
+    Queue a page processing result for a job; the background writer commits it.
     
     Args:
         job_id: Unique identifier for the processing job
@@ -430,53 +944,111 @@ def append_page_result(job_id: str, page_number: int, gpt_response: str, image_s
         gpt_response: GPT response for this page
         image_size_bytes: Size of the image sent to GPT
     """
-    table_name = f"page_results_{job_id.replace('-', '_')}"
+    PAGE_RESULT_WRITER.put(job_id, int(page_number), gpt_response, image_size_bytes)
+
+
+def iter_page_results(job_id: str, batch_size: int = 200) -> Iterator[Tuple[int, str]]:
+    """
+    Stream (page_number, gpt_response) for a job in page order without
+    loading the whole result set; rows are fetched *batch_size* at a time.
+
+    Args:
+        job_id: Unique identifier for the processing job
+        batch_size: Rows per fetchmany() round trip
+    """
+    require_page_results_saved([job_id])
+    with _streaming_connection() as conn:
+        cursor = conn.execute("""
+            SELECT page_number, gpt_response
+            FROM page_results
+            WHERE job_id = ?
+            ORDER BY page_number
+        """, (job_id,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], row[1]
+
+
+def iter_batch_page_results(job_ids: List[str], batch_size: int = 200) -> Iterator[Tuple[str, int, str]]:
+    """
+    Stream (job_id, page_number, gpt_response) for several jobs, ordered by
+    position in *job_ids* and then by page, with one query per BULK_ID_BATCH ids.
+
+    Args:
+        job_ids: Jobs to read, in output order
+        batch_size: Rows per fetchmany() round trip
+    """
+    require_page_results_saved(job_ids)
+    with _streaming_connection() as conn:
+        for start in range(0, len(job_ids), BULK_ID_BATCH):
+            cte, params = _job_ids_cte(job_ids[start:start + BULK_ID_BATCH])
+            cursor = conn.execute(f"""
+                {cte}
+                SELECT ids.job_id, pr.page_number, pr.gpt_response
+                FROM ids JOIN page_results AS pr ON pr.job_id = ids.job_id
+                ORDER BY ids.ord, pr.page_number
+            """, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0], row[1], row[2]
+
+
+def count_page_results(job_id: str) -> int:
+    """
+    Count the page results stored so far for a job.
+
+    Args:
+        job_id: Unique identifier for the processing job
+    """
+    flush_page_results()
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(f"""
-            INSERT OR REPLACE INTO {table_name} 
-            (page_number, gpt_response, image_size_bytes)
-            VALUES (?, ?, ?)
-        """, (page_number, gpt_response, image_size_bytes))
-        logger.info(f"Appended page {page_number} result to {table_name}")
+        cursor.execute("SELECT COUNT(*) FROM page_results WHERE job_id = ?", (job_id,))
+        return int(cursor.fetchone()[0] or 0)
 
 
-def get_all_page_results(job_id: str) -> List[Dict[str, Any]]:
+def delete_page_results(job_id: str) -> int:
     """
-    Get all page processing results for a job, sorted by page number.
-    
+    Delete all page results for a job (one indexed DELETE on the primary key).
+
     Args:
         job_id: Unique identifier for the processing job
-        
+
     Returns:
-        List of dicts with page_number, gpt_response, image_size_bytes
+        Number of rows deleted
     """
-    table_name = f"page_results_{job_id.replace('-', '_')}"
+    # Queued rows for this job would otherwise land after the delete
+    flush_page_results()
+    PAGE_RESULT_WRITER.forget_failures(job_id)
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(f"""
-            SELECT page_number, gpt_response, image_size_bytes
-            FROM {table_name}
-            ORDER BY page_number
-        """)
-        rows = cursor.fetchall()
-        results = [{"page": row[0], "gpt_response": row[1], "image_size_bytes": row[2]} for row in rows]
-        logger.info(f"Retrieved {len(results)} page results from {table_name}")
-        return results
+        cursor.execute("DELETE FROM page_results WHERE job_id = ?", (job_id,))
+        deleted = cursor.rowcount or 0
+        logger.info(f"Deleted {deleted} page results for job {job_id}")
+        return deleted
 
 
-def delete_page_results_table(job_id: str):
+def purge_orphan_page_results() -> int:
     """
-    Delete the page results table for a specific job.
-    
-    Args:
-        job_id: Unique identifier for the processing job
+    Delete page results whose job row no longer exists (crashed or abandoned jobs).
+    Returns number of rows deleted.
     """
-    table_name = f"page_results_{job_id.replace('-', '_')}"
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-        logger.info(f"Deleted page results table: {table_name}")
+        cursor.execute("""
+            DELETE FROM page_results
+            WHERE job_id NOT IN (SELECT job_id FROM jobs)
+        """)
+        deleted = cursor.rowcount or 0
+
+    logger.info(f"purge_orphan_page_results deleted {deleted} rows")
+    return deleted
 
 
 # ----------------------------
@@ -506,12 +1078,30 @@ def init_jobs_table():
                 original_file_name TEXT,
                 file_stem TEXT,
 
-                processing_started_at TEXT
+                processing_started_at TEXT,
+
+                processing_options_json TEXT,  -- JSON string
+
+                cache_hits INTEGER DEFAULT 0,
+                cache_misses INTEGER DEFAULT 0
             )
         """)
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at DESC)
         """)
+
+        # Older databases predate some columns; add them in place
+        cols = cursor.execute("PRAGMA table_info(jobs)").fetchall()
+        colnames = {c[1] for c in cols}  # (cid, name, type, notnull, dflt, pk)
+        for colname, coltype in (
+            ("processing_options_json", "TEXT"),
+            ("cache_hits", "INTEGER DEFAULT 0"),
+            ("cache_misses", "INTEGER DEFAULT 0"),
+        ):
+            if colname not in colnames:
+                logger.warning(f"Jobs table missing {colname}, migrating")
+                cursor.execute(f"ALTER TABLE jobs ADD COLUMN {colname} {coltype}")
+
         logger.info("Jobs table initialized successfully")
 
 
@@ -526,6 +1116,7 @@ def create_job(
     output_config: Dict[str, Any],
     original_file_name: Optional[str] = None,
     file_stem: Optional[str] = None,
+    processing_options: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     """Insert a new job row."""
     attempt = 0
@@ -538,8 +1129,9 @@ def create_job(
                         job_id, file_id, model, status,
                         system_prompt, user_prompt,
                         output_config_json, selected_pages_json,
-                        original_file_name, file_stem
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        original_file_name, file_stem,
+                        processing_options_json
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     job_id,
                     file_id,
@@ -551,6 +1143,7 @@ def create_job(
                     json.dumps(sorted([int(p) for p in (selected_pages or [])])),
                     original_file_name,
                     file_stem,
+                    json.dumps(processing_options or {}),
                 ))
                 logger.info(f"Created job {job_id} for file_id={file_id}")
                 return {"success": True}
@@ -569,6 +1162,77 @@ def create_job(
     return {"success": False, "error": "Database is busy, please try again"}
 
 
+def _job_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    """Job row as dict with its JSON columns parsed (bad JSON becomes empty)."""
+    job = dict(row)
+
+    # Parse JSON fields safely
+    try:
+        job["output_config"] = json.loads(job.get("output_config_json") or "{}")
+    except Exception:
+        job["output_config"] = {}
+
+    try:
+        job["selected_pages"] = json.loads(job.get("selected_pages_json") or "[]")
+    except Exception:
+        job["selected_pages"] = []
+
+    try:
+        job["processing_options"] = json.loads(job.get("processing_options_json") or "{}")
+    except Exception:
+        job["processing_options"] = {}
+
+    return job
+
+
+# Ids bound per VALUES list; two parameters each keeps older SQLite builds
+# under their 999-variable limit
+BULK_ID_BATCH = 400
+
+
+def _job_ids_cte(job_ids: List[str]) -> Tuple[str, List[Any]]:
+    """WITH clause binding *job_ids* as ids(job_id, ord), ord being list position."""
+    values = ", ".join("(?, ?)" for _ in job_ids)
+    params: List[Any] = []
+    for ord_, job_id in enumerate(job_ids):
+        params.extend((job_id, ord_))
+    return f"WITH ids(job_id, ord) AS (VALUES {values})", params
+
+
+def get_jobs_by_ids(job_ids: List[str]) -> Dict[str, Any]:
+    """
+    Fetch many job rows at once.
+
+    Returns {"success": True, "jobs": {job_id: job}}; ids without a row are
+    simply absent.
+    """
+    unique_ids = list(dict.fromkeys(job_ids))
+    attempt = 0
+    while attempt < MAX_RETRIES:
+        try:
+            jobs: Dict[str, Dict[str, Any]] = {}
+            with get_db_connection() as conn:
+                for start in range(0, len(unique_ids), BULK_ID_BATCH):
+                    cte, params = _job_ids_cte(unique_ids[start:start + BULK_ID_BATCH])
+                    cursor = conn.execute(f"""
+                        {cte}
+                        SELECT jobs.* FROM ids JOIN jobs ON jobs.job_id = ids.job_id
+                    """, params)
+                    for row in cursor:
+                        jobs[row["job_id"]] = _job_from_row(row)
+            return {"success": True, "jobs": jobs}
+        except sqlite3.OperationalError as e:
+            if any(err in str(e).lower() for err in RETRYABLE_ERRORS):
+                attempt += 1
+                logger.warning(f"Database locked, retry {attempt}/{MAX_RETRIES}: {e}")
+                time.sleep(RETRY_DELAY * attempt)
+            else:
+                return {"success": False, "error": str(e)}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    return {"success": False, "error": "Database is busy, please try again"}
+
+
 def get_job(job_id: str) -> Dict[str, Any]:
     """Fetch a job row as dict; returns success False if not found."""
     attempt = 0
@@ -581,20 +1245,7 @@ def get_job(job_id: str) -> Dict[str, Any]:
                 if not row:
                     return {"success": False, "error": "Job not found"}
 
-                job = dict(row)
-
-                # Parse JSON fields safely
-                try:
-                    job["output_config"] = json.loads(job.get("output_config_json") or "{}")
-                except Exception:
-                    job["output_config"] = {}
-
-                try:
-                    job["selected_pages"] = json.loads(job.get("selected_pages_json") or "[]")
-                except Exception:
-                    job["selected_pages"] = []
-
-                return {"success": True, "job": job}
+                return {"success": True, "job": _job_from_row(row)}
         except sqlite3.OperationalError as e:
             if any(err in str(e).lower() for err in RETRYABLE_ERRORS):
                 attempt += 1
@@ -666,17 +1317,58 @@ def delete_job(job_id: str) -> Dict[str, Any]:
     return {"success": False, "error": "Database is busy, please try again"}
 
 
+def record_job_cache_lookup(job_id: str, hit: bool) -> Dict[str, Any]:
+    """
+    Count one GPT cache hit or miss against a job and return the running totals.
+    """
+    column = "cache_hits" if hit else "cache_misses"
+    attempt = 0
+    while attempt < MAX_RETRIES:
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"""
+                    UPDATE jobs
+                    SET {column} = COALESCE({column}, 0) + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE job_id = ?
+                """, (job_id,))
+                row = cursor.execute(
+                    "SELECT cache_hits, cache_misses FROM jobs WHERE job_id = ?", (job_id,)
+                ).fetchone()
+                if not row:
+                    return {"success": False, "error": "Job not found"}
+                return {"success": True, "cache_hits": row[0] or 0, "cache_misses": row[1] or 0}
+        except sqlite3.OperationalError as e:
+            if any(err in str(e).lower() for err in RETRYABLE_ERRORS):
+                attempt += 1
+                logger.warning(f"Database locked, retry {attempt}/{MAX_RETRIES}: {e}")
+                time.sleep(RETRY_DELAY * attempt)
+            else:
+                return {"success": False, "error": str(e)}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    return {"success": False, "error": "Database is busy, please try again"}
+
+
 from typing import Tuple
 
 def cleanup_jobs_older_than(max_age_minutes: int = 30) -> int:
     """
-    Delete job rows older than max_age_minutes based on created_at.
-    Returns number of jobs deleted.
+    Delete job rows older than max_age_minutes based on created_at, together
+    with their page results. Returns number of jobs deleted.
     """
     cutoff_expr = f"-{int(max_age_minutes)} minutes"
 
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute(
+            """
+            DELETE FROM page_results
+            WHERE job_id IN (SELECT job_id FROM jobs WHERE created_at < datetime('now', ?))
+            """,
+            (cutoff_expr,)
+        )
         cursor.execute(
             """
             DELETE FROM jobs
@@ -690,6 +1382,142 @@ def cleanup_jobs_older_than(max_age_minutes: int = 30) -> int:
     return deleted
 
 
+def list_job_file_ids() -> Set[str]:
+    """file_ids referenced by any job row, i.e. uploads still needed by a job."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT file_id FROM jobs")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def list_job_ids() -> Set[str]:
+    """job_ids of every job row still in the database."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT job_id FROM jobs")
+        return {row[0] for row in cursor.fetchall()}
+
+
+# ----------------------------
+# GPT RESPONSE CACHE
+# ----------------------------
+
+# Entries unused for longer than the TTL are ignored and purged; beyond the
+# size bound the least recently used entries go first.
+GPT_CACHE_TTL_SECONDS = int(os.getenv("GPT_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+GPT_CACHE_MAX_BYTES = int(os.getenv("GPT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+GPT_CACHE_EVICT_EVERY = 50  # run eviction once per this many inserts
+
+_gpt_cache_inserts = 0
+_gpt_cache_inserts_lock = threading.Lock()
+
+
+def init_gpt_cache_table():
+    """Initialize the gpt_response_cache table if it doesn't exist."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS gpt_response_cache (
+                cache_key TEXT PRIMARY KEY,   -- sha256 hex
+                model TEXT,
+                response TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,     -- unix seconds
+                last_accessed_at REAL NOT NULL,
+                hit_count INTEGER DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_gpt_cache_last_accessed
+            ON gpt_response_cache(last_accessed_at)
+        """)
+        logger.info("GPT response cache table initialized successfully")
+
+
+def get_cached_gpt_response(cache_key: str, ttl_seconds: int = GPT_CACHE_TTL_SECONDS) -> Optional[str]:
+    """
+    Return the cached response for cache_key (and mark it as used), or None.
+    Cache problems are logged and treated as a miss.
+    """
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute("""
+                UPDATE gpt_response_cache
+                SET last_accessed_at = ?, hit_count = hit_count + 1
+                WHERE cache_key = ? AND last_accessed_at >= ?
+            """, (now, cache_key, now - ttl_seconds))
+            if cursor.rowcount == 0:
+                return None
+            row = cursor.execute(
+                "SELECT response FROM gpt_response_cache WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.warning(f"GPT cache lookup failed: {e}")
+        return None
+
+
+def put_cached_gpt_response(cache_key: str, model: str, response: str):
+    """Store (or refresh) a response in the cache. Best-effort."""
+    global _gpt_cache_inserts
+    try:
+        now = time.time()
+        with get_db_connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO gpt_response_cache
+                (cache_key, model, response, size_bytes, created_at, last_accessed_at, hit_count)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            """, (cache_key, model, response, len(response.encode("utf-8")), now, now))
+    except sqlite3.Error as e:
+        logger.warning(f"GPT cache store failed: {e}")
+        return
+
+    with _gpt_cache_inserts_lock:
+        _gpt_cache_inserts += 1
+        due = _gpt_cache_inserts % GPT_CACHE_EVICT_EVERY == 0
+    if due:
+        evict_gpt_response_cache()
+
+
+def evict_gpt_response_cache(
+    ttl_seconds: int = GPT_CACHE_TTL_SECONDS,
+    max_bytes: int = GPT_CACHE_MAX_BYTES
+) -> int:
+    """
+    Delete expired entries, then least recently used entries until the cache
+    fits in max_bytes. Returns number of entries deleted.
+    """
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM gpt_response_cache WHERE last_accessed_at < ?",
+                (time.time() - ttl_seconds,)
+            )
+            deleted = cursor.rowcount or 0
+            cursor.execute("""
+                DELETE FROM gpt_response_cache
+                WHERE cache_key IN (
+                    SELECT cache_key FROM (
+                        SELECT cache_key,
+                               SUM(size_bytes) OVER (ORDER BY last_accessed_at DESC, cache_key) AS running_bytes
+                        FROM gpt_response_cache
+                    )
+                    WHERE running_bytes > ?
+                )
+            """, (max_bytes,))
+            deleted += cursor.rowcount or 0
+    except sqlite3.Error as e:
+        logger.warning(f"GPT cache eviction failed: {e}")
+        return 0
+
+    if deleted:
+        logger.info(f"evict_gpt_response_cache deleted {deleted} entries")
+    return deleted
+
+
 # ----------------------------
 # FEEDBACK (standalone section)
 # ----------------------------
@@ -857,5 +1685,6 @@ def save_feedback(
 
 init_prompts_table()
 init_jobs_table()
-init_feedback_table()
-cleanup_jobs_older_than(30)
\ No newline at end of file
+init_page_results_table()
+init_gpt_cache_table()
+init_feedback_table()
\ No newline at end of file
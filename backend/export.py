@@ -0,0 +1,422 @@
+"""
+Streaming XLSX export of page results.
+
+Rows come straight from a DB cursor, are cleaned and assigned to chunks in a
+single generator pass, and go into a write-only (constant-memory) openpyxl
+workbook written to a file or stream. Nothing holds the whole result set.
+
+Jobs can also build their export as pages complete: a JobExportSpool cleans
+and chunks each finished page and appends it, in page order, to a spool file,
+so writing the workbook at the end is a straight copy.
+
+Besides XLSX the same rows can be written as CSV, JSON lines or Parquet
+(zstd; needs pyarrow), all incrementally from the row stream.
+"""
+import csv
+import io
+import json
+import threading
+import unicodedata
+from bisect import bisect_left
+from contextlib import closing, nullcontext
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+from openpyxl import Workbook
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = None
+    pq = None
+
+OUTPUT_COLUMNS = [
+    "timestamp",
+    "chunk",
+    "Filename stem",
+    "Data reference",
+    "Brief description (optional)",
+    "Source (optional)",
+    "Data",
+]
+OUTPUT_SHEET_NAME = "output"
+
+# outputFormat -> (file extension, download mimetype)
+OUTPUT_FORMATS = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".csv", "text/csv"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+DEFAULT_OUTPUT_FORMAT = "xlsx"
+
+# Rows per Parquet row group (also what is held in memory while writing)
+PARQUET_ROW_GROUP_ROWS = 1000
+
+# Pages are grouped into chunks of roughly this many characters
+TARGET_CHARS_PER_CHUNK = 26140
+
+# (file_stem, original_file_name, iterable of (page_number, gpt_response))
+ExportSource = Tuple[str, str, Iterable[Tuple[int, Any]]]
+
+
+# Control characters dropped from text cells (\t \n \r are kept). All are
+# ASCII, so they can be deleted from the UTF-8 bytes with one bytes.translate
+# pass: bytes below 0x80 never occur inside a multi-byte sequence.
+_CTRL_BYTES = bytes([*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), 0x7F])
+
+
+def clean_text(text: str) -> str:
+    """
+    NFC-normalise *text* and drop control characters.
+
+    ASCII text is already NFC, so most model output only pays for the byte
+    pass (normalize() quick-checks the rest and returns NFC text unchanged).
+    """
+    if not text.isascii():
+        text = unicodedata.normalize('NFC', text)
+    raw = text.encode('utf-8', 'surrogatepass')
+    kept = raw.translate(None, _CTRL_BYTES)
+    if len(kept) == len(raw):
+        return text
+    return kept.decode('utf-8', 'surrogatepass')
+
+
+def clean_cell(x):
+    """Clean a text cell (bytes are decoded first); other values pass through."""
+    if isinstance(x, (bytes, bytearray)):
+        try:
+            x = x.decode('utf-8')
+        except Exception:
+            x = x.decode('utf-8', 'replace')
+    if isinstance(x, str):
+        x = clean_text(x)
+    return x
+
+
+def _safe_len(x) -> int:
+    try:
+        return len(x) if isinstance(x, str) else len(str(x))
+    except Exception:
+        return 0
+
+
+class ChunkCounter:
+    """
+    Greedy chunk assignment. A chunk closes before a page when closing it
+    lands nearer the target than keeping the page would.
+    """
+
+    def __init__(self, target_chars: int = TARGET_CHARS_PER_CHUNK):
+        self.target_chars = target_chars
+        self.chunk_id = 1
+        self.chunk_sum = 0
+
+    def new_file(self):
+        self.chunk_id += 1
+        self.chunk_sum = 0
+
+    def add(self, text_len: int) -> int:
+        """Place a page of *text_len* characters; returns its chunk number."""
+        if self.chunk_sum > 0 and (self.chunk_sum + text_len) > self.target_chars:
+            dist_if_break = self.target_chars - self.chunk_sum
+            dist_if_keep = (self.chunk_sum + text_len) - self.target_chars
+            if dist_if_break <= dist_if_keep:
+                self.chunk_id += 1
+                self.chunk_sum = 0
+
+        self.chunk_sum += text_len
+        return self.chunk_id
+
+
+def _output_row(processing_ts, chunk_id: int, file_stem, original_file_name, page: int, text) -> tuple:
+    # All text arguments are already cleaned
+    return (
+        processing_ts,
+        chunk_id,
+        file_stem,
+        f"p_{original_file_name}",
+        f"Page {int(page)}",
+        original_file_name,
+        text,
+    )
+
+
+def iter_export_rows(sources: Iterable[ExportSource],
+                     processing_ts: str,
+                     break_on_new_file: bool = True,
+                     target_chars: int = TARGET_CHARS_PER_CHUNK) -> Iterator[tuple]:
+    """
+    Yield cleaned output rows (in OUTPUT_COLUMNS order) with chunk numbers.
+    With *break_on_new_file* every file also starts a new chunk.
+    """
+    processing_ts = clean_cell(processing_ts)
+    chunks = ChunkCounter(target_chars)
+    prev_file_stem = None
+
+    for file_stem, original_file_name, pages in sources:
+        if break_on_new_file and prev_file_stem is not None and file_stem != prev_file_stem:
+            chunks.new_file()
+        prev_file_stem = file_stem
+        file_stem_clean = clean_cell(file_stem)
+        original_file_name_clean = clean_cell(original_file_name)
+
+        # closing(): a cursor-backed generator must be released even if we stop early
+        with closing(pages) if hasattr(pages, "close") else nullcontext(pages) as page_iter:
+            for page, text in page_iter:
+                yield _output_row(
+                    processing_ts,
+                    chunks.add(_safe_len(text)),
+                    file_stem_clean,
+                    original_file_name_clean,
+                    page,
+                    clean_cell(text),
+                )
+
+
+class JobExportSpool:
+    """
+    Running export state for one job.
+
+    Finished pages are cleaned and chunked as they arrive and appended, in page
+    order, to a JSON-lines spool of [page, chunk, text_len, text]. Pages that
+    finish ahead of a gap wait in memory until the gap is filled. A page that
+    is stored twice, or was not selected, marks the spool invalid; callers then
+    export from the database instead.
+    """
+
+    def __init__(self, spool_path: Union[str, Path], pages: Iterable[int],
+                 file_stem: str, original_file_name: str,
+                 target_chars: int = TARGET_CHARS_PER_CHUNK):
+        self.spool_path = Path(spool_path)
+        self.pages: List[int] = sorted({int(p) for p in pages})
+        self.file_stem = clean_cell(file_stem)
+        self.original_file_name = clean_cell(original_file_name)
+        self.valid = True
+        self._chunks = ChunkCounter(target_chars)
+        self._next = 0
+        self._pending: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        self.spool_path.write_text("", encoding="utf-8")
+
+    @property
+    def complete(self) -> bool:
+        return self.valid and self._next == len(self.pages)
+
+    def add(self, page: int, text: Any):
+        """Record a finished page and spool every page now in order."""
+        page = int(page)
+        with self._lock:
+            if not self.valid:
+                return
+            idx = bisect_left(self.pages, page)
+            if idx == len(self.pages) or self.pages[idx] != page or idx < self._next:
+                # Already spooled rows can't be rewritten in place
+                self._invalidate_locked()
+                return
+
+            self._pending[page] = text
+            lines = []
+            while self._next < len(self.pages) and self.pages[self._next] in self._pending:
+                p = self.pages[self._next]
+                raw = self._pending.pop(p)
+                text_len = _safe_len(raw)
+                chunk_id = self._chunks.add(text_len)
+                lines.append(json.dumps([p, chunk_id, text_len, clean_cell(raw)], ensure_ascii=False))
+                self._next += 1
+
+            if lines:
+                try:
+                    with open(self.spool_path, "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                except OSError:
+                    self._invalidate_locked()
+
+    def _invalidate_locked(self):
+        self.valid = False
+        self._pending.clear()
+
+    def iter_spooled(self) -> Iterator[Tuple[int, int, int, Any]]:
+        """(page, chunk, text_len, cleaned text) in page order."""
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    page, chunk_id, text_len, text = json.loads(line)
+                    yield page, chunk_id, text_len, text
+
+    def discard(self):
+        with self._lock:
+            self._invalidate_locked()
+            self.spool_path.unlink(missing_ok=True)
+
+
+def iter_spooled_rows(spools: Sequence[JobExportSpool],
+                      processing_ts: str,
+                      break_on_new_file: bool = False,
+                      target_chars: int = TARGET_CHARS_PER_CHUNK) -> Iterator[tuple]:
+    """
+    Output rows from complete spools. A single spool keeps the chunks assigned
+    while its pages arrived; several are re-chunked from the stored lengths
+    (no re-cleaning) so chunks can run on across files.
+    """
+    processing_ts = clean_cell(processing_ts)
+
+    if len(spools) == 1:
+        spool = spools[0]
+        for page, chunk_id, _, text in spool.iter_spooled():
+            yield _output_row(processing_ts, chunk_id, spool.file_stem, spool.original_file_name, page, text)
+        return
+
+    chunks = ChunkCounter(target_chars)
+    prev_file_stem = None
+    for spool in spools:
+        if break_on_new_file and prev_file_stem is not None and spool.file_stem != prev_file_stem:
+            chunks.new_file()
+        prev_file_stem = spool.file_stem
+        for page, _, text_len, text in spool.iter_spooled():
+            yield _output_row(
+                processing_ts, chunks.add(text_len), spool.file_stem, spool.original_file_name, page, text
+            )
+
+
+def write_xlsx(rows: Iterable[tuple], dest: Union[str, Path, BinaryIO]) -> int:
+    """
+    Write a header plus *rows* to a single-sheet XLSX at *dest* (path or
+    binary stream) using openpyxl's write-only mode. Returns the row count.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(OUTPUT_SHEET_NAME)
+    ws.append(OUTPUT_COLUMNS)
+
+    n_rows = 0
+    for row in rows:
+        ws.append(row)
+        n_rows += 1
+
+    wb.save(str(dest) if isinstance(dest, Path) else dest)
+    return n_rows
+
+
+def export_results_xlsx(sources: Iterable[ExportSource],
+                        processing_ts: str,
+                        dest: Union[str, Path, BinaryIO],
+                        break_on_new_file: bool = True) -> int:
+    """Stream *sources* into an XLSX at *dest*; returns the number of data rows."""
+    return write_xlsx(iter_export_rows(sources, processing_ts, break_on_new_file), dest)
+
+
+def export_spooled_xlsx(spools: Sequence[JobExportSpool],
+                        processing_ts: str,
+                        dest: Union[str, Path, BinaryIO],
+                        break_on_new_file: bool = False) -> int:
+    """Copy complete *spools* into an XLSX at *dest*; returns the number of data rows."""
+    return write_xlsx(iter_spooled_rows(spools, processing_ts, break_on_new_file), dest)
+
+
+def normalise_output_format(value: Any) -> str:
+    """Lower-cased outputFormat; raises ValueError for unknown formats."""
+    fmt = str(value or DEFAULT_OUTPUT_FORMAT).strip().lower().lstrip(".")
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"outputFormat must be one of: {', '.join(OUTPUT_FORMATS)}")
+    if fmt == "parquet" and pa is None:
+        raise ValueError("Parquet output requires pyarrow, which is not installed")
+    return fmt
+
+
+def output_extension(output_format: str) -> str:
+    return OUTPUT_FORMATS[output_format][0]
+
+
+def _open_dest(dest: Union[str, Path, BinaryIO]):
+    if isinstance(dest, (str, Path)):
+        return open(dest, "wb")
+    return nullcontext(dest)
+
+
+def write_csv(rows: Iterable[tuple], dest: Union[str, Path, BinaryIO]) -> int:
+    """Write a header plus *rows* as UTF-8 CSV. Returns the row count."""
+    n_rows = 0
+    with _open_dest(dest) as raw:
+        text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        try:
+            writer = csv.writer(text)
+            writer.writerow(OUTPUT_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                n_rows += 1
+        finally:
+            # Leave a caller's stream open
+            text.flush()
+            text.detach()
+    return n_rows
+
+
+def write_jsonl(rows: Iterable[tuple], dest: Union[str, Path, BinaryIO]) -> int:
+    """Write one JSON object per row, keyed by OUTPUT_COLUMNS. Returns the row count."""
+    n_rows = 0
+    with _open_dest(dest) as raw:
+        for row in rows:
+            line = json.dumps(dict(zip(OUTPUT_COLUMNS, row)), ensure_ascii=False)
+            raw.write(line.encode("utf-8") + b"\n")
+            n_rows += 1
+    return n_rows
+
+
+def _parquet_schema():
+    return pa.schema([
+        pa.field(name, pa.int64() if name == "chunk" else pa.string())
+        for name in OUTPUT_COLUMNS
+    ])
+
+
+def _parquet_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+def write_parquet(rows: Iterable[tuple], dest: Union[str, Path, BinaryIO]) -> int:
+    """
+    Write *rows* as zstd-compressed Parquet, one row group per
+    PARQUET_ROW_GROUP_ROWS rows. Returns the row count.
+    """
+    if pa is None:
+        raise RuntimeError("Parquet output requires pyarrow, which is not installed")
+
+    schema = _parquet_schema()
+    chunk_col = OUTPUT_COLUMNS.index("chunk")
+    n_rows = 0
+    with _open_dest(dest) as raw:
+        with pq.ParquetWriter(raw, schema, compression="zstd") as writer:
+            columns: List[list] = [[] for _ in OUTPUT_COLUMNS]
+
+            def _flush():
+                writer.write_batch(pa.record_batch(columns, schema=schema))
+                for col in columns:
+                    col.clear()
+
+            for row in rows:
+                for i, value in enumerate(row):
+                    columns[i].append(int(value) if i == chunk_col else _parquet_value(value))
+                n_rows += 1
+                if n_rows % PARQUET_ROW_GROUP_ROWS == 0:
+                    _flush()
+            if columns[0] or n_rows == 0:
+                _flush()
+    return n_rows
+
+
+_WRITERS = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+    "jsonl": write_jsonl,
+    "parquet": write_parquet,
+}
+
+
+def write_rows(rows: Iterable[tuple], dest: Union[str, Path, BinaryIO], output_format: str = DEFAULT_OUTPUT_FORMAT) -> int:
+    """Write *rows* to *dest* in *output_format*; returns the number of data rows."""
+    return _WRITERS[output_format](rows, dest)
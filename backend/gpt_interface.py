@@ -1,10 +1,17 @@
-from openai import OpenAI, BadRequestError, APITimeoutError
+from openai import OpenAI, AsyncOpenAI, BadRequestError, APITimeoutError, RateLimitError
 import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from mimetypes import guess_type
 import base64
-from typing import List
+from typing import List, Dict, Any, Optional
 import httpx
 import io
+import asyncio
+import threading
+import weakref
 
 subscription_key = os.getenv("OPENAI_API_KEY")
 
@@ -17,6 +24,379 @@ client = OpenAI(
     timeout=httpx.Timeout(90.0, read=60.0, write=60.0, pool=60.0)
 )
 
+# Upper bound on async GPT requests in flight per event loop
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", "64"))
+
+# AsyncOpenAI clients and semaphores are bound to the loop they first run on
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_ASYNC_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def _get_async_client() -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    async_client = _ASYNC_CLIENTS.get(loop)
+    if async_client is None:
+        async_client = AsyncOpenAI(
+            base_url=endpoint,
+            api_key=subscription_key,
+            max_retries=0,
+            timeout=httpx.Timeout(90.0, read=60.0, write=60.0, pool=60.0),
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=GPT_MAX_CONCURRENCY, max_keepalive_connections=GPT_MAX_CONCURRENCY)
+            ),
+        )
+        _ASYNC_CLIENTS[loop] = async_client
+    return async_client
+
+
+def _get_gpt_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _ASYNC_SEMAPHORES.get(loop)
+    if sem is None:
+        sem = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+        _ASYNC_SEMAPHORES[loop] = sem
+    return sem
+
+
+# One long-lived event loop shared by every caller in the process, so that the
+# global semaphore and the pooled HTTP connections are shared too.
+_GPT_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_GPT_LOOP_LOCK = threading.Lock()
+
+
+def _get_gpt_loop() -> asyncio.AbstractEventLoop:
+    global _GPT_LOOP
+    with _GPT_LOOP_LOCK:
+        if _GPT_LOOP is None or _GPT_LOOP.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="gpt-event-loop", daemon=True).start()
+            _GPT_LOOP = loop
+        return _GPT_LOOP
+
+
+def run_on_gpt_loop(coro, timeout: Optional[float] = None):
+    """
+    Run *coro* on the shared GPT event loop from synchronous code and block
+    until it finishes.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _get_gpt_loop())
+    return future.result(timeout=timeout)
+
+
+# -----------------------------------------------------------------------------
+# Rate-limit-aware scheduling
+#
+# Every chat completion goes through _create_chat_completion /
+# _acreate_chat_completion, which wait on RATE_LIMITER before sending. The
+# limiter keeps per-model token buckets for requests/min and tokens/min,
+# recalibrates them from the x-ratelimit-* response headers and adjusts the
+# number of requests in flight with AIMD (+1 per window of successes, halved
+# on a 429). A 429 is queued again after retry-after instead of failing.
+# -----------------------------------------------------------------------------
+
+GPT_RPM_LIMIT = int(os.getenv("GPT_RPM_LIMIT", "300"))
+GPT_TPM_LIMIT = int(os.getenv("GPT_TPM_LIMIT", "300000"))
+GPT_INITIAL_CONCURRENCY = int(os.getenv("GPT_INITIAL_CONCURRENCY", "8"))
+# Give up on a request that has been rate limited for longer than this
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "600"))
+
+# Longest a request waits for a free slot before re-checking the buckets
+SLOT_WAIT_SECONDS = 5.0
+
+# Rough request cost used before the real usage is known
+ESTIMATED_TOKENS_PER_IMAGE = 1500
+ESTIMATED_COMPLETION_TOKENS = 1000
+
+
+@dataclass
+class _ModelBudget:
+    rpm_limit: float
+    tpm_limit: float
+    requests_available: float
+    tokens_available: float
+    concurrency: float
+    refilled_at: float = field(default_factory=time.monotonic)
+    blocked_until: float = 0.0
+    in_flight: int = 0
+    rate_limited_count: int = 0
+    completed_count: int = 0
+
+
+def _wake_waiter(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RateLimitScheduler:
+    """Token-bucket + AIMD admission control for GPT requests, per model."""
+
+    def __init__(self, rpm_limit: int, tpm_limit: int, initial_concurrency: int, max_concurrency: int):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self._budgets: Dict[str, _ModelBudget] = {}
+        self._lock = threading.Lock()
+        # Waiters are woken whenever a slot is released instead of polling for one
+        self._released = threading.Condition(self._lock)
+        self._async_waiters: List[asyncio.Future] = []
+
+    def _budget(self, model: str) -> _ModelBudget:
+        budget = self._budgets.get(model)
+        if budget is None:
+            budget = _ModelBudget(
+                rpm_limit=self.rpm_limit,
+                tpm_limit=self.tpm_limit,
+                requests_available=self.rpm_limit,
+                tokens_available=self.tpm_limit,
+                concurrency=min(self.initial_concurrency, self.max_concurrency),
+            )
+            self._budgets[model] = budget
+        return budget
+
+    @staticmethod
+    def _refill(budget: _ModelBudget, now: float) -> None:
+        elapsed = now - budget.refilled_at
+        if elapsed > 0:
+            budget.requests_available = min(budget.rpm_limit, budget.requests_available + elapsed * budget.rpm_limit / 60.0)
+            budget.tokens_available = min(budget.tpm_limit, budget.tokens_available + elapsed * budget.tpm_limit / 60.0)
+            budget.refilled_at = now
+
+    def try_acquire(self, model: str, est_tokens: int) -> float:
+        """Reserve capacity for one request; returns 0 on success, else seconds to wait."""
+        with self._lock:
+            return self._try_acquire_locked(model, est_tokens)
+
+    def _try_acquire_locked(self, model: str, est_tokens: int) -> float:
+        budget = self._budget(model)
+        now = time.monotonic()
+        self._refill(budget, now)
+
+        if now < budget.blocked_until:
+            return budget.blocked_until - now
+        if budget.in_flight >= max(1, int(budget.concurrency)):
+            # Woken early by release(); the timeout is only a safety net
+            return SLOT_WAIT_SECONDS
+        # A single request larger than the whole bucket may go once the bucket is full
+        needed_tokens = min(est_tokens, budget.tpm_limit)
+        if budget.requests_available < 1:
+            return (1 - budget.requests_available) * 60.0 / budget.rpm_limit
+        if budget.tokens_available < needed_tokens:
+            return (needed_tokens - budget.tokens_available) * 60.0 / budget.tpm_limit
+
+        budget.requests_available -= 1
+        budget.tokens_available -= needed_tokens
+        budget.in_flight += 1
+        return 0.0
+
+    def acquire(self, model: str, est_tokens: int) -> None:
+        with self._released:
+            while True:
+                wait = self._try_acquire_locked(model, est_tokens)
+                if wait <= 0:
+                    return
+                self._released.wait(min(wait, SLOT_WAIT_SECONDS))
+
+    async def aacquire(self, model: str, est_tokens: int) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._try_acquire_locked(model, est_tokens)
+                if wait <= 0:
+                    return
+                # Registered under the lock, so a release cannot slip in before we wait
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=min(wait, SLOT_WAIT_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def release(self, model: str) -> None:
+        """Give back the slot taken by acquire(); call once per admitted request, however it ended."""
+        with self._lock:
+            budget = self._budget(model)
+            budget.in_flight = max(0, budget.in_flight - 1)
+            self._wake_waiters_locked()
+
+    def _wake_waiters_locked(self) -> None:
+        self._released.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for waiter in waiters:
+            try:
+                waiter.get_loop().call_soon_threadsafe(_wake_waiter, waiter)
+            except RuntimeError:
+                # The waiter's loop has been closed
+                pass
+
+    def on_success(self, model: str, est_tokens: int, used_tokens: Optional[int] = None, headers=None) -> None:
+        with self._lock:
+            budget = self._budget(model)
+            budget.completed_count += 1
+            # Additive increase: one extra slot per window's worth of successes
+            budget.concurrency = min(self.max_concurrency, budget.concurrency + 1.0 / max(1.0, budget.concurrency))
+            if used_tokens is not None:
+                # Give back (or charge) the difference between the estimate and reality
+                budget.tokens_available = min(budget.tpm_limit, budget.tokens_available + est_tokens - used_tokens)
+            if headers is not None:
+                self._calibrate(budget, headers)
+
+    def on_rate_limited(self, model: str, retry_after: float, headers=None) -> None:
+        with self._lock:
+            budget = self._budget(model)
+            budget.rate_limited_count += 1
+            # Multiplicative decrease
+            budget.concurrency = max(1.0, budget.concurrency / 2.0)
+            budget.blocked_until = max(budget.blocked_until, time.monotonic() + retry_after)
+            if headers is not None:
+                self._calibrate(budget, headers)
+
+    @staticmethod
+    def _calibrate(budget: _ModelBudget, headers) -> None:
+        """Trust the server's view of the remaining quota over our own."""
+        limit_requests = _header_number(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _header_number(headers, "x-ratelimit-limit-tokens")
+        if limit_requests:
+            budget.rpm_limit = limit_requests
+        if limit_tokens:
+            budget.tpm_limit = limit_tokens
+
+        remaining_requests = _header_number(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            budget.requests_available = min(budget.requests_available, remaining_requests)
+        if remaining_tokens is not None:
+            budget.tokens_available = min(budget.tokens_available, remaining_tokens)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                model: {
+                    "rpm_limit": b.rpm_limit,
+                    "tpm_limit": b.tpm_limit,
+                    "requests_available": round(b.requests_available, 2),
+                    "tokens_available": round(b.tokens_available),
+                    "concurrency": round(b.concurrency, 2),
+                    "in_flight": b.in_flight,
+                    "blocked_for_seconds": round(max(0.0, b.blocked_until - now), 2),
+                    "rate_limited_count": b.rate_limited_count,
+                    "completed_count": b.completed_count,
+                }
+                for model, b in self._budgets.items()
+            }
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    try:
+        value = headers.get(name)
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after_seconds(headers, attempt: int) -> float:
+    """Seconds to wait after a 429, from retry-after-ms / retry-after, else exponential backoff."""
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return max(0.0, retry_after_ms / 1000.0)
+    retry_after = _header_number(headers, "retry-after")
+    if retry_after is not None:
+        return max(0.0, retry_after)
+    raw = headers.get("retry-after") if headers is not None else None
+    if raw:
+        try:
+            return max(0.0, (parsedate_to_datetime(raw) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return min(60.0, 2.0 ** attempt)
+
+
+def _estimate_request_tokens(messages: List[Dict[str, Any]]) -> int:
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    images += 1
+                else:
+                    chars += len(part.get("text") or "")
+    return chars // 4 + images * ESTIMATED_TOKENS_PER_IMAGE + ESTIMATED_COMPLETION_TOKENS
+
+
+def _used_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+RATE_LIMITER = RateLimitScheduler(
+    rpm_limit=GPT_RPM_LIMIT,
+    tpm_limit=GPT_TPM_LIMIT,
+    initial_concurrency=GPT_INITIAL_CONCURRENCY,
+    max_concurrency=GPT_MAX_CONCURRENCY,
+)
+
+
+def _create_chat_completion(**params):
+    """client.chat.completions.create, admitted by RATE_LIMITER and re-queued on 429."""
+    model = params["model"]
+    est_tokens = _estimate_request_tokens(params["messages"])
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        RATE_LIMITER.acquire(model, est_tokens)
+        try:
+            raw = client.chat.completions.with_raw_response.create(**params)
+            response = raw.parse()
+        except RateLimitError as e:
+            attempt += 1
+            retry_after = _retry_after_seconds(e.response.headers, attempt)
+            RATE_LIMITER.on_rate_limited(model, retry_after, e.response.headers)
+            if time.monotonic() - started + retry_after > RATE_LIMIT_MAX_WAIT_SECONDS:
+                raise
+            print(f"Rate limited on {model}, re-queueing in {retry_after:.1f}s (attempt {attempt})")
+            continue
+        else:
+            RATE_LIMITER.on_success(model, est_tokens, _used_tokens(response), raw.headers)
+            return response
+        finally:
+            RATE_LIMITER.release(model)
+
+
+async def _acreate_chat_completion(**params):
+    """Async twin of _create_chat_completion; also holds the per-loop GPT semaphore."""
+    model = params["model"]
+    est_tokens = _estimate_request_tokens(params["messages"])
+    started = time.monotonic()
+    attempt = 0
+    async with _get_gpt_semaphore():
+        while True:
+            await RATE_LIMITER.aacquire(model, est_tokens)
+            try:
+                raw = await _get_async_client().chat.completions.with_raw_response.create(**params)
+                response = raw.parse()
+            except RateLimitError as e:
+                attempt += 1
+                retry_after = _retry_after_seconds(e.response.headers, attempt)
+                RATE_LIMITER.on_rate_limited(model, retry_after, e.response.headers)
+                if time.monotonic() - started + retry_after > RATE_LIMIT_MAX_WAIT_SECONDS:
+                    raise
+                print(f"Rate limited on {model}, re-queueing in {retry_after:.1f}s (attempt {attempt})")
+                continue
+            else:
+                RATE_LIMITER.on_success(model, est_tokens, _used_tokens(response), raw.headers)
+                return response
+            finally:
+                RATE_LIMITER.release(model)
+
 def _reduce_image_size_by_half(data_url: str) -> str:
     """
     Reduce an image data URL by ~50% in both dimensions.
@@ -82,7 +462,7 @@ def get_response_from_chatgpt_simple(system_prompt: str, user_prompt: str, model
     else:
         temperature = 0
     
-    response = client.chat.completions.create(
+    response = _create_chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -101,7 +481,7 @@ def get_response_from_chatgpt_with_functions(user_prompt: str, system_prompt: st
         used_temperature = 1
     else:
         used_temperature = temperature
-    response = client.chat.completions.create(
+    response = _create_chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -114,15 +494,18 @@ def get_response_from_chatgpt_with_functions(user_prompt: str, system_prompt: st
     return response.choices[0].message.tool_calls[0].function.arguments
 
 
+def image_bytes_to_data_url(image_bytes: bytes, mime_type: str = 'image/png') -> str:
+    base64_encoded_data = base64.b64encode(image_bytes).decode('utf-8')
+    return f"data:{mime_type};base64,{base64_encoded_data}"
+
+
 def local_image_to_data_url(image_path: str) -> str:
     mime_type, _ = guess_type(image_path)
     if mime_type is None:
         mime_type = 'application/octet-stream'
 
     with open(image_path, "rb") as image_file:
-        base64_encoded_data = base64.b64encode(image_file.read()).decode('utf-8')
-
-    return f"data:{mime_type};base64,{base64_encoded_data}"
+        return image_bytes_to_data_url(image_file.read(), mime_type)
 
 
 def get_response_from_chatgpt_image(system_prompt: str, user_prompt: str, image_path: str, model: str, pre_compiled_image = None) -> str:
@@ -156,7 +539,7 @@ def get_response_from_chatgpt_image(system_prompt: str, user_prompt: str, image_
                 "temperature": temperature
             }
             
-            response = client.chat.completions.create(**create_params)
+            response = _create_chat_completion(**create_params)
             return response.choices[0].message.content
         except (APITimeoutError, httpx.TimeoutException) as e:
             if attempt < max_retries - 1:
@@ -182,7 +565,7 @@ def get_response_from_chatgpt_image_and_functions(system_prompt: str, user_promp
         temperature = 0
     for attempt in range(max_retries):
         try:
-            response = client.chat.completions.create(
+            response = _create_chat_completion(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -238,7 +621,7 @@ def get_response_from_chatgpt_multiple_image_and_functions(
                     "image_url": {"url": image_data_url}
                 })
 
-            response = client.chat.completions.create(
+            response = _create_chat_completion(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -282,7 +665,7 @@ def get_response_from_chatgpt_multiple_image(
                     "image_url": {"url": image_data_url}
                 })
 
-            response = client.chat.completions.create(
+            response = _create_chat_completion(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -299,6 +682,135 @@ def get_response_from_chatgpt_multiple_image(
                 raise Exception(f"Failed after {max_retries} retries with timeout: {e}")
 
 
+# -----------------------------------------------------------------------------
+# Async twins (AsyncOpenAI). Same arguments and return values as the blocking
+# functions above; requests go through _acreate_chat_completion.
+# -----------------------------------------------------------------------------
+
+async def aget_response_from_chatgpt_with_functions(user_prompt: str, system_prompt: str, model: str, temperature: float, function_name: str, functions: List) -> str:
+    if client is None:
+        return "API key not available"
+
+    if model in ('gpt-5', 'gpt-5.1-chat'):
+        used_temperature = 1
+    else:
+        used_temperature = temperature
+    response = await _acreate_chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=used_temperature,
+        tools=functions,
+        tool_choice={"type": "function", "function": {"name": function_name}}
+    )
+    return response.choices[0].message.tool_calls[0].function.arguments
+
+
+async def aget_response_from_chatgpt_image(system_prompt: str, user_prompt: str, image_path: str, model: str, pre_compiled_image = None) -> str:
+    if client is None:
+        return "API key not available"
+
+    if pre_compiled_image is not None:
+        image_data_url = pre_compiled_image
+    else:
+        image_data_url = local_image_to_data_url(image_path)
+
+    max_retries = 1
+    if model in ('gpt-5', 'gpt-5.1-chat'):
+        temperature = 1
+    else:
+        temperature = 0
+    for attempt in range(max_retries):
+        try:
+            response = await _acreate_chat_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": user_prompt},
+                            {"type": "image_url", "image_url": {"url" : image_data_url}}
+                        ]
+                    }
+                ],
+                temperature=temperature
+            )
+            return response.choices[0].message.content
+        except (APITimeoutError, httpx.TimeoutException) as e:
+            if attempt < max_retries - 1:
+                print(f"Timeout on attempt {attempt + 1}, reducing image size by 50% and retrying...")
+                image_data_url = await asyncio.to_thread(_reduce_image_size_by_half, image_data_url)
+            else:
+                raise Exception(f"Failed after {max_retries} retries with timeout: {e}")
+
+
+async def aget_response_from_chatgpt_image_and_functions(system_prompt: str, user_prompt: str, image_path: str, model: str, functions: List, function_name: str, pre_compiled_image = None) -> str:
+    if pre_compiled_image is None:
+        pre_compiled_image = local_image_to_data_url(image_path)
+    return await aget_response_from_chatgpt_multiple_image_and_functions(
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        image_paths=[image_path],
+        model=model,
+        functions=functions,
+        function_name=function_name,
+        pre_compiled_images=[pre_compiled_image]
+    )
+
+
+async def aget_response_from_chatgpt_multiple_image_and_functions(
+    system_prompt: str,
+    user_prompt: str,
+    image_paths: List,
+    model: str,
+    functions: List,
+    function_name: str,
+    pre_compiled_images=None
+) -> str:
+    if client is None:
+        return "API key not available"
+
+    if pre_compiled_images is not None:
+        image_data_urls = pre_compiled_images
+    else:
+        image_data_urls = [local_image_to_data_url(path) for path in image_paths]
+
+    max_retries = 1
+    if model in ('gpt-5', 'gpt-5.1-chat'):
+        temperature = 1
+    else:
+        temperature = 0
+    for attempt in range(max_retries):
+        try:
+            content = [{"type": "text", "text": user_prompt}]
+            for image_data_url in image_data_urls:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {"url": image_data_url}
+                })
+
+            response = await _acreate_chat_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                temperature=temperature,
+                tools=functions,
+                tool_choice={"type": "function", "function": {"name": function_name}}
+            )
+            return response.choices[0].message.tool_calls[0].function.arguments
+        except (APITimeoutError, httpx.TimeoutException) as e:
+            if attempt < max_retries - 1:
+                print(f"Timeout on attempt {attempt + 1}, reducing all images by 50% and retrying...")
+                image_data_urls = [await asyncio.to_thread(_reduce_image_size_by_half, url) for url in image_data_urls]
+            else:
+                raise Exception(f"Failed after {max_retries} retries with timeout: {e}")
+
+
 def get_markdown_schema():
     """
     Returns a schema that demands a single markdown string response.
@@ -325,15 +837,16 @@ def get_markdown_schema():
     ]
 
 
-def get_embedding(text: str, model = "text-embedding-3-large"):
+def get_embedding(text: str, model = "text-embedding-3-large", dimensions: Optional[int] = None):
     if client is None:
         return []
     
+    params = {"model": model, "input": text}
+    if dimensions:
+        # text-embedding-3 models can return shortened vectors
+        params["dimensions"] = dimensions
     try:
-        response = client.embeddings.create(
-            model=model,
-            input=text
-        )
+        response = client.embeddings.create(**params)
     except BadRequestError:
         return []
 
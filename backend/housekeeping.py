@@ -0,0 +1,146 @@
+"""
+Periodic maintenance on one background thread.
+
+Tasks are registered with an interval; the thread sleeps until the next one
+is due, runs it and records per-task stats (last run, duration, result,
+error) for the stats endpoint. Nothing runs until start() is called, so
+importing this module (e.g. in a spawned render worker) is inert.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on one sleep, so newly added tasks are picked up promptly
+_MAX_SLEEP_SECONDS = 60.0
+
+
+@dataclass
+class HousekeepingTask:
+    name: str
+    interval_seconds: float
+    fn: Callable[[], Any]
+    next_due: float = 0.0  # time.monotonic()
+    runs: int = 0
+    failures: int = 0
+    last_started_at: Optional[str] = None
+    last_duration_ms: Optional[float] = None
+    last_result: Any = None
+    last_error: Optional[str] = None
+
+
+class Housekeeper:
+    """Runs registered maintenance tasks at their intervals on one daemon thread."""
+
+    def __init__(self, name: str = "housekeeping"):
+        self.name = name
+        self._tasks: Dict[str, HousekeepingTask] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def add_task(self, name: str, interval_seconds: float, fn: Callable[[], Any],
+                 run_at_start: bool = True) -> None:
+        """Register *fn* to run every *interval_seconds*; <= 0 disables the task."""
+        if interval_seconds <= 0:
+            logger.info(f"Housekeeping task {name} disabled")
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._tasks[name] = HousekeepingTask(
+                name=name,
+                interval_seconds=float(interval_seconds),
+                fn=fn,
+                next_due=now if run_at_start else now + interval_seconds,
+            )
+        self._wake.set()
+
+    def start(self) -> bool:
+        """Start the thread if it is not running; returns whether it was started."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._started_at = datetime.now().isoformat(timespec="seconds")
+            self._thread.start()
+        logger.info(f"Housekeeping started with {len(self._tasks)} tasks")
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def run_now(self) -> None:
+        """Make every task due immediately."""
+        with self._lock:
+            for task in self._tasks.values():
+                task.next_due = 0.0
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = [t for t in self._tasks.values() if t.next_due <= now]
+            for task in due:
+                if self._stopping.is_set():
+                    return
+                self._run_task(task)
+
+            with self._lock:
+                next_due = min((t.next_due for t in self._tasks.values()), default=now + _MAX_SLEEP_SECONDS)
+            self._wake.wait(timeout=min(_MAX_SLEEP_SECONDS, max(0.0, next_due - time.monotonic())))
+            self._wake.clear()
+
+    def _run_task(self, task: HousekeepingTask) -> None:
+        started_at = datetime.now().isoformat(timespec="seconds")
+        t0 = time.monotonic()
+        result, error = None, None
+        try:
+            result = task.fn()
+        except Exception as e:
+            logger.exception(f"Housekeeping task {task.name} failed")
+            error = str(e)
+        duration_ms = round((time.monotonic() - t0) * 1000, 1)
+
+        with self._lock:
+            task.runs += 1
+            task.failures += int(error is not None)
+            task.last_started_at = started_at
+            task.last_duration_ms = duration_ms
+            task.last_result = result
+            task.last_error = error
+            task.next_due = time.monotonic() + task.interval_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            tasks = {
+                t.name: {
+                    "interval_seconds": t.interval_seconds,
+                    "runs": t.runs,
+                    "failures": t.failures,
+                    "last_started_at": t.last_started_at,
+                    "last_duration_ms": t.last_duration_ms,
+                    "last_result": t.last_result,
+                    "last_error": t.last_error,
+                    "next_run_in_seconds": round(max(0.0, t.next_due - now), 1),
+                }
+                for t in self._tasks.values()
+            }
+        return {"running": self.running, "started_at": self._started_at, "tasks": tasks}
@@ -25,6 +25,13 @@ class JobState:
     traceback: Optional[str] = None
     rows_processed: int = 0
     total_files: int = 0
+    pages_total: int = 0
+    pages_done: int = 0
+    pages_failed: int = 0
+    pages_blank: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    result: Optional[Dict[str, Any]] = None   # final payload once DONE
     created_at: datetime = field(default_factory=datetime.now)
     so_far_csv_name: str = ""
     messages: List[Message] = field(default_factory=list)
\ No newline at end of file
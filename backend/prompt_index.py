@@ -0,0 +1,180 @@
+"""
+In-memory similarity index over saved prompt embeddings.
+
+Each prompt is embedded once when it is saved; vectors are stored as float32
+blobs in prompt_embeddings and loaded into one L2-normalised NumPy matrix on
+first use. Saves and deletes update the matrix in place, so a semantic query
+is one embedding call (none for "like this prompt") plus a matrix-vector
+product.
+"""
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.database import (
+    save_prompt_embedding,
+    load_prompt_embeddings,
+    list_prompts_missing_embeddings,
+)
+
+logger = logging.getLogger(__name__)
+
+PROMPT_EMBEDDING_MODEL = os.getenv("PROMPT_EMBEDDING_MODEL", "text-embedding-3-large")
+# Shortened text-embedding-3 vectors keep the matrix small (4 KiB per prompt at 1024)
+PROMPT_EMBEDDING_DIMENSIONS = int(os.getenv("PROMPT_EMBEDDING_DIMENSIONS", "1024"))
+
+_PROMPT_TEXT_FIELDS = (
+    ("Name", "name"),
+    ("Description", "description"),
+    ("Tags", "tags"),
+    ("Role", "role_prompt"),
+    ("Task", "task_prompt"),
+    ("Context", "context_prompt"),
+    ("Format", "format_prompt"),
+    ("Constraints", "constraints_prompt"),
+)
+
+
+def prompt_embedding_text(prompt: Dict[str, Any]) -> str:
+    """The text a saved prompt is embedded as (labelled, non-empty fields only)."""
+    parts = []
+    for label, key in _PROMPT_TEXT_FIELDS:
+        value = (prompt.get(key) or "").strip()
+        if value:
+            parts.append(f"{label}: {value}")
+    return "\n".join(parts)
+
+
+def _normalise(vec) -> Optional[np.ndarray]:
+    arr = np.asarray(vec, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(arr))
+    if arr.size == 0 or norm == 0.0:
+        return None
+    return arr / norm
+
+
+class PromptEmbeddingIndex:
+    """
+    Thread-safe matrix of unit vectors with an id <-> row mapping.
+
+    Rows live in a preallocated buffer that doubles when full; removing a
+    prompt moves the last row into its slot, so add/remove are O(dim).
+    """
+
+    def __init__(self, embed_fn: Callable[[str], List[float]], model: str = PROMPT_EMBEDDING_MODEL):
+        self.embed_fn = embed_fn
+        self.model = model
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: List[int] = []
+        self._row_of: Dict[int, int] = {}
+
+    # -- storage ---------------------------------------------------------
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            rows = load_prompt_embeddings(self.model)
+            for prompt_id, dim, blob in rows:
+                vec = np.frombuffer(blob, dtype=np.float32)
+                if vec.size == dim:
+                    self._put_locked(prompt_id, vec)
+            self._loaded = True
+            logger.info(f"Loaded {len(self._ids)} prompt embeddings ({self.model})")
+
+    def _put_locked(self, prompt_id: int, unit_vec: np.ndarray):
+        if self._matrix is None:
+            self._matrix = np.empty((64, unit_vec.size), dtype=np.float32)
+        if unit_vec.size != self._matrix.shape[1]:
+            # Vectors from another dimension setting can't share the matrix
+            return
+        row = self._row_of.get(prompt_id)
+        if row is None:
+            row = len(self._ids)
+            if row == self._matrix.shape[0]:
+                grown = np.empty((row * 2, self._matrix.shape[1]), dtype=np.float32)
+                grown[:row] = self._matrix[:row]
+                self._matrix = grown
+            self._ids.append(prompt_id)
+            self._row_of[prompt_id] = row
+        self._matrix[row] = unit_vec
+
+    # -- updates ---------------------------------------------------------
+    def embed_prompt(self, prompt: Dict[str, Any]) -> bool:
+        """Embed a saved prompt, persist the vector and add it to the index."""
+        vec = _normalise(self.embed_fn(prompt_embedding_text(prompt)))
+        if vec is None:
+            logger.warning(f"No embedding for prompt {prompt.get('id')}")
+            return False
+        save_prompt_embedding(int(prompt["id"]), self.model, vec.tobytes(), int(vec.size))
+        if self._loaded:
+            with self._lock:
+                self._put_locked(int(prompt["id"]), vec)
+        return True
+
+    def remove(self, prompt_id: int):
+        """Drop a prompt from the index (its DB row goes with the prompt)."""
+        with self._lock:
+            row = self._row_of.pop(int(prompt_id), None)
+            if row is None:
+                return
+            last = len(self._ids) - 1
+            if row != last:
+                moved_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved_id
+                self._row_of[moved_id] = row
+            self._ids.pop()
+
+    def backfill(self, limit: int = 100) -> int:
+        """Embed up to *limit* prompts saved before embeddings existed."""
+        done = 0
+        for prompt in list_prompts_missing_embeddings(self.model, limit):
+            done += int(self.embed_prompt(prompt))
+        return done
+
+    # -- queries ---------------------------------------------------------
+    def vector_for(self, prompt_id: int) -> Optional[np.ndarray]:
+        self._ensure_loaded()
+        with self._lock:
+            row = self._row_of.get(int(prompt_id))
+            return None if row is None else self._matrix[row].copy()
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        return _normalise(self.embed_fn(text))
+
+    def top_k(self, query_vec: np.ndarray, k: int = 20,
+              exclude: Optional[int] = None) -> List[Tuple[int, float]]:
+        """[(prompt_id, cosine similarity)] for the k nearest prompts, best first."""
+        self._ensure_loaded()
+        with self._lock:
+            n = len(self._ids)
+            if n == 0 or query_vec is None or query_vec.size != self._matrix.shape[1]:
+                return []
+            scores = self._matrix[:n] @ query_vec
+            ids = list(self._ids)
+            excluded_row = self._row_of.get(int(exclude)) if exclude is not None else None
+
+        if excluded_row is not None:
+            scores[excluded_row] = -np.inf
+        k = max(0, min(k, n))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": self._loaded,
+                "model": self.model,
+                "count": len(self._ids),
+                "dim": None if self._matrix is None else int(self._matrix.shape[1]),
+            }
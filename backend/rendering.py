@@ -0,0 +1,508 @@
+"""
+Page rasterization and image encoding for GPT.
+
+Rendering (PyMuPDF) and encoding (Pillow) are CPU-bound and hold the GIL, so
+RENDER_SERVICE runs them in a pool of worker processes. Each worker keeps a
+small cache of open documents so consecutive pages of the same PDF don't
+re-parse it. This module is imported by those workers: keep it free of Flask,
+database and GPT imports.
+"""
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import CancelledError as FuturesCancelled, ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import fitz
+
+logger = logging.getLogger(__name__)
+
+
+# Largest image we send to GPT for one page
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+IMAGE_FORMATS = ("png", "jpeg", "webp", "auto")
+_IMAGE_MIME = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Worker processes for page rendering; 0 renders on the calling thread
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# Longest a page may take on a worker; a slower (hung) worker pool is recycled
+RENDER_TIMEOUT_SECONDS = float(os.getenv("RENDER_TIMEOUT_SECONDS", "60"))
+# Open documents kept per worker process
+RENDER_WORKER_DOC_CACHE = int(os.getenv("RENDER_WORKER_DOC_CACHE", "8"))
+# Open documents kept in this process (DOCUMENT_CACHE), and how long they may sit unused
+OPEN_DOC_CACHE_SIZE = int(os.getenv("OPEN_DOC_CACHE_SIZE", "16"))
+OPEN_DOC_IDLE_SECONDS = int(os.getenv("OPEN_DOC_IDLE_SECONDS", "300"))
+
+
+def _encode_pil(img, fmt: str, quality: int) -> bytes:
+    buf = BytesIO()
+    if fmt == "png":
+        img.save(buf, format="PNG", compress_level=6)
+    elif fmt == "jpeg":
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+    else:
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    return buf.getvalue()
+
+
+def encode_pixmap_to_budget(pix,
+                            image_format: str = "png",
+                            max_bytes: int = MAX_IMAGE_BYTES,
+                            quality: int = 85,
+                            min_quality: int = 50,
+                            min_side_px: int = 256) -> Tuple[bytes, str]:
+    """
+    Encode a rendered page (fitz.Pixmap) as PNG, JPEG or WebP within *max_bytes*.
+    Returns (image_bytes, mime_type).
+
+    One trial encode usually settles it. Otherwise the size of the trial
+    predicts the next step: a lossy format that is less than 2x over budget
+    binary-searches the quality (min_quality..quality). Anything further over
+    is downscaled by sqrt(budget / size), since encoded size tracks pixel area.
+    "auto" picks JPEG over PNG only when it is substantially smaller
+    (photo-like pages); text pages stay lossless.
+    """
+    from PIL import Image
+
+    fmt = image_format if image_format in IMAGE_FORMATS else "png"
+
+    # PyMuPDF's own PNG encoder is fast; use it for the lossless trial
+    png_trial = pix.tobytes("png") if fmt in ("png", "auto") else None
+    if fmt == "png" and len(png_trial) <= max_bytes:
+        return png_trial, _IMAGE_MIME["png"]
+
+    mode = "RGBA" if pix.alpha else "RGB"
+    img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    if fmt in ("jpeg", "auto") and mode == "RGBA":
+        img = img.convert("RGB")
+
+    if fmt == "auto":
+        jpeg_trial = _encode_pil(img, "jpeg", quality)
+        if len(jpeg_trial) < 0.6 * len(png_trial):
+            fmt, data = "jpeg", jpeg_trial
+        else:
+            fmt, data = "png", png_trial
+        if len(data) <= max_bytes:
+            return data, _IMAGE_MIME[fmt]
+    elif fmt == "png":
+        data = png_trial
+    else:
+        data = _encode_pil(img, fmt, quality)
+        if len(data) <= max_bytes:
+            return data, _IMAGE_MIME[fmt]
+
+    # Lossy and close to the budget: search quality at full resolution
+    if fmt != "png" and len(data) < 2 * max_bytes:
+        lo, hi, best = min_quality, quality - 1, None
+        while lo <= hi:
+            q = (lo + hi) // 2
+            candidate = _encode_pil(img, fmt, q)
+            if len(candidate) <= max_bytes:
+                best, lo = candidate, q + 1
+            else:
+                hi = q - 1
+        if best is not None:
+            return best, _IMAGE_MIME[fmt]
+
+    # Downscale by the predicted factor; re-predict from each measurement
+    curr = img
+    while len(data) > max_bytes and min(curr.size) > min_side_px:
+        scale = (max_bytes / len(data)) ** 0.5 * 0.95
+        new_w = max(min_side_px, int(curr.width * scale))
+        new_h = max(min_side_px, int(curr.height * scale))
+        if new_w >= curr.width and new_h >= curr.height:
+            break
+        curr = curr.resize((new_w, new_h), Image.LANCZOS)
+        data = _encode_pil(curr, fmt, quality)
+
+    return data, _IMAGE_MIME[fmt]
+
+
+def _valid_page_numbers(pages: List[int], max_page: int) -> List[int]:
+    pages_to_render = []
+    for p in pages:
+        try:
+            p_int = int(p)
+        except Exception:
+            continue
+        if 1 <= p_int <= max_page:
+            pages_to_render.append(p_int)
+    return pages_to_render
+
+
+def _render_doc_page(doc, page_num: int, dpi: int, image_format: str, max_bytes: int) -> Optional[Tuple[bytes, str]]:
+    if not (1 <= page_num <= len(doc)):
+        return None
+    scale = dpi / 72.0
+    pix = doc[page_num - 1].get_pixmap(matrix=fitz.Matrix(scale, scale))
+    return encode_pixmap_to_budget(pix, image_format=image_format, max_bytes=max_bytes)
+
+
+# -----------------------------------------------------------------------------
+#  Document manifest
+# -----------------------------------------------------------------------------
+# Bumped when fields change, so stored manifests are rebuilt
+MANIFEST_VERSION = 1
+
+
+def _page_manifest(page) -> Dict[str, Any]:
+    rect = page.rect
+    page_area = abs(rect) or 1.0
+    text_chars = len("".join((page.get_text("text") or "").split()))
+    image_infos = page.get_image_info()
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & rect) for info in image_infos)
+    # Vector graphics only matter (and are only extracted) when there is nothing else
+    blank = not text_chars and not image_infos and not page.get_cdrawings()
+    return {
+        "page": page.number + 1,
+        "width": round(rect.width, 2),
+        "height": round(rect.height, 2),
+        "rotation": page.rotation,
+        "text_chars": text_chars,
+        "image_count": len(image_infos),
+        "image_coverage": round(min(1.0, image_area / page_area), 4),
+        "blank": blank,
+    }
+
+
+def build_document_manifest(doc) -> Dict[str, Any]:
+    """
+    Facts about every page of an open document, gathered in one pass: size
+    in points, rotation, text-layer characters (whitespace excluded), image
+    count, share of the page covered by images, and "blank" when the page has
+    no text, images or vector graphics at all.
+    """
+    pages = [_page_manifest(page) for page in doc]
+    return {"version": MANIFEST_VERSION, "page_count": len(pages), "pages": pages}
+
+
+def page_ink_stats(doc, page_num: int, dpi: int = 36, ink_delta: int = 64) -> Dict[str, float]:
+    """
+    Luminance statistics of a low-resolution grayscale render of one page:
+    standard deviation, and the share of "ink" pixels (differing from the
+    page's median by more than ink_delta, in either direction, so light text
+    on a dark page counts too). Scanned blank pages have noise but almost no
+    ink.
+    """
+    from PIL import Image
+
+    scale = dpi / 72.0
+    pix = doc[page_num - 1].get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    hist = Image.frombytes("L", (pix.width, pix.height), pix.samples).histogram()
+
+    total = sum(hist) or 1
+    mean = sum(level * count for level, count in enumerate(hist)) / total
+    variance = sum(count * (level - mean) ** 2 for level, count in enumerate(hist)) / total
+    seen, median = 0, 0
+    for median, count in enumerate(hist):
+        seen += count
+        if seen * 2 >= total:
+            break
+    ink = sum(count for level, count in enumerate(hist) if abs(level - median) > ink_delta)
+    return {"stddev": variance ** 0.5, "ink_ratio": ink / total}
+
+
+def rasterize_pdf_pages_to_bytes(pdf_path: Path,
+                                 pages: List[int],
+                                 dpi: int = 200,
+                                 image_format: str = "png",
+                                 max_bytes: int = MAX_IMAGE_BYTES) -> Dict[int, Tuple[bytes, str]]:
+    """
+    Rasterize selected PDF pages straight to encoded, size-capped image bytes
+    in memory. Returns {page_number: (image_bytes, mime_type)}; out-of-range
+    pages are skipped.
+    """
+    doc = fitz.open(str(pdf_path))
+    try:
+        out: Dict[int, Tuple[bytes, str]] = {}
+        for p in _valid_page_numbers(pages, len(doc)):
+            out[p] = _render_doc_page(doc, p, dpi, image_format, max_bytes)
+        return out
+    finally:
+        try:
+            doc.close()
+        except Exception:
+            pass
+
+
+# -----------------------------------------------------------------------------
+#  Open-document cache (this process)
+# -----------------------------------------------------------------------------
+@dataclass
+class _OpenDoc:
+    doc: "fitz.Document"
+    signature: Tuple[str, int, int]          # (path, mtime_ns, size)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+    borrowers: int = 0        # checked out and not yet returned (under the cache lock)
+    retired: bool = False     # dropped from the cache; the last borrower closes it
+
+
+def _file_signature(pdf_path: str) -> Tuple[str, int, int]:
+    st = os.stat(pdf_path)
+    return (pdf_path, st.st_mtime_ns, st.st_size)
+
+
+def _close_quietly(entry: _OpenDoc) -> None:
+    # Wait for any borrower to finish before closing under them
+    with entry.lock:
+        try:
+            entry.doc.close()
+        except Exception:
+            pass
+
+
+class DocumentCache:
+    """
+    Thread-safe LRU of open fitz.Document handles keyed by upload file_id, so
+    page counting, text extraction and rendering don't re-open (and re-parse
+    the xref of) the same PDF for every page.
+
+    fitz documents are not thread-safe: borrow() holds the document's own lock
+    for the duration of the with-block. Entries beyond max_docs, or unused for
+    idle_seconds, are closed; a file whose mtime/size changed is re-opened.
+    Borrowed entries are never evicted, and one dropped while borrowed (by
+    invalidate or a re-open) is closed when its last borrower returns it.
+    Call invalidate(file_id) before deleting an upload directory.
+    """
+
+    def __init__(self, max_docs: int = OPEN_DOC_CACHE_SIZE, idle_seconds: int = OPEN_DOC_IDLE_SECONDS):
+        self.max_docs = max(1, int(max_docs))
+        self.idle_seconds = idle_seconds
+        self._docs: "OrderedDict[str, _OpenDoc]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _checkout(self, file_id: str, pdf_path: str) -> _OpenDoc:
+        """Get (or open) the entry for file_id with a borrow registered on it."""
+        signature = _file_signature(pdf_path)
+        stale: List[_OpenDoc] = []
+        with self._lock:
+            entry = self._docs.get(file_id)
+            if entry is not None and entry.signature != signature:
+                stale.extend(self._retire_locked([self._docs.pop(file_id)]))
+                entry = None
+            if entry is None:
+                entry = _OpenDoc(doc=fitz.open(pdf_path), signature=signature)
+                self._docs[file_id] = entry
+            entry.borrowers += 1
+            entry.last_used = time.monotonic()
+            self._docs.move_to_end(file_id)
+            stale.extend(self._pop_evictable_locked(keep=file_id))
+
+        for old in stale:
+            _close_quietly(old)
+        return entry
+
+    def _release(self, entry: _OpenDoc) -> None:
+        with self._lock:
+            entry.borrowers -= 1
+            close = entry.retired and entry.borrowers == 0
+        if close:
+            _close_quietly(entry)
+
+    @staticmethod
+    def _retire_locked(entries: List[_OpenDoc]) -> List[_OpenDoc]:
+        """Mark dropped entries; returns those nobody is borrowing (safe to close now)."""
+        closable = []
+        for entry in entries:
+            entry.retired = True
+            if entry.borrowers == 0:
+                closable.append(entry)
+        return closable
+
+    def _pop_evictable_locked(self, keep: Optional[str] = None) -> List[_OpenDoc]:
+        # Oldest first; borrowed entries stay until they are returned
+        evicted = []
+        cutoff = time.monotonic() - self.idle_seconds
+        excess = len(self._docs) - self.max_docs
+        for fid, entry in list(self._docs.items()):
+            if fid == keep or entry.borrowers:
+                continue
+            if entry.last_used < cutoff or excess > 0:
+                evicted.append(self._docs.pop(fid))
+                excess -= 1
+        return evicted
+
+    @contextmanager
+    def borrow(self, file_id: str, pdf_path: str):
+        """Yield the open document for file_id, holding it exclusively."""
+        entry = self._checkout(file_id, str(pdf_path))
+        try:
+            with entry.lock:
+                yield entry.doc
+                entry.last_used = time.monotonic()
+        finally:
+            self._release(entry)
+
+    def invalidate(self, file_id: str) -> None:
+        with self._lock:
+            entry = self._docs.pop(file_id, None)
+            closable = self._retire_locked([entry]) if entry is not None else []
+        for entry in closable:
+            _close_quietly(entry)
+
+    def evict_idle(self) -> int:
+        """Close documents idle for longer than idle_seconds; returns how many."""
+        with self._lock:
+            evicted = self._pop_evictable_locked()
+        for entry in evicted:
+            _close_quietly(entry)
+        return len(evicted)
+
+    def close_all(self) -> None:
+        with self._lock:
+            entries = self._retire_locked(list(self._docs.values()))
+            self._docs.clear()
+        for entry in entries:
+            _close_quietly(entry)
+
+
+DOCUMENT_CACHE = DocumentCache()
+
+
+# -----------------------------------------------------------------------------
+#  Worker side
+# -----------------------------------------------------------------------------
+# (path, mtime_ns, size) -> open fitz.Document; a replaced upload gets a new key
+_WORKER_DOCS: "OrderedDict[Tuple[str, int, int], fitz.Document]" = OrderedDict()
+
+
+def _worker_open_doc(pdf_path: str):
+    st = os.stat(pdf_path)
+    key = (pdf_path, st.st_mtime_ns, st.st_size)
+
+    doc = _WORKER_DOCS.get(key)
+    if doc is not None:
+        _WORKER_DOCS.move_to_end(key)
+        return doc
+
+    doc = fitz.open(pdf_path)
+    _WORKER_DOCS[key] = doc
+    while len(_WORKER_DOCS) > RENDER_WORKER_DOC_CACHE:
+        _, old = _WORKER_DOCS.popitem(last=False)
+        try:
+            old.close()
+        except Exception:
+            pass
+    return doc
+
+
+def render_page_bytes(pdf_path: str,
+                      page_num: int,
+                      dpi: int = 200,
+                      image_format: str = "png",
+                      max_bytes: int = MAX_IMAGE_BYTES) -> Optional[Tuple[bytes, str]]:
+    """
+    Render and encode one page using the worker's document cache.
+    Returns (image_bytes, mime_type), or None for an out-of-range page.
+    """
+    doc = _worker_open_doc(str(pdf_path))
+    return _render_doc_page(doc, int(page_num), dpi, image_format, max_bytes)
+
+
+# -----------------------------------------------------------------------------
+#  Render service
+# -----------------------------------------------------------------------------
+class RenderTimeout(RuntimeError):
+    """A page took longer than RENDER_TIMEOUT_SECONDS on the render pool."""
+
+
+class RenderService:
+    """
+    Renders pages in a ProcessPoolExecutor so throughput scales with cores.
+
+    The pool is created on first use with the "spawn" start method (forking a
+    threaded Flask process is unsafe). If the pool breaks (a worker crashed)
+    it is rebuilt on the next call, and the failed call is retried on the
+    calling thread. Callers wait for a free worker before submitting, so a
+    page's *timeout* only counts its own render time; a page that takes
+    longer raises RenderTimeout and the workers are killed, so a
+    pathological page cannot hold a thread forever. With processes=0
+    everything runs on the calling thread.
+    """
+
+    def __init__(self, processes: int = RENDER_PROCESSES, timeout: float = RENDER_TIMEOUT_SECONDS):
+        self.processes = max(0, int(processes))
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # One permit per worker: nothing waits in the pool's own queue
+        self._slots = threading.BoundedSemaphore(max(1, self.processes))
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.processes == 0:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor, terminate: bool = False) -> None:
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        # shutdown() does not stop a worker stuck inside a page, so kill them;
+        # other renders in flight on this pool fail over to the calling thread
+        workers = list((getattr(pool, "_processes", None) or {}).values()) if terminate else []
+        try:
+            pool.shutdown(wait=False)
+        except Exception:
+            pass
+        for proc in workers:
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+
+    def render(self,
+               pdf_path: str,
+               page_num: int,
+               dpi: int = 200,
+               image_format: str = "png",
+               max_bytes: int = MAX_IMAGE_BYTES,
+               file_id: Optional[str] = None) -> Optional[Tuple[bytes, str]]:
+        """
+        Render one page; returns (image_bytes, mime_type) or None if out of range.
+        In-thread renders reuse DOCUMENT_CACHE when file_id is given.
+        """
+        args = (str(pdf_path), int(page_num), dpi, image_format, max_bytes)
+
+        if self.processes:
+            with self._slots:
+                pool = self._get_pool()
+                try:
+                    return pool.submit(render_page_bytes, *args).result(timeout=self.timeout)
+                except (BrokenProcessPool, FuturesCancelled) as e:
+                    # Another page's timeout recycled the pool under us
+                    logger.warning(f"Render pool unavailable, rendering in-thread: {e!r}")
+                    self._discard_pool(pool)
+                except FuturesTimeout:
+                    logger.error(f"Rendering page {page_num} of {pdf_path} timed out; recycling the render pool")
+                    self._discard_pool(pool, terminate=True)
+                    raise RenderTimeout(f"rendering timed out after {self.timeout:g}s")
+
+        if file_id:
+            with DOCUMENT_CACHE.borrow(file_id, str(pdf_path)) as doc:
+                return _render_doc_page(doc, int(page_num), dpi, image_format, max_bytes)
+        return rasterize_pdf_pages_to_bytes(Path(pdf_path), [page_num], dpi, image_format, max_bytes).get(int(page_num))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+RENDER_SERVICE = RenderService()
@@ -0,0 +1,394 @@
+"""
+Disk-budgeted store for the per-upload directories under UPLOAD_ROOT.
+
+Every <file_id> directory has a last-access time, kept in memory and mirrored
+to the directory mtime (at most once a minute) so the order survives a
+restart. A sweep removes directories idle for longer than max_idle_seconds,
+then least recently used ones while the store is over its byte budget.
+Directories named by the pinned_ids callback (uploads that running jobs still
+need) are never removed, and neither is anything touched in the last
+min_idle_seconds. Names starting with "_" or "." are not uploads and are left
+alone.
+
+ContentStore keeps one canonical PDF per distinct upload under <root>/_cas,
+named by the SHA-256 of the uploaded bytes, with its manifest beside it.
+Upload directories hard-link their document.pdf (and manifest.json) to these,
+so a re-upload costs a hash and a link; a blob with no links left is removed
+by its sweep.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Directory mtimes are refreshed at most this often per upload
+MTIME_PERSIST_SECONDS = 60
+
+
+@dataclass
+class _Upload:
+    last_access: float        # time.time()
+    size_bytes: int = 0
+    mtime_persisted: float = 0.0
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            # A hard-linked file is shared; charge each link its share
+                            total += st.st_size // max(1, st.st_nlink)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+class UploadStore:
+    """LRU manager for upload directories with a disk budget and pinning."""
+
+    def __init__(self, root: Path, max_bytes: int, max_idle_seconds: float,
+                 pinned_ids: Callable[[], Iterable[str]] = lambda: (),
+                 on_evict: Optional[Callable[[str], None]] = None,
+                 min_idle_seconds: float = 300):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.max_idle_seconds = float(max_idle_seconds)
+        self.min_idle_seconds = float(min_idle_seconds)
+        self._pinned_ids = pinned_ids
+        self._on_evict = on_evict
+        self._uploads: Dict[str, _Upload] = {}
+        self._lock = threading.Lock()
+        self._evicted = 0
+        self._evicted_bytes = 0
+
+    @staticmethod
+    def _is_upload_name(name: str) -> bool:
+        return bool(name) and not name.startswith(("_", "."))
+
+    # -- access tracking -------------------------------------------------
+    def touch(self, file_id: str) -> None:
+        """Record an access to *file_id* (cheap; called on every page read)."""
+        if not self._is_upload_name(file_id):
+            return
+        now = time.time()
+        with self._lock:
+            upload = self._uploads.get(file_id)
+            if upload is None:
+                if not (self.root / file_id).is_dir():
+                    return
+                upload = self._uploads[file_id] = _Upload(last_access=now)
+            upload.last_access = now
+            persist = now - upload.mtime_persisted >= MTIME_PERSIST_SECONDS
+            if persist:
+                upload.mtime_persisted = now
+        if persist:
+            try:
+                os.utime(self.root / file_id, (now, now))
+            except OSError:
+                pass
+
+    def register(self, file_id: str) -> int:
+        """
+        Track a new or grown upload directory and make room for it by evicting
+        other uploads if the budget is exceeded. Returns its size in bytes.
+        """
+        size = _dir_size(self.root / file_id)
+        self.touch(file_id)
+        with self._lock:
+            upload = self._uploads.get(file_id)
+            if upload is not None:
+                upload.size_bytes = size
+            over_budget = self._total_bytes_locked() > self.max_bytes
+        if over_budget:
+            self.enforce_budget(keep=file_id)
+        return size
+
+    def _total_bytes_locked(self) -> int:
+        return sum(u.size_bytes for u in self._uploads.values())
+
+    # -- eviction --------------------------------------------------------
+    def _pinned(self) -> Optional[Set[str]]:
+        try:
+            return set(self._pinned_ids())
+        except Exception as e:
+            # Without the pin list nothing can be evicted safely
+            logger.warning(f"Upload pin lookup failed, skipping eviction: {e}")
+            return None
+
+    def _pop_lru_locked(self, pinned: Set[str], now: float, keep: Optional[str]) -> List[Tuple[str, int]]:
+        victims = []
+        total = self._total_bytes_locked()
+        for file_id, upload in sorted(self._uploads.items(), key=lambda kv: kv[1].last_access):
+            if total <= self.max_bytes:
+                break
+            if file_id in pinned or file_id == keep or now - upload.last_access < self.min_idle_seconds:
+                continue
+            victims.append((file_id, upload.size_bytes))
+            total -= upload.size_bytes
+        for file_id, _ in victims:
+            del self._uploads[file_id]
+        return victims
+
+    def _remove(self, victims: List[Tuple[str, int]], reason: str) -> int:
+        freed = 0
+        for file_id, size in victims:
+            if self._on_evict is not None:
+                try:
+                    self._on_evict(file_id)
+                except Exception:
+                    logger.exception(f"on_evict failed for upload {file_id}")
+            shutil.rmtree(self.root / file_id, ignore_errors=True)
+            freed += size
+            logger.info(f"Evicted upload {file_id} ({size:,} bytes, {reason})")
+        with self._lock:
+            self._evicted += len(victims)
+            self._evicted_bytes += freed
+        return freed
+
+    def enforce_budget(self, keep: Optional[str] = None) -> int:
+        """Evict least recently used uploads until under budget; returns bytes freed."""
+        pinned = self._pinned()
+        if pinned is None:
+            return 0
+        with self._lock:
+            victims = self._pop_lru_locked(pinned, time.time(), keep)
+            still_over = self._total_bytes_locked() > self.max_bytes
+        if still_over:
+            logger.warning("Upload store over budget; everything left is pinned or in use")
+        return self._remove(victims, "over budget")
+
+    def _rescan(self) -> None:
+        """Refresh sizes from disk, adopt untracked directories, drop vanished ones."""
+        seen = {}
+        try:
+            children = list(self.root.iterdir())
+        except OSError:
+            children = []
+        for child in children:
+            if not self._is_upload_name(child.name):
+                continue
+            try:
+                if not child.is_dir():
+                    continue
+                mtime = child.stat().st_mtime
+            except OSError:
+                continue
+            seen[child.name] = (mtime, _dir_size(child))
+
+        with self._lock:
+            for file_id in list(self._uploads):
+                if file_id not in seen:
+                    del self._uploads[file_id]
+            for file_id, (mtime, size) in seen.items():
+                upload = self._uploads.get(file_id)
+                if upload is None:
+                    # Unknown since start-up: the mtime is the last recorded access
+                    upload = self._uploads[file_id] = _Upload(last_access=mtime, mtime_persisted=mtime)
+                upload.size_bytes = size
+
+    def sweep(self) -> Dict[str, Any]:
+        """Rescan the disk, evict idle then over-budget uploads; returns a summary."""
+        self._rescan()
+        pinned = self._pinned()
+        if pinned is None:
+            return {"removed": 0, "freed_bytes": 0, "skipped": "pin lookup failed"}
+
+        now = time.time()
+        with self._lock:
+            idle = [(fid, u.size_bytes) for fid, u in self._uploads.items()
+                    if fid not in pinned and now - u.last_access > self.max_idle_seconds]
+            for file_id, _ in idle:
+                del self._uploads[file_id]
+        freed = self._remove(idle, "idle")
+
+        with self._lock:
+            lru = self._pop_lru_locked(pinned, now, keep=None)
+        freed += self._remove(lru, "over budget")
+
+        with self._lock:
+            total = self._total_bytes_locked()
+            count = len(self._uploads)
+        return {
+            "removed": len(idle) + len(lru),
+            "freed_bytes": freed,
+            "uploads": count,
+            "total_bytes": total,
+            "pinned": len(pinned),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "uploads": len(self._uploads),
+                "total_bytes": self._total_bytes_locked(),
+                "max_bytes": self.max_bytes,
+                "max_idle_seconds": self.max_idle_seconds,
+                "evicted": self._evicted,
+                "evicted_bytes": self._evicted_bytes,
+            }
+
+
+# -----------------------------------------------------------------------------
+#  Content-addressed PDFs
+# -----------------------------------------------------------------------------
+CAS_DIR_NAME = "_cas"
+CONTENT_MARKER = ".content_id"  # in an upload directory: the content id it links to
+MANIFEST_NAME = "manifest.json"  # in an upload directory, beside document.pdf
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class ContentStore:
+    """Canonical PDFs keyed by the SHA-256 of the uploaded bytes."""
+
+    def __init__(self, root: Path, grace_seconds: float = 300,
+                 on_remove: Optional[Callable[[str], None]] = None):
+        self.dir = Path(root) / CAS_DIR_NAME
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.grace_seconds = float(grace_seconds)
+        self._on_remove = on_remove
+        self._content_ids: Dict[str, str] = {}  # file_id -> content id
+
+    def blob_path(self, content_id: str) -> Path:
+        return self.dir / f"{content_id}.pdf"
+
+    def manifest_path(self, content_id: str) -> Path:
+        return self.dir / f"{content_id}.json"
+
+    def has(self, content_id: str) -> bool:
+        return self.blob_path(content_id).exists()
+
+    def save_stream(self, stream: BinaryIO, chunk_size: int = HASH_CHUNK_BYTES) -> Tuple[str, Path]:
+        """Copy *stream* to a temporary file in the store, hashing as it goes."""
+        digest = hashlib.sha256()
+        fd, tmp_name = tempfile.mkstemp(dir=self.dir, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        return digest.hexdigest(), Path(tmp_name)
+
+    def adopt(self, content_id: str, pdf_path: Path) -> Path:
+        """Make *pdf_path* the blob for *content_id* unless one already exists."""
+        blob = self.blob_path(content_id)
+        try:
+            # Linking never replaces a blob that a concurrent upload just added
+            os.link(pdf_path, blob)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not blob.exists():
+                shutil.copy2(pdf_path, blob)
+        return blob
+
+    def link(self, content_id: str, upload_dir: Path) -> Path:
+        """Point upload_dir/document.pdf at the blob and record the content id."""
+        dest = Path(upload_dir) / "document.pdf"
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(self.blob_path(content_id), dest)
+        except OSError:
+            # No hard links on this filesystem: the upload keeps its own copy
+            shutil.copy2(self.blob_path(content_id), dest)
+        (Path(upload_dir) / CONTENT_MARKER).write_text(content_id)
+        self._content_ids[Path(upload_dir).name] = content_id
+        return dest
+
+    def content_id_for(self, file_id: str) -> Optional[str]:
+        """Content id of an upload whose blob still exists, else None."""
+        content_id = self._content_ids.get(file_id)
+        if content_id is None:
+            try:
+                content_id = (self.dir.parent / file_id / CONTENT_MARKER).read_text().strip()
+            except OSError:
+                return None
+            self._content_ids[file_id] = content_id
+        return content_id if self.has(content_id) else None
+
+    def forget(self, file_id: str) -> None:
+        self._content_ids.pop(file_id, None)
+
+    def load_manifest(self, content_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.manifest_path(content_id).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def save_manifest(self, content_id: str, manifest: Dict[str, Any]) -> None:
+        # Written whole and swapped in, so readers and links never see a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=self.dir, prefix=".tmp_")
+        with os.fdopen(fd, "w") as out:
+            json.dump(manifest, out, separators=(",", ":"))
+        os.replace(tmp_name, self.manifest_path(content_id))
+
+    def link_manifest(self, content_id: str, upload_dir: Path) -> Path:
+        """Place the stored manifest at upload_dir/manifest.json."""
+        dest = Path(upload_dir) / MANIFEST_NAME
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(self.manifest_path(content_id), dest)
+        except OSError:
+            shutil.copy2(self.manifest_path(content_id), dest)
+        return dest
+
+    def sweep(self) -> Dict[str, Any]:
+        """Remove blobs no upload links to any more, and abandoned temp files."""
+        now = time.time()
+        removed, freed, kept = 0, 0, 0
+        try:
+            entries = list(self.dir.iterdir())
+        except OSError:
+            entries = []
+        for path in entries:
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if now - st.st_mtime < self.grace_seconds:
+                if path.suffix == ".pdf":
+                    kept += 1
+                continue
+            if path.name.startswith(".tmp_"):
+                path.unlink(missing_ok=True)
+                continue
+            if path.suffix != ".pdf":
+                continue
+            if st.st_nlink > 1:
+                kept += 1
+                continue
+            content_id = path.stem
+            if self._on_remove is not None:
+                try:
+                    self._on_remove(content_id)
+                except Exception:
+                    logger.exception(f"on_remove failed for content {content_id}")
+            path.unlink(missing_ok=True)
+            self.manifest_path(content_id).unlink(missing_ok=True)
+            removed += 1
+            freed += st.st_size
+        return {"removed": removed, "freed_bytes": freed, "blobs": kept}
@@ -0,0 +1,97 @@
+"""
+Throughput of the export text cleaning on synthetic model output.
+
+    python benchmarks/bench_clean_text.py [--mb 100] [--non-ascii 0.3] [--repeat 3]
+
+Compares backend.export.clean_text with the previous per-cell cleaning
+(NFC normalisation plus a control-character regex on every value) and checks
+that both produce identical output.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.export import clean_text  # noqa: E402
+
+_CTRL_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")
+
+
+def reference_clean(x: str) -> str:
+    """Per-cell cleaning as the export did it before."""
+    x = unicodedata.normalize('NFC', x)
+    return _CTRL_RE.sub('', x)
+
+
+_TABLE_ROW = "| {label} | {value:,} | {note} |\n"
+_ASCII_NOTES = ["", "see note 3", "restated", "unaudited"]
+# Precomposed and decomposed (non-NFC) accents, dashes, currency, quotes
+_NON_ASCII_NOTES = _ASCII_NOTES + ["caf\u00e9/na\u00efve \u2014 \u20ac", "e\u0301tude", "\u201cquoted\u201d"]
+
+
+def make_pages(total_mb: float, non_ascii: float = 0.3, seed: int = 0):
+    """
+    Markdown pages of 1-8 KB; a *non_ascii* share of pages contain accents
+    (some decomposed), a few contain control characters.
+    """
+    rng = random.Random(seed)
+    target = int(total_mb * 1_000_000)
+    pages, size = [], 0
+    while size < target:
+        notes = _NON_ASCII_NOTES if rng.random() < non_ascii else _ASCII_NOTES
+        lines = ["## Page summary\n", "| Item | Value | Note |\n", "|---|---|---|\n"]
+        for _ in range(rng.randint(15, 120)):
+            lines.append(_TABLE_ROW.format(
+                label=rng.choice(["Revenue", "EBITDA", "Capex", "Headcount"]),
+                value=rng.randint(0, 10_000_000),
+                note=rng.choice(notes),
+            ))
+        if rng.random() < 0.02:
+            lines.append("stray \x0b form \x0c feed \x01\n")
+        page = "".join(lines)
+        pages.append(page)
+        size += len(page.encode('utf-8'))
+    return pages, size
+
+
+def _time(fn, pages, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for page in pages:
+            fn(page)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mb", type=float, default=100.0, help="MB of synthetic output (default 100)")
+    parser.add_argument("--non-ascii", type=float, default=0.3, help="share of pages with non-ASCII text (default 0.3)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per variant; best is reported")
+    args = parser.parse_args()
+
+    pages, size = make_pages(args.mb, args.non_ascii)
+    mb = size / 1_000_000
+    print(f"{len(pages):,} pages, {mb:.1f} MB")
+
+    mismatches = sum(clean_text(p) != reference_clean(p) for p in pages)
+    print(f"output identical to reference: {mismatches == 0} ({mismatches} mismatches)")
+
+    results = {}
+    for name, fn in (("reference (NFC + regex)", reference_clean), ("clean_text", clean_text)):
+        seconds = _time(fn, pages, args.repeat)
+        results[name] = seconds
+        print(f"{name:<24} {seconds:7.3f} s  {mb / seconds:8.1f} MB/s")
+
+    speedup = results["reference (NFC + regex)"] / results["clean_text"]
+    print(f"speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
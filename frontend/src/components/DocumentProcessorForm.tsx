@@ -698,6 +698,27 @@ if (hasAnyInitParams && missing.length > 0) {
     return await response.json();
   };
 
+  // Batch finalization runs in the background; poll until it is DONE or ERROR
+  const waitForFinalize = async (statusUrl: string) => {
+    while (true) {
+      const statusResp = await apiFetch(statusUrl);
+      if (!statusResp.ok) {
+        const msg = await statusResp.text().catch(() => '');
+        throw new Error(msg || `Finalize status failed with status ${statusResp.status}`);
+      }
+
+      const status = await statusResp.json();
+      if (status.status === 'DONE') {
+        return status.result || {};
+      }
+      if (status.status === 'ERROR' || !status.success) {
+        throw new Error(status.error || 'Batch finalize failed.');
+      }
+
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+  };
+
 const handleSubmit = async (e: React.FormEvent) => {
     e.preventDefault();
 
@@ -827,6 +848,7 @@ const handleSubmit = async (e: React.FormEvent) => {
           body: JSON.stringify({
             job_ids: batchJobIds,
             output_config: { ...(outputConfig as any), batch_mode: true },
+            async: true,
           }),
         });
 
@@ -835,12 +857,14 @@ const handleSubmit = async (e: React.FormEvent) => {
           throw new Error(msg || `Finalize failed with status ${finalizeResp.status}`);
         }
 
-        const finalData = await finalizeResp.json();
+        const finalizeInit = await finalizeResp.json();
 
-        if (!finalData.success) {
-          throw new Error(finalData.error || 'Batch finalize failed.');
+        if (!finalizeInit.success || !finalizeInit.status_url) {
+          throw new Error(finalizeInit.error || 'Batch finalize failed.');
         }
 
+        const finalData = await waitForFinalize(finalizeInit.status_url);
+
         if ((outputConfig.outputType === 'browser') && finalData.xlsx_download_url) {
           const absolute = apiUrl(finalData.xlsx_download_url);
           await downloadCsv(absolute, finalData.xlsx_filename);
@@ -9,6 +9,7 @@ interface OutputLocationModalProps {
 
 export interface OutputConfig {
   outputType: 'browser' | 'sharepoint' | 'init_from_sharepoint';
+  outputFormat?: 'xlsx' | 'parquet' | 'jsonl' | 'csv';
   sharepointFolder?: string;
   filename?: string;
   contextId?: string;